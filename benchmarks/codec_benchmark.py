@@ -0,0 +1,95 @@
+"""
+    Compares wire codecs on BatchElements like the ones used in the examples.
+    For every element type, reports encode and decode throughput along with bytes sent on the wire.
+
+    python -m benchmarks.codec_benchmark
+"""
+
+from cheese.codec import encode_task, decode_task
+from cheese.data import BatchElement
+from cheese.tasks import Task
+
+from dataclasses import dataclass
+from typing import List
+from PIL import Image
+import numpy as np
+import time
+
+# Mirrors of the BatchElements in examples/, which can't be imported without their heavy dependencies
+
+@dataclass
+class ImageSelectionBatchElement(BatchElement):
+    img1_url : str = None
+    img2_url : str = None
+    select : int = 0
+    time : float = 0
+
+@dataclass
+class SDGenerationElement(BatchElement):
+    prompt : str = None
+    seed : int = None
+    img : Image.Image = None
+    rating : float = -1
+    batch_size : int = 1
+    batch_index : int = 0
+
+@dataclass
+class LMGenerationElement(BatchElement):
+    query : str = None
+    completions : List[str] = None
+    rankings : List[int] = None
+
+@dataclass
+class AudioSampleElement(BatchElement):
+    id : int = None
+    sample_rate : int = 16000
+    audio : np.ndarray = None
+    rating : int = -1
+    comment : str = ""
+
+def msgpack_variant(cls):
+    return dataclass(type(cls.__name__ + "Msgpack", (cls,), {"codec" : "msgpack"}))
+
+def make_elements():
+    rng = np.random.default_rng(0)
+    img = Image.fromarray(rng.integers(0, 256, (512, 512, 3), dtype = np.uint8))
+    return {
+        "image_selection" : (ImageSelectionBatchElement, dict(
+            img1_url = "https://example.com/images/1.jpg", img2_url = "https://example.com/images/2.jpg"
+        )),
+        "sd_generation" : (SDGenerationElement, dict(
+            prompt = "A beautiful award winning portrait, digital art", seed = 1234, img = img
+        )),
+        "lm_generation" : (LMGenerationElement, dict(
+            query = "Tell me a fun fact about rabbits", completions = ["Rabbits can see nearly 360 degrees. " * 8] * 5
+        )),
+        "audio" : (AudioSampleElement, dict(
+            id = 3, audio = rng.standard_normal(16000 * 5).astype(np.float32)
+        )),
+    }
+
+def bench(task : Task, min_time : float = 0.5):
+    payload = encode_task(task)
+
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        encode_task(task)
+        n += 1
+    encode_rate = n / (time.perf_counter() - start)
+
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        decode_task(payload)
+        n += 1
+    decode_rate = n / (time.perf_counter() - start)
+
+    return len(payload), encode_rate, decode_rate
+
+if __name__ == "__main__":
+    print(f"{'element':<18}{'codec':<10}{'bytes':>12}{'encode/s':>12}{'decode/s':>12}")
+    for name, (cls, kwargs) in make_elements().items():
+        for codec_cls in [cls, msgpack_variant(cls)]:
+            size, enc, dec = bench(Task(codec_cls(**kwargs)))
+            print(f"{name:<18}{codec_cls.codec:<10}{size:>12}{enc:>12.0f}{dec:>12.0f}")
@@ -1,16 +1,20 @@
-from typing import ClassVar, Iterable, Tuple, Dict, Any, Callable
+from typing import ClassVar, Iterable, Tuple, Dict, Any, Callable, List, Union
 
 from cheese.client import ClientManager, ClientStatistics
 from cheese.client.gradio_client import GradioClientManager
 from cheese.pipeline import Pipeline
 from cheese.models import BaseModel
+from cheese.models.replicas import ReplicaModel
+from cheese.transport import Transport, make_transport
+from cheese.codec import set_blob_store
+from cheese.codec.blob_store import BlobStore
 
 import cheese.utils.msg_constants as msg_constants
 from cheese.utils.rabbit_utils import rabbitmq_callback
 
 import pickle
-from b_rabbit import BRabbit
 from tqdm import tqdm
+import queue
 import time
 
 # Master object for CHEESE
@@ -42,13 +46,45 @@ class CHEESE:
 
     :param port: Port to run rabbitmq server on
     :type port: int
-    
+
     :param debug: Print debug messages for rabbitmq
     :type debug: bool
 
     :param no_login: If true, users don't need password, only their ID, to log in
     :type no_login: bool
+
+    :param transport: Messaging backend used between components. "rabbitmq" uses a RabbitMQ server at host and port.
+        "in_process" passes messages through thread-safe queues, and can be used when pipeline, model and frontend
+        all run in this process. A Transport object can also be given directly.
+    :type transport: Union[str, Transport]
+    
+    :param blob_threshold: If set, images and arrays in BatchElements that are at least this many bytes are written once to
+        shared memory and only a handle to them is sent between components. They are reclaimed once the pipeline posts the element.
+        Arrays received this way are read-only, so copy one to change it.
+    :type blob_threshold: int
+
+    :param blob_max_age: With blob_threshold, blobs are reclaimed this many seconds after being written even if the element
+        holding them was never posted
+    :type blob_max_age: float
+
+    :param scheduling: How gradio client manager chooses which idle client gets a new task. "fifo" gives it to the client
+        that has been idle longest, "round_robin" cycles through clients so each gets a task in turn.
+    :type scheduling: str
+
+    :param prefetch: Number of extra tasks gradio client manager keeps ready for each client, so the next task can be shown
+        as soon as a user submits instead of waiting on the pipeline. Tasks are still only drawn when a client has room for them.
+    :type prefetch: int
+
+    :param wait_timeout: If set, longest time in seconds a gradio frontend waits on a task for a user before showing them
+        a waiting screen instead. Otherwise requests wait until a task arrives.
+    :type wait_timeout: float
+
+    :param model_replicas: If set, model is run as this many replicas in worker processes, each with its own instance
+        of model_cls (see ReplicaModel). Their statistics are under "replicas" in model_stats.
+    :type model_replicas: int
     """
+    CONSUMPTION_INTERVAL : ClassVar[float] = 1.0 # Least seconds between telling pipeline how fast clients consume tasks
+
     def __init__(
         self,
         pipeline_cls = None, client_cls = None, model_cls = None,
@@ -56,35 +92,45 @@ class CHEESE:
         gradio : bool = True, draw_always : bool = False,
         host : str = 'localhost', port : int = 5672,
         debug : bool = False,
-        no_login : bool = False
+        no_login : bool = False,
+        transport : Union[str, Transport] = "rabbitmq",
+        blob_threshold : int = None,
+        scheduling : str = "fifo",
+        prefetch : int = 0,
+        wait_timeout : float = None,
+        blob_max_age : float = None,
+        model_replicas : int = None
         ):
 
         self.gradio = gradio
         self.draw_always = draw_always
         self.debug = debug
 
-        # Initialize rabbit MQ server
-        self.connection = BRabbit(host=host, port=port)
+        # Initialize messaging backend
+        self.connection : Transport = make_transport(transport, host = host, port = port)
+
+        # Shared memory for large fields
+        self.blob_store : BlobStore = None
+        if blob_threshold is not None:
+            self.blob_store = BlobStore(threshold = blob_threshold, max_age = blob_max_age)
+            set_blob_store(self.blob_store)
 
         # Channel for client to notify of task completion
-        self.subscriber = self.connection.EventSubscriber(
-            b_rabbit = self.connection,
+        self.subscriber = self.connection.subscriber(
             routing_key = 'main',
             publisher_name = 'client',
             event_listener = self.client_ping
         )
 
         # Receive tasks via API
-        self.api_subscriber = self.connection.EventSubscriber(
-            b_rabbit = self.connection,
+        self.api_subscriber = self.connection.subscriber(
             routing_key = 'main',
             publisher_name = 'api',
             event_listener = self.api_ping
         )
 
         # Send data back through API
-        self.api_publisher = self.connection.EventPublisher(
-            b_rabbit = self.connection,
+        self.api_publisher = self.connection.publisher(
             publisher_name = 'main'
         )
 
@@ -93,26 +139,39 @@ class CHEESE:
         
         # components initialized
         self.pipeline : Pipeline = pipeline_cls(**pipeline_kwargs)
-        self.model : BaseModel = model_cls(**model_kwargs) if model_cls is not None else None
+        # Pipelines that don't override observe_consumption don't use the rate, so it is never computed for them
+        self.observe_consumption = type(self.pipeline).observe_consumption is not Pipeline.observe_consumption
+        self.last_observed = 0.0
+        self.model : BaseModel = None
+        if model_cls is not None:
+            if model_replicas is not None:
+                self.model = ReplicaModel(model_cls, model_kwargs, replicas = model_replicas)
+            else:
+                self.model = model_cls(**model_kwargs)
 
         self.client_cls = client_cls
         if gradio:
-            self.client_manager = GradioClientManager(no_login = no_login)
+            self.client_manager = GradioClientManager(
+                no_login = no_login, scheduling = scheduling,
+                prefetch = prefetch, wait_timeout = wait_timeout
+            )
+            self.task_slots = 1 + prefetch # Tasks each client can hold at once
         else:
             self.client_manager = ClientManager()
+            self.task_slots = 1
 
         self.pipeline.init_connection(self.connection)
         self.client_manager.init_connection(self.connection)
         if self.model is not None: self.model.init_connection(self.connection)
 
         self.clients = 0
-        self.busy_clients = 0
+        self.assigned_tasks = 0 # Tasks given to clients that have not yet been sent on to pipeline
 
         self.finished = False # For when pipeline is exhausted
         self.launched = False
 
         # Communication with API
-        self.receive_buffer = []
+        self.receive_buffer : queue.Queue = queue.Queue()
 
         self.url = None
 
@@ -132,35 +191,80 @@ class CHEESE:
     
     def start_listening(self, listen_every : float = 1.0):
         """
-        If using as a server, call this before running client.
+        If using as a server, call this before running client. Blocks and handles API commands as soon as they arrive.
 
-        :param run_every: Listen for messages every x seconds
+        :param listen_every: Longest time to block waiting for a message at once. Does not delay handling of messages.
+        :type listen_every: float
         """
 
-        def send(msg : Any):
-            self.api_publisher.publish('api', pickle.dumps(msg))
-        
         while True:
-            if self.receive_buffer:
-                if self.debug:
-                    print(f"Responding to message: {self.receive_buffer[0]}")
-                msg = self.receive_buffer.pop(0).split("|")
-                if msg[0] == msg_constants.READY:
-                    send(True)
-                elif msg[0] == msg_constants.LAUNCH:
-                    send(self.launch())
-                elif msg[0] == msg_constants.ADD:
-                    send(self.create_client(int(msg[1])))
-                elif msg[0] == msg_constants.REMOVE:
-                    self.remove_client(int(msg[1]))
-                elif msg[0] == msg_constants.STATS:
-                    send(self.get_stats())
-                elif msg[0] == msg_constants.DRAW:
-                    self.draw()
-                else:
-                    print("Warning: Unknown message received", msg)
-            time.sleep(listen_every)
-        
+            try:
+                msg = self.receive_buffer.get(timeout = listen_every)
+            except queue.Empty:
+                continue
+
+            # Handle everything that arrived since the last wakeup
+            msgs = [msg]
+            while True:
+                try:
+                    msgs.append(self.receive_buffer.get_nowait())
+                except queue.Empty:
+                    break
+
+            for msg in msgs:
+                self.handle_api_message(msg)
+
+    def handle_api_message(self, msg : msg_constants.APIRequest):
+        """
+        Execute a single API command and send back its result, tagged with the ID of the request.
+        Messages from older APIs in the form of "command|arg" strings are also accepted.
+        """
+        if self.debug:
+            print(f"Responding to message: {msg}")
+
+        legacy = isinstance(msg, str)
+        if legacy:
+            command, *args = msg.split("|")
+            msg = msg_constants.APIRequest(command, tuple(int(arg) for arg in args))
+
+        res, error = None, None
+        try:
+            res = self.execute_command(msg.command, *msg.args)
+        except Exception as e:
+            error = repr(e)
+            print(f"Warning: Exception while handling API command {msg.command}: {error}")
+
+        if legacy:
+            # Older APIs only wait on commands that return something
+            if msg.command not in [msg_constants.REMOVE, msg_constants.DRAW]:
+                self.api_publisher.publish('api', pickle.dumps(res))
+            return
+
+        reply_to = getattr(msg, "reply_to", None) or 'api' # Requests from APIs before reply_to existed lack it
+        self.api_publisher.publish(reply_to, pickle.dumps(msg_constants.APIResponse(msg.request_id, res, error)))
+
+    def execute_command(self, command : str, *args) -> Any:
+        """
+        Run API command with given arguments and return its result.
+        """
+        if command == msg_constants.READY:
+            return True
+        elif command == msg_constants.LAUNCH:
+            return self.launch()
+        elif command == msg_constants.ADD:
+            return self.create_client(*args)
+        elif command == msg_constants.REMOVE:
+            return self.remove_client(*args)
+        elif command == msg_constants.ADD_MANY:
+            return self.create_clients(*args)
+        elif command == msg_constants.REMOVE_MANY:
+            return self.remove_clients(*args)
+        elif command == msg_constants.STATS:
+            return self.get_stats()
+        elif command == msg_constants.DRAW:
+            return self.draw()
+        raise Exception(f"Error: Unknown API command {command}")
+
     @rabbitmq_callback
     def api_ping(self, msg):
         """
@@ -178,13 +282,25 @@ class CHEESE:
             print(f"Received message from API: {pickle.loads(msg)}")
 
         try:
-            self.receive_buffer.append(pickle.loads(msg))
+            self.receive_buffer.put(pickle.loads(msg))
         except Exception as e:
             # Check if the error has to do with receive_buffer not being defined yet
             if "receive_buffer" in str(e):
                 print("Warning: RabbitMQ queue non-empty at startup. Consider restarting RabbitMQ server if unexpected errors arise.")
 
 
+    @property
+    def busy_clients(self) -> int:
+        """
+        Former name of assigned_tasks, kept for compatibility. Without prefetch, each client holds at most one task,
+        so this is the number of clients working on a task.
+        """
+        return self.assigned_tasks
+
+    @busy_clients.setter
+    def busy_clients(self, value : int):
+        self.assigned_tasks = value
+
     @rabbitmq_callback
     def client_ping(self, msg):
         """
@@ -193,10 +309,10 @@ class CHEESE:
         msg = msg.decode('utf-8')
         if msg == msg_constants.SENT:
             # Client sent task to pipeline, needs a new one
-            self.busy_clients -= 1
+            self.assigned_tasks -= 1
             self.draw()
         elif msg == msg_constants.RECEIVED:
-            self.busy_clients += 1
+            self.assigned_tasks += 1
         else:
             raise Exception("Error: Client pinged master with unknown message")
 
@@ -212,7 +328,9 @@ class CHEESE:
 
         id, pwd = self.client_manager.add_client(id)
         self.clients += 1
-        self.draw() # pre-emptively draw a task for the client to pick up
+        for _ in range(self.task_slots):
+            if self.finished: break
+            self.draw() # pre-emptively draw tasks for the client to pick up
         return id, pwd
     
     def remove_client(self, id : int):
@@ -225,6 +343,36 @@ class CHEESE:
         self.client_manager.remove_client(id)
         self.clients -= 1
 
+    def create_clients(self, ids : Iterable[int]) -> List[Tuple[int, int]]:
+        """
+        Create several client instances at once. All clients are registered before any tasks are drawn,
+        then tasks are drawn for all new clients in a single pass.
+
+        :param ids: Unique identifying numbers for the clients.
+        :type ids: Iterable[int]
+
+        :return: Username and password for each client, in the same order as ids
+        """
+        credentials = self.client_manager.add_clients(ids)
+        self.clients += len(credentials)
+
+        # Pre-emptively draw tasks for the new clients to pick up
+        for _ in range(len(credentials) * self.task_slots):
+            if self.finished: break
+            self.draw()
+
+        return credentials
+
+    def remove_clients(self, ids : Iterable[int]):
+        """
+        Remove several clients at once.
+
+        :param ids: Unique identifying numbers for the clients.
+        :type ids: Iterable[int]
+        """
+        for id in ids:
+            self.remove_client(id)
+
     def get_stats(self) -> Dict:
         """
         Get various statistics in the form of a dictionary.
@@ -234,10 +382,14 @@ class CHEESE:
             - finished: Whether pipeline is exhausted
             - num_clients: Number of clients connected to CHEESE
             - num_busy_clients: Number of clients currently working on a task
+            - num_assigned_tasks: Number of tasks held by clients, including prefetched ones and those of removed clients
+                waiting to be handed to another client
             - num_tasks: Number of tasks completed overall
             - client_stats: Dictionary of client statistics
             - model_stats: Dictionary of model statistics
             - pipeline_stats: Dictionary of pipeline statistics
+            - prefetch_stats: Dictionary of pipeline prefetching statistics (None if pipeline does not prefetch)
+            - blob_stats: Dictionary of blob store statistics (None if blob store is not used)
         """
         client_stats = self.client_manager.client_statistics
 
@@ -251,22 +403,28 @@ class CHEESE:
             'url' : self.url,
             'finished' : self.finished,
             'num_clients' : self.clients,
-            'num_busy_clients' : self.busy_clients,
+            'num_busy_clients' : self.clients - self.client_manager.get_idle_clients(),
+            'num_assigned_tasks' : self.assigned_tasks,
             'num_tasks' : num_tasks,
             'client_stats' : client_stats,
             'model_stats' : self.model.get_stats() if self.model else None,
-            'pipeline_stats' : self.pipeline.get_stats()
+            'pipeline_stats' : self.pipeline.get_stats(),
+            'prefetch_stats' : self.pipeline.prefetch_stats(),
+            'blob_stats' : self.blob_store.get_stats() if self.blob_store else None
         }
 
     def draw(self):
         """
-        Draws a sample from data pipeline and creates a task to send to clients. Does nothing if no free clients.
+        Draws a sample from data pipeline and creates a task to send to clients. Does nothing if clients have no room for more tasks.
         This check if overriden if draw_always is set to True.
         """
 
-        if not self.draw_always and self.busy_clients >= self.clients:
+        if not self.draw_always and self.assigned_tasks >= self.clients * self.task_slots:
             return
 
+        if self.observe_consumption and time.time() - self.last_observed >= self.CONSUMPTION_INTERVAL:
+            self.last_observed = time.time()
+            self.pipeline.observe_consumption(self.client_manager.consumption_rate())
         exhausted = not self.pipeline.queue_task()
 
         if exhausted and self.pipeline.exhausted():
@@ -1,16 +1,19 @@
-from typing import ClassVar, Iterable, Tuple, Dict, Any, Callable
+from typing import ClassVar, Iterable, Tuple, Dict, Any, Callable, List, Union
 
 from cheese.client import ClientManager, ClientStatistics
 from cheese.client.gradio_client import GradioClientManager
 from cheese.pipeline import Pipeline
 from cheese.models import BaseModel
+from cheese.transport import Transport, make_transport
 
 import cheese.utils.msg_constants as msg_constants
 from cheese.utils.rabbit_utils import rabbitmq_callback
 
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeoutError
 import pickle
-from b_rabbit import BRabbit
 from tqdm import tqdm
+import threading
+import uuid
 import time
 
 # Master object for CHEESE
@@ -29,18 +32,26 @@ class CHEESEAPI:
 
     :param debug: Print debug messages for rabbitmq
     :type debug: bool
+
+    :param transport: Messaging backend, should match the one used by the main server. "rabbitmq" uses a RabbitMQ server at host and port.
+        To use the API with an in-process CHEESE object, pass its connection (i.e. CHEESEAPI(transport = cheese.connection)).
+    :type transport: Union[str, Transport]
     """
-    def __init__(self, host : str = 'localhost', port : int = 5672, timeout : float = 10, debug : bool = False):
+    def __init__(
+        self, host : str = 'localhost', port : int = 5672, timeout : float = 10, debug : bool = False,
+        transport : Union[str, Transport] = "rabbitmq"
+        ):
         self.timeout = timeout
 
-        # Initialize rabbit MQ server
-        self.connection = BRabbit(host=host, port=port)
+        # Initialize messaging backend
+        self.connection : Transport = make_transport(transport, host = host, port = port)
         self.debug = debug
 
-        # Channel to get results back from main server
-        self.subscriber = self.connection.EventSubscriber(
-            b_rabbit = self.connection,
-            routing_key = 'api',
+        # Channel to get results back from main server. Each API has its own, so responses reach the API that sent
+        # the request even when several share a connection
+        self.reply_key = f"api_{uuid.uuid4().hex}"
+        self.subscriber = self.connection.subscriber(
+            routing_key = self.reply_key,
             publisher_name = 'main',
             event_listener = self.main_listener
         )
@@ -48,58 +59,98 @@ class CHEESEAPI:
         self.subscriber.subscribe_on_thread()
 
         # Channel to send commands to main server
-        self.publisher = self.connection.EventPublisher(
-            b_rabbit = self.connection,
+        self.publisher = self.connection.publisher(
             publisher_name = 'api'
         )
 
-        # Any received values from main will be placed here
-        self.buffer : Any = None 
+        # Requests awaiting a response from main, by request ID
+        self.pending : Dict[str, Future] = {}
+        self.pending_lock = threading.Lock()
 
         # Check if main server is running
-        self.connected_to_main : bool = False
-        self.publisher.publish('main', pickle.dumps(msg_constants.READY))
-        self.connected_to_main = True
+        self.check_connection()
 
-        if not self.await_result():
+    def check_connection(self):
+        """
+        Raise an exception if main server does not respond.
+        """
+        if not self.request(msg_constants.READY):
             raise Exception("Main server not running")
 
     @rabbitmq_callback
     def main_listener(self, msg : str):
         """
-        Callback for main server. Receives messages from main server and places them in buffer.
+        Callback for main server. Receives responses from main server and resolves the request they correspond to.
         """
+        msg = pickle.loads(msg)
         if self.debug:
-            print(f"Received message from main server: {pickle.loads(msg)}")
-        if not self.connected_to_main:
-            print("Warning: RabbitMQ queue non-empty at startup. Consider restarting RabbitMQ server if unexpected errors arise.")
+            print(f"Received message from main server: {msg}")
+
+        future = None
+        if isinstance(msg, msg_constants.APIResponse):
+            with self.pending_lock:
+                future = self.pending.pop(msg.request_id, None)
+
+        if future is None:
+            # Response to a request nobody is waiting on anymore (i.e. it timed out or was cancelled)
+            if self.debug:
+                print("Warning: Received response that does not match any pending request.")
             return
-        msg = pickle.loads(msg)
-        self.buffer = msg
-    
-    def await_result(self, time_step : float = 0.5):
+
+        try:
+            if msg.error is not None:
+                future.set_exception(Exception(f"Error: Main server failed to handle request: {msg.error}"))
+            else:
+                future.set_result(msg.result)
+        except InvalidStateError:
+            # Request was cancelled while response was in flight
+            pass
+
+    def send_request(self, command : str, *args) -> Future:
         """
-        Assuming buffer is none
+        Send command to main server without waiting on its result.
+
+        :param command: API command to send (see cheese.utils.msg_constants)
+        :type command: str
+
+        :return: Future that is resolved once main server responds
+        :rtype: concurrent.futures.Future
         """
-        total_time = 0
-        while self.buffer is None:
-            time.sleep(time_step)
-            total_time += time_step
-            if total_time > self.timeout:
-                print("Warning: Timeout exceeded awaiting API result.")
-                return None
-        
-        res = self.buffer
-        self.buffer = None
-        return res
+        request = msg_constants.APIRequest(command, args, uuid.uuid4().hex, self.reply_key)
+        future = Future()
+        with self.pending_lock:
+            self.pending[request.request_id] = future
+
+        def untrack(_):
+            # Stop tracking request once it is resolved or cancelled
+            with self.pending_lock:
+                self.pending.pop(request.request_id, None)
+        future.add_done_callback(untrack)
 
+        self.publisher.publish('main', pickle.dumps(request))
+        return future
+
+    def request(self, command : str, *args) -> Any:
+        """
+        Send command to main server and wait for its result. Safe to call from several threads at once.
+        Returns None if main server does not respond within timeout.
+
+        :param command: API command to send (see cheese.utils.msg_constants)
+        :type command: str
+        """
+        future = self.send_request(command, *args)
+        try:
+            return future.result(timeout = self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            print("Warning: Timeout exceeded awaiting API result.")
+            return None
 
     def launch(self) -> str:
         """
         Launch the frontend and return URL for users to access it.
         """
-        self.publisher.publish('main', pickle.dumps(msg_constants.LAUNCH))
-        return self.await_result()
+        return self.request(msg_constants.LAUNCH)
     
     def create_client(self, id : int) -> Tuple[int, int]:
         """
@@ -110,10 +161,7 @@ class CHEESEAPI:
 
         :return: Username and password user can use to log in to CHEESE
         """
-        msg = f"{msg_constants.ADD}|{id}"
-        self.publisher.publish('main', pickle.dumps(msg))
-
-        return self.await_result()
+        return self.request(msg_constants.ADD, id)
     
     def remove_client(self, id : int):
         """
@@ -122,10 +170,27 @@ class CHEESEAPI:
         :param id: A unique identifying number for the client.
         :type id: int
         """
-        msg = f"{msg_constants.REMOVE}|{id}"
-        self.publisher.publish('main', pickle.dumps(msg))
+        return self.request(msg_constants.REMOVE, id)
+
+    def create_clients(self, ids : Iterable[int]) -> List[Tuple[int, int]]:
+        """
+        Create several client instances in a single request.
 
-        return self.await_result()
+        :param ids: Unique identifying numbers for the clients.
+        :type ids: Iterable[int]
+
+        :return: Username and password for each client, in the same order as ids
+        """
+        return self.request(msg_constants.ADD_MANY, list(ids))
+
+    def remove_clients(self, ids : Iterable[int]):
+        """
+        Remove several clients in a single request.
+
+        :param ids: Unique identifying numbers for the clients.
+        :type ids: Iterable[int]
+        """
+        return self.request(msg_constants.REMOVE_MANY, list(ids))
 
     def get_stats(self) -> Dict:
         """
@@ -134,21 +199,22 @@ class CHEESEAPI:
         :return: Dictionary containing following statistics:
             - num_clients: Number of clients connected to CHEESE
             - num_busy_clients: Number of clients currently working on a task
+            - num_assigned_tasks: Number of tasks held by clients, including prefetched ones and those of removed clients
+                waiting to be handed to another client
             - num_tasks: Number of tasks completed overall
             - client_stats: Dictionary of client statistics
             - model_stats: Dictionary of model statistics
             - pipeline_stats: Dictionary of pipeline statistics
+            - prefetch_stats: Dictionary of pipeline prefetching statistics
         """
-        self.publisher.publish('main', pickle.dumps(msg_constants.STATS))
-
-        return self.await_result()
+        return self.request(msg_constants.STATS)
 
     def draw(self):
         """
         Draws a sample from data pipeline and creates a task to send to clients. Does nothing if no free clients.
         This check if overriden if draw_always is set to True.
         """
-        self.publisher.publish('main', pickle.dumps(msg_constants.DRAW))
+        self.send_request(msg_constants.DRAW)
 
     def progress_bar(self, max_tasks : int, access_stat : Callable, call_every : Callable = None, check_every : float = 1.0):
         """
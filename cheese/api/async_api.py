@@ -0,0 +1,119 @@
+from typing import Any, Dict, Iterable, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import asyncio
+
+from cheese.api import CHEESEAPI
+import cheese.utils.msg_constants as msg_constants
+
+class AsyncCHEESEAPI(CHEESEAPI):
+    """
+    Asyncio version of CHEESEAPI. All commands are awaitable, and any number of them can be in flight
+    over the same connection at once (i.e. with asyncio.gather). Should be created with AsyncCHEESEAPI.create,
+    which checks the main server is running without blocking the event loop. Takes the same arguments as CHEESEAPI.
+
+    :param timeout: Default timeout for waiting for main server to respond. Requests that time out are cancelled
+        and raise asyncio.TimeoutError.
+    :type timeout: float
+    """
+    def __init__(self, **kwargs):
+        # Publishing can block on the broker, so it is done off the event loop, in order, on a single thread
+        self.publish_executor = ThreadPoolExecutor(max_workers = 1)
+
+        super().__init__(**kwargs)
+
+    @classmethod
+    async def create(cls, **kwargs) -> "AsyncCHEESEAPI":
+        """
+        Create API and wait for main server to respond.
+
+        :param kwargs: Keyword arguments for CHEESEAPI
+        """
+        loop = asyncio.get_running_loop()
+        api = await loop.run_in_executor(None, partial(cls, **kwargs))
+        if not await api.request(msg_constants.READY):
+            raise Exception("Main server not running")
+        return api
+
+    def check_connection(self):
+        # Done asynchronously in create
+        pass
+
+    async def request(self, command : str, *args, timeout : float = None) -> Any:
+        """
+        Send command to main server and await its result.
+
+        :param command: API command to send (see cheese.utils.msg_constants)
+        :type command: str
+
+        :param timeout: Timeout for this request. Defaults to timeout given to constructor.
+        :type timeout: float
+        """
+        loop = asyncio.get_running_loop()
+        future = await loop.run_in_executor(self.publish_executor, partial(self.send_request, command, *args))
+
+        # Timing out cancels the underlying request, so a late response is dropped
+        return await asyncio.wait_for(
+            asyncio.wrap_future(future),
+            timeout = self.timeout if timeout is None else timeout
+        )
+
+    async def launch(self) -> str:
+        """
+        Launch the frontend and return URL for users to access it.
+        """
+        return await self.request(msg_constants.LAUNCH)
+
+    async def create_client(self, id : int) -> Tuple[int, int]:
+        """
+        Create a client instance with given id.
+
+        :param id: A unique identifying number for the client.
+        :type id: int
+
+        :return: Username and password user can use to log in to CHEESE
+        """
+        return await self.request(msg_constants.ADD, id)
+
+    async def remove_client(self, id : int):
+        """
+        Remove client with given id.
+
+        :param id: A unique identifying number for the client.
+        :type id: int
+        """
+        return await self.request(msg_constants.REMOVE, id)
+
+    async def create_clients(self, ids : Iterable[int]) -> List[Tuple[int, int]]:
+        """
+        Create several client instances in a single request.
+
+        :param ids: Unique identifying numbers for the clients.
+        :type ids: Iterable[int]
+
+        :return: Username and password for each client, in the same order as ids
+        """
+        return await self.request(msg_constants.ADD_MANY, list(ids))
+
+    async def remove_clients(self, ids : Iterable[int]):
+        """
+        Remove several clients in a single request.
+
+        :param ids: Unique identifying numbers for the clients.
+        :type ids: Iterable[int]
+        """
+        return await self.request(msg_constants.REMOVE_MANY, list(ids))
+
+    async def get_stats(self) -> Dict:
+        """
+        Get various statistics in the form of a dictionary. See CHEESEAPI.get_stats.
+        """
+        return await self.request(msg_constants.STATS)
+
+    async def draw(self):
+        """
+        Draws a sample from data pipeline and creates a task to send to clients. Returns once command is sent.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.publish_executor, partial(self.send_request, msg_constants.DRAW))
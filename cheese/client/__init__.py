@@ -2,13 +2,13 @@ from abc import abstractmethod
 from cheese.data import BatchElement
 
 from cheese.tasks import Task
+from cheese.codec import encode_task, decode_task
 from cheese.client.states import ClientState as CS
 import cheese.utils.msg_constants as msg_constants
 from cheese.utils.rabbit_utils import rabbitmq_callback
 
-import pickle
 
-from b_rabbit import BRabbit
+from cheese.transport import Transport
 import gradio as gr
 
 from dataclasses import dataclass
@@ -29,6 +29,15 @@ class ClientStatistics:
 
         return self.total_time / self.total_tasks
 
+    def rate(self) -> float:
+        """
+        Get number of tasks completed per second, from average time. 0 if no tasks have been completed.
+        """
+        avg_time = self.avg_time()
+        if avg_time <= 0: return 0.0
+
+        return 1 / avg_time
+
 class ClientManager:
     def __init__(self):
         # <id : int, Client>
@@ -66,26 +75,30 @@ class ClientManager:
         for key in self.client_states:
             if self.client_states[key] == CS.IDLE:
                 cnt += 1
+        return cnt
     
-    def init_connection(self, connection : BRabbit):
+    def consumption_rate(self) -> float:
+        """
+        Estimated number of tasks per second clients complete between them. Base manager keeps no timing, so gives 0.
+        """
+        return 0.0
+
+    def init_connection(self, connection : Transport):
         """
         Initialize message channel and consumption callbacks.
         """
 
-        self.publisher = connection.EventPublisher(
-            b_rabbit = connection,
+        self.publisher = connection.publisher(
             publisher_name = 'client'
         )
 
-        self.subscriber = connection.EventSubscriber(
-            b_rabbit = connection,
+        self.subscriber = connection.subscriber(
             routing_key = 'client',
             publisher_name = 'pipeline',
             event_listener = self.dequeue_task
         )
 
-        self.subscriber_active = connection.EventSubscriber(
-            b_rabbit = connection,
+        self.subscriber_active = connection.subscriber(
             routing_key = 'active',
             publisher_name = 'model',
             event_listener = self.dequeue_active_task
@@ -109,7 +122,7 @@ class ClientManager:
         task.data.client_id = id
         task.client_id = id
 
-        tasks = pickle.dumps(task)
+        tasks = encode_task(task)
 
         to_pipeline = task.data.trip >= task.data.trip_max
 
@@ -140,7 +153,7 @@ class ClientManager:
         """
         Receive message for a new task. Assume this is from pipeline
         """
-        task : Task = pickle.loads(tasks)
+        task : Task = decode_task(tasks)
         task.data.trip += 1
 
         for id in self.clients:
@@ -161,7 +174,7 @@ class ClientManager:
         """
         Receive message for in progress (active) task.
         """
-        task : Task = pickle.loads(tasks)
+        task : Task = decode_task(tasks)
 
         id = task.client_id
 
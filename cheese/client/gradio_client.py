@@ -1,20 +1,22 @@
 from abc import abstractmethod
 
-from typing import Any, Iterable, Dict, Tuple, List, Callable
+from typing import Any, Iterable, Dict, Tuple, List, Callable, Union
 
 from cheese.data import BatchElement
 from cheese.tasks import Task
+from cheese.codec import encode_task, decode_task
 from cheese.client.states import ClientState as CS
 from cheese.client import ClientManager, ClientStatistics
+from cheese.client.scheduling import IdleClientPolicy, make_policy
 import cheese.utils.msg_constants as msg_constants
 from cheese.utils.rabbit_utils import rabbitmq_callback
 
-import pickle
 import joblib
 
-from b_rabbit import BRabbit
 import gradio as gr
 from gradio.components import Component
+from collections import deque
+import threading
 import time
 
 import random
@@ -22,9 +24,29 @@ import random
 class GradioClientManager(ClientManager):
     """
     ClientManager for frontends made in Gradio
+
+    :param no_login: If True, users don't need a password to log in
+    :type no_login: bool
+
+    :param scheduling: Policy for choosing which idle client receives a new task. "fifo" picks the client that
+        has been idle longest, "round_robin" cycles through clients so each gets a task in turn. Can also be an IdleClientPolicy.
+    :type scheduling: Union[str, IdleClientPolicy]
+
+    :param prefetch: Number of tasks to keep ready for each client on top of the one they are working on,
+        so a new task can be shown as soon as they submit.
+    :type prefetch: int
+
+    :param wait_timeout: If set, longest time in seconds frontend waits on a task for a user before showing them
+        a waiting screen (see GradioFront.present_waiting). Otherwise frontend waits until a task arrives.
+    :type wait_timeout: float
     """
-    def __init__(self, no_login : bool = False):
+    def __init__(
+        self, no_login : bool = False, scheduling : Union[str, IdleClientPolicy] = "fifo",
+        prefetch : int = 0, wait_timeout : float = None
+        ):
         self.no_login = no_login
+        self.prefetch = prefetch
+        self.wait_timeout = wait_timeout
 
         # Rabbit connections
         self.publisher = None # to pipeline or model
@@ -40,7 +62,13 @@ class GradioClientManager(ClientManager):
 
         self.client_tasks : Dict[int, Iterable[Task]]= {} # A stack of tasks to serve each client
         self.client_states : Dict[int, CS] = {} # The state of each client
+        self.client_load : Dict[int, int] = {} # Number of tasks from pipeline each client is holding
+        self.idle_clients : IdleClientPolicy = make_policy(scheduling) # Index over clients with room for another task
+        self.state_lock = threading.Lock()
+        self.task_conditions : Dict[int, threading.Condition] = {} # Signalled when a task is given to each client
+        self.orphaned_tasks : deque = deque() # Tasks no client had room for (i.e. those of removed clients), waiting for one to have room
         self.client_statistics : Dict[int, ClientStatistics] = {} # Stats on each client
+        self.total_rate = 0.0 # Sum of rates of all clients, updated as they submit so it never has to be recomputed
 
         self.front : GradioFront = None
 
@@ -79,7 +107,12 @@ class GradioClientManager(ClientManager):
             raise Exception("Error: Trying to create client with ID that has already been taken")
         
         self.client_tasks[id] = []
-        self.client_states[id] = CS.IDLE
+        with self.state_lock:
+            self.client_load[id] = 0
+            self.client_states[id] = CS.IDLE
+            self.task_conditions[id] = threading.Condition(self.state_lock)
+            self.idle_clients.add(id)
+            self.serve_orphaned_tasks()
 
         pwd = random.randrange(100000,999999)
 
@@ -89,11 +122,88 @@ class GradioClientManager(ClientManager):
 
         return id, pwd
 
+    def add_clients(self, ids : Iterable[int]) -> List[Tuple[int, int]]:
+        """
+        Add several new clients. No client is added if any of the IDs is already taken.
+
+        :param ids: IDs for the new clients
+
+        :return: ID and password for each new client
+        """
+        ids = list(ids)
+        if len(set(ids)) != len(ids) or any(id in self.id_pass for id in ids):
+            raise Exception("Error: Trying to create clients with IDs that are repeated or have already been taken")
+
+        return [self.add_client(id) for id in ids]
+
     def remove_client(self, id : int):
-        del self.client_tasks[id]
-        del self.client_states[id]
+        """
+        Remove a client. Tasks it was holding (including prefetched ones and the one it was working on)
+        are handed to other clients, or kept until one has room.
+        """
+        with self.state_lock:
+            self.idle_clients.forget(id)
+            del self.client_states[id]
+            del self.client_load[id]
+            # Wake anyone waiting on a task for this client so they can be told to terminate
+            self.task_conditions.pop(id).notify_all()
+
+            tasks = self.client_tasks.pop(id)
+            backup = self.task_backup.pop(id, None)
+            if backup is not None:
+                tasks.insert(0, backup)
+            for task in tasks:
+                self.reassign_task(task)
+            self.total_rate -= self.client_statistics.pop(id).rate()
+        self.client_ids.remove(id)
         del self.id_pass[id]
-        del self.client_statistics[id]
+
+    def assign_task(self, task : Task):
+        """
+        Give task to next idle client, if there is one. Should be called with state_lock held.
+
+        :return: ID of client given the task, or None if no client has room for it
+        """
+        id = self.idle_clients.select()
+        if id is None:
+            return None
+
+        self.client_tasks[id].append(task)
+        self.client_load[id] += 1
+        if self.client_load[id] < self.task_slots():
+            self.idle_clients.add(id)
+        if self.client_states[id] == CS.IDLE:
+            self.client_states[id] = CS.BUSY
+        self.task_conditions[id].notify()
+        return id
+
+    def reassign_task(self, task : Task):
+        """
+        Give task of a removed client to another client, or keep it until one has room. Main object still counts
+        the task as assigned, so it is not replaced by a new one from pipeline. Should be called with state_lock held.
+        """
+        if self.assign_task(task) is None:
+            self.orphaned_tasks.append(task)
+
+    def serve_orphaned_tasks(self):
+        """
+        Give tasks waiting in orphaned_tasks to clients that have room for them. Should be called with state_lock held.
+        """
+        while self.orphaned_tasks and self.assign_task(self.orphaned_tasks[0]) is not None:
+            self.orphaned_tasks.popleft()
+
+    def set_state(self, id : int, state : CS):
+        """
+        Set state of client.
+        """
+        with self.state_lock:
+            self.client_states[id] = state
+
+    def task_slots(self) -> int:
+        """
+        How many tasks from pipeline each client can hold at once.
+        """
+        return 1 + self.prefetch
 
     def query_client(self, id : int, password : int):
         if id in self.id_pass:
@@ -101,13 +211,17 @@ class GradioClientManager(ClientManager):
                 return True
         return False
 
-    def await_new_task(self, id : int) -> Task:
+    def await_new_task(self, id : int, timeout : float = None) -> Task:
         """
         GradioFront should call this with ID of client. It will return a new task if one is available. Otherwise,
-        it will loop and wait for one.
+        it will block until one is given to the client.
         
         :param id: ID of the client awaiting a task
 
+        :param timeout: If set, longest time in seconds to wait for a task. If none arrives in time,
+            a task with the waiting flag set (and no data) is returned instead.
+        :type timeout: float
+
         :return: A task, as soon as it is available
         """
 
@@ -124,15 +238,31 @@ class GradioClientManager(ClientManager):
         if id in self.task_backup:
             return self.task_backup[id]
 
-        while True:
-            if self.client_tasks[id]:
-                new_task : Task = self.client_tasks[id].pop(0)
-                new_task.data.start_time = time.time() # Mark time stamp for when task was sent to client
-                self.task_backup[id] = new_task
-                return new_task
+        def ready() -> bool:
+            # Tasks coming back from model are put at front of queue, and are the only ones to serve while client is waiting
+            return id not in self.client_states or \
+                (len(self.client_tasks[id]) > 0 and self.client_states[id] != CS.WAITING)
 
-            time.sleep(0.5)
+        with self.state_lock:
+            if id in self.task_conditions and not self.task_conditions[id].wait_for(ready, timeout = timeout):
+                return Task(waiting = True) # Nothing yet, frontend can ask again later
+            if id not in self.client_states:
+                # Client was removed while waiting
+                return Task(terminate = True)
+            new_task : Task = self.client_tasks[id].pop(0)
+
+        new_task.data.start_time = time.time() # Mark time stamp for when task was sent to client
+        self.task_backup[id] = new_task
+        return new_task
     
+    def consumption_rate(self) -> float:
+        """
+        Estimated number of tasks per second clients complete between them, from the average time each client has
+        taken on its tasks so far. Clients that have not completed any tasks are not counted.
+        """
+        with self.state_lock:
+            return max(self.total_rate, 0.0) # Clamped, since removing clients' rates can leave rounding error
+
     def submit_task(self, id : int, task : Task):
         """
         GradioFront should call this to submit a finished task.
@@ -150,8 +280,12 @@ class GradioClientManager(ClientManager):
         if to_pipeline:
             task.data.end_time = time.time()
             # Update our user stats with this
-            self.client_statistics[id].total_time += task.data.end_time - task.data.start_time
-            self.client_statistics[id].total_tasks += 1
+            with self.state_lock:
+                stats = self.client_statistics[id]
+                self.total_rate -= stats.rate()
+                stats.total_time += task.data.end_time - task.data.start_time
+                stats.total_tasks += 1
+                self.total_rate += stats.rate()
 
         # If they submitted a task, backup can be emptied
         if id in self.task_backup:
@@ -170,7 +304,7 @@ class GradioClientManager(ClientManager):
         trip = task.data.trip
         trip_max = task.data.trip_max
 
-        tasks = pickle.dumps(task)
+        tasks = encode_task(task)
 
         to_pipeline = trip >= trip_max
         active = trip < trip_max - 1 # If trip is < trip_max - 1, client can expect to get data back
@@ -189,11 +323,18 @@ class GradioClientManager(ClientManager):
             )
         
         if active:
-            self.client_states[id] = CS.WAITING # Waiting to get data back from model
+            self.set_state(id, CS.WAITING) # Waiting to get data back from model
         else:
-            self.client_states[id] = CS.IDLE # Waiting for a new task from pipeline
-            
-            # Ping main object to get more data
+            # Task is done with client, so it has room for another
+            with self.state_lock:
+                self.client_load[id] -= 1
+                self.idle_clients.add(id)
+                # Client may still have prefetched tasks to work on
+                self.client_states[id] = CS.BUSY if self.client_tasks[id] else CS.IDLE
+                self.serve_orphaned_tasks()
+
+            # Ping main object to get more data. While tasks of removed clients are waiting, the freed slot goes to one
+            # of those, but main is still told so it no longer counts this task as assigned
             self.publisher.publish(
                 routing_key = 'main',
                 payload = msg_constants.SENT
@@ -204,40 +345,43 @@ class GradioClientManager(ClientManager):
         """
         Receive message for a new task. Assume this is from pipeline
         """
-        task : Task = pickle.loads(tasks)
+        task : Task = decode_task(tasks)
 
         task.data.trip += 1
 
-        for id in self.client_ids:
-            if self.client_states[id] == CS.IDLE:
-                self.client_tasks[id].append(task)
-                self.client_states[id] = CS.BUSY
+        with self.state_lock:
+            if self.assign_task(task) is None:
+                # No client has room (i.e. it was drawn just before a client was removed, or the Rabbit queue was populated
+                # before CHEESE was started), so it waits with tasks of removed clients instead of being dropped
+                self.orphaned_tasks.append(task)
 
-                self.publisher.publish(
-                    routing_key = 'main',
-                    payload = msg_constants.RECEIVED
-                )
-                return
-        
-        print("Warning: New task dequeued with no free clients to receive. This is expected if the Rabbit queue was populated before CHEESE was started")
+        self.publisher.publish(
+            routing_key = 'main',
+            payload = msg_constants.RECEIVED
+        )
     
     @rabbitmq_callback
     def dequeue_active_task(self, tasks : str):
         """
         Receive message for in progress (active) task. Assumed to be from model
         """
-        task : Task = pickle.loads(tasks)
+        task : Task = decode_task(tasks)
 
         id = task.client_id
 
-        if id not in self.client_ids:
-            raise Exception(f"Error: Active task dequeued but target client with id {id} does not exist")
+        task.data.trip += 1
+        with self.state_lock:
+            if id not in self.client_states:
+                # Client was removed while model worked on its task, so another client finishes it
+                self.reassign_task(task)
+                return
         if self.client_states[id] != CS.WAITING:
             raise Exception("Error: Active task dequeued but target client was not waiting for any active tasks.")
-        
-        task.data.trip += 1
-        self.client_tasks[id].append(task)
-        self.client_states[id] = CS.BUSY
+
+        with self.state_lock:
+            self.client_tasks[id].insert(0, task) # Ahead of any prefetched tasks
+            self.client_states[id] = CS.BUSY
+            self.task_conditions[id].notify()
 
 class GradioFront:
     """
@@ -257,6 +401,7 @@ class GradioFront:
 
             with gr.Column(visible = False) as main:
                 outputs = self.main()
+            self.outputs : List[Component] = outputs
             
             # Deal with login here
             def login_fn(id, pwd):
@@ -272,9 +417,9 @@ class GradioFront:
                 
                 if valid:
                     # When valid, get a task then switch to main screen
-                    task = self.manager.await_new_task(id)
+                    task = self.manager.await_new_task(id, timeout = self.manager.wait_timeout)
                     return [id, task, gr.update(), gr.update(visible = False), gr.update(visible = True)] + \
-                        self.present(task)
+                        self.present_task(task)
                 else:
                     return [id, None, gr.update(visible = True), gr.update(), gr.update()] + \
                         [None] * len(outputs)
@@ -357,6 +502,21 @@ class GradioFront:
         """
         pass
     
+    def present_waiting(self) -> List[Component]:
+        """
+        Outputs to show user while there is no task for them yet. Default behavior leaves all outputs as they are.
+        Their next response is not submitted, and only asks for a task again.
+        """
+        return [gr.update() for _ in self.outputs]
+
+    def present_task(self, task : Task) -> List[Component]:
+        """
+        Present task to user, or waiting screen if there is no task for them yet.
+        """
+        present_out = self.present_waiting() if task.waiting else self.present(task)
+        if type(present_out) is tuple: present_out = list(present_out)
+        return present_out
+
     def response(self, *inp) -> Any:
         """
         Submit input from user then stall until we have an output ready for them.
@@ -368,7 +528,12 @@ class GradioFront:
         """
 
         client_id : int = inp[0]
-        task : Task = None
+        task : Task = inp[1]
+
+        if task is not None and task.waiting:
+            # Nothing to submit, user is only asking for a task again
+            task = self.manager.await_new_task(client_id, timeout = self.manager.wait_timeout)
+            return [task] + self.present_task(task)
 
         try:
             task = self.receive(*inp)
@@ -379,12 +544,9 @@ class GradioFront:
                 raise e
 
         self.manager.submit_task(client_id, task)
-        task = self.manager.await_new_task(client_id)
-
-        present_out = self.present(task)
-        if type(present_out) is tuple: present_out = list(present_out)
+        task = self.manager.await_new_task(client_id, timeout = self.manager.wait_timeout)
 
-        return [task] + present_out
+        return [task] + self.present_task(task)
     
     def handle_input_exception(self, *args) -> Any:
         """
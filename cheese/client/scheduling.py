@@ -0,0 +1,115 @@
+from abc import abstractmethod
+from collections import OrderedDict
+from typing import Optional, Set, Union
+
+class IdleClientPolicy:
+    """
+    Abstract base class for an index over idle clients, which decides which of them gets the next task.
+    ClientManagers tell the policy whenever a client becomes idle or stops being idle.
+    """
+    @abstractmethod
+    def add(self, id : int):
+        """
+        Mark client as idle.
+        """
+        pass
+
+    @abstractmethod
+    def remove(self, id : int):
+        """
+        Mark client as no longer idle (or removed). Does nothing if client was not idle.
+        """
+        pass
+
+    def forget(self, id : int):
+        """
+        Drop a client that has been removed entirely.
+        """
+        self.remove(id)
+
+    @abstractmethod
+    def select(self) -> Optional[int]:
+        """
+        Pick an idle client to receive a task and mark it as no longer idle.
+
+        :return: ID of client, or None if no client is idle
+        """
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+class FIFOPolicy(IdleClientPolicy):
+    """
+    Gives tasks to whichever client has been idle the longest. All operations are O(1).
+    """
+    def __init__(self):
+        self.idle : OrderedDict = OrderedDict()
+
+    def add(self, id : int):
+        self.idle[id] = None
+
+    def remove(self, id : int):
+        self.idle.pop(id, None)
+
+    def select(self) -> Optional[int]:
+        if not self.idle:
+            return None
+        id, _ = self.idle.popitem(last = False)
+        return id
+
+    def __len__(self) -> int:
+        return len(self.idle)
+
+class RoundRobinPolicy(IdleClientPolicy):
+    """
+    Cycles through idle clients in laps. Within a lap, each client gets one task, in the order they became idle
+    (so clients added at once go in the order they were added). A client that is given a task waits for the next lap,
+    so it only gets another once every client that was idle in the meantime has had one. All operations are O(1),
+    amortized for select since starting a lap forgets the clients served in the last one.
+    """
+    def __init__(self):
+        self.current : OrderedDict = OrderedDict() # Idle clients not served yet in this lap
+        self.waiting : OrderedDict = OrderedDict() # Idle clients already served in this lap, for the next one
+        self.served : Set[int] = set() # Clients served in this lap
+
+    def add(self, id : int):
+        if id in self.served:
+            self.waiting[id] = None
+        else:
+            self.current[id] = None
+
+    def remove(self, id : int):
+        self.current.pop(id, None)
+        self.waiting.pop(id, None)
+
+    def forget(self, id : int):
+        self.remove(id)
+        self.served.discard(id)
+
+    def select(self) -> Optional[int]:
+        if not self.current:
+            # Start next lap
+            self.current, self.waiting = self.waiting, OrderedDict()
+            self.served = set()
+        if not self.current:
+            return None
+        id, _ = self.current.popitem(last = False)
+        self.served.add(id)
+        return id
+
+    def __len__(self) -> int:
+        return len(self.current) + len(self.waiting)
+
+def make_policy(policy : Union[str, IdleClientPolicy] = "fifo") -> IdleClientPolicy:
+    """
+    Create an idle client policy from its name ("fifo" or "round_robin"). Policy objects are returned as is.
+    """
+    if isinstance(policy, IdleClientPolicy):
+        return policy
+    if policy == "fifo":
+        return FIFOPolicy()
+    if policy == "round_robin":
+        return RoundRobinPolicy()
+    raise Exception(f"Error: Unknown client scheduling policy {policy}")
@@ -0,0 +1,192 @@
+from abc import abstractmethod
+from typing import Any, Dict, Iterable, List, Optional, Set, Union
+
+import pickle
+import io
+
+import numpy as np
+from PIL import Image
+
+from cheese.tasks import Task
+from cheese.codec.blob_store import BlobStore, BlobHandle
+
+class Codec:
+    """
+    Abstract base class for a wire codec. Codecs turn Tasks into bytes to be sent between components, and back again.
+    Which codec is used for a task is chosen by the codec attribute of the BatchElement class it contains.
+    Which codecs are decoded is up to the receiving end (see set_allowed_codecs).
+    """
+    name : str = None
+
+    @abstractmethod
+    def encode(self, task : Task) -> List[bytes]:
+        """
+        Encode task into bytes. Result is a list of chunks which are concatenated only once,
+        so large buffers can be returned as is rather than copied into a single object.
+        """
+        pass
+
+    @abstractmethod
+    def decode(self, payload : memoryview) -> Task:
+        """
+        Decode bytes produced by encode back into a task.
+        """
+        pass
+
+class PickleCodec(Codec):
+    """
+    Default codec. Works for any BatchElement, but should only be used between trusted components,
+    since decoding a pickle can run arbitrary code.
+    """
+    name = "pickle"
+
+    def encode(self, task : Task) -> List[bytes]:
+        if BLOB_STORE is None:
+            return [pickle.dumps(task, protocol = pickle.HIGHEST_PROTOCOL)]
+
+        buf = io.BytesIO()
+        BlobPickler(buf, protocol = pickle.HIGHEST_PROTOCOL).dump(task)
+        return [buf.getbuffer()]
+
+    def decode(self, payload : memoryview) -> Task:
+        return BlobUnpickler(io.BytesIO(payload)).load()
+
+class BlobPickler(pickle.Pickler):
+    """
+    Pickler that puts large images and arrays in the blob store and pickles only their handles.
+    """
+    def persistent_id(self, obj):
+        handle = blob_handle(obj)
+        if handle is None:
+            return None
+        return ("blob", handle.name, handle.kind, handle.nbytes, handle.meta)
+
+class BlobUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        _, name, kind, nbytes, meta = pid
+        return load_blob(BlobHandle(name, kind, nbytes, meta))
+
+CODECS : Dict[str, Codec] = {}
+
+# Store that large fields are written to when set, see set_blob_store
+BLOB_STORE : BlobStore = None
+
+# Names of codecs this end decodes, see set_allowed_codecs. None allows any registered codec.
+ALLOWED_CODECS : Set[str] = None
+
+def register_codec(codec : Codec):
+    """
+    Register a codec so BatchElements can opt into it by name.
+
+    :param codec: The codec to register
+    :type codec: Codec
+    """
+    CODECS[codec.name] = codec
+
+def get_codec(name : str) -> Codec:
+    """
+    Get registered codec by name.
+    """
+    if name not in CODECS:
+        raise Exception(f"Error: Codec {name} has not been registered")
+    return CODECS[name]
+
+def encode_task(task : Task) -> bytes:
+    """
+    Encode a task to be sent to another component. Payload is prefixed with the name of the codec used,
+    so the receiving end knows how to decode it.
+
+    :param task: Task to encode
+    :type task: Task
+
+    :return: Encoded task
+    :rtype: bytes
+    """
+    # Tasks without data (i.e. terminate signals) are plain flags, so they never need pickle
+    name = "msgpack" if task.data is None else type(task.data).codec
+    header = name.encode('utf-8')
+    return b"".join([bytes([len(header)]), header] + get_codec(name).encode(task))
+
+def decode_task(payload : Union[bytes, memoryview]) -> Task:
+    """
+    Decode a task produced by encode_task. The codec named in the payload is only used if it is allowed
+    (see set_allowed_codecs), since the payload comes from another component.
+
+    :param payload: Encoded task
+    :type payload: bytes
+
+    :return: Decoded task
+    :rtype: Task
+    """
+    payload = memoryview(payload)
+    header_len = payload[0]
+    name = bytes(payload[1:1 + header_len]).decode('utf-8')
+    if ALLOWED_CODECS is not None and name not in ALLOWED_CODECS:
+        raise Exception(f"Error: Received task encoded with codec {name}, which is not allowed")
+    return get_codec(name).decode(payload[1 + header_len:])
+
+def set_allowed_codecs(names : Iterable[str] = None):
+    """
+    Set which codecs tasks received by this process may be encoded with. Tasks encoded with any other codec are refused
+    before being decoded. When components that aren't trusted can send tasks, call this with only codecs that are safe
+    to decode (i.e. ["msgpack"]), so a peer cannot have a payload unpickled by naming pickle in its header.
+    Pass None to allow every registered codec, which is the default.
+
+    :param names: Names of allowed codecs
+    :type names: Iterable[str]
+    """
+    global ALLOWED_CODECS
+    if names is None:
+        ALLOWED_CODECS = None
+        return
+    names = set(names)
+    for name in names:
+        get_codec(name) # Raises if not registered
+    ALLOWED_CODECS = names
+
+def set_blob_store(store : BlobStore):
+    """
+    Set store that codecs write large images and arrays to, so only handles to them are sent between components.
+    Pass None to send everything inline.
+
+    :param store: The blob store
+    :type store: BlobStore
+    """
+    global BLOB_STORE
+    BLOB_STORE = store
+
+def get_blob_store() -> BlobStore:
+    return BLOB_STORE
+
+def blob_handle(obj : Any) -> Optional[BlobHandle]:
+    """
+    If a blob store is set and object is an image or array that belongs in it, put it in the store and return its handle.
+    Returns None if object should be encoded inline.
+    """
+    if BLOB_STORE is None or not isinstance(obj, (Image.Image, np.ndarray)):
+        return None
+
+    handle = BLOB_STORE.handle_of(obj)
+    if handle is None and BLOB_STORE.should_store(obj):
+        handle = BLOB_STORE.put(obj)
+    return handle
+
+def load_blob(handle : BlobHandle) -> Any:
+    """
+    Rebuild object from a received blob handle.
+    """
+    # Blobs from another process can still be read without a store of our own
+    store = BLOB_STORE if BLOB_STORE is not None else BlobStore()
+    return store.get(handle)
+
+def release_blobs(batch_element : Any):
+    """
+    Release blobs held by a BatchElement once it is no longer needed (i.e. after it has been posted).
+    """
+    if BLOB_STORE is not None:
+        BLOB_STORE.release_element(batch_element)
+
+register_codec(PickleCodec())
+
+from cheese.codec.msgpack_codec import MsgpackCodec
+register_codec(MsgpackCodec())
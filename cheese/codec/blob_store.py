@@ -0,0 +1,271 @@
+from dataclasses import dataclass, fields, is_dataclass
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, Optional
+
+import threading
+import weakref
+import time
+
+import numpy as np
+from PIL import Image
+
+@dataclass
+class BlobHandle:
+    """
+    Reference to a blob in shared memory. This is what travels in a task in place of the large object it refers to.
+
+    :param name: Name of the shared memory block
+    :type name: str
+
+    :param kind: "image" or "array"
+    :type kind: str
+
+    :param nbytes: Size of blob in bytes
+    :type nbytes: int
+
+    :param meta: Whatever is needed to rebuild the object (i.e. mode and size for an image, dtype and shape for an array)
+    :type meta: List
+    """
+    name : str = None
+    kind : str = None
+    nbytes : int = 0
+    meta : List = None
+
+class BlobStore:
+    """
+    Local store for large BatchElement fields (PIL images and numpy arrays) on top of multiprocessing.shared_memory.
+    When a blob store is set (see cheese.codec.set_blob_store), codecs write large fields to it once and only send a handle.
+    Objects rebuilt from a handle remember it, so sending them on to the next component does not write them again.
+    So that this needs no pass over their contents, rebuilt arrays are read-only (copy one to change it) and rebuilt
+    images are marked read-only, which PIL answers by copying the image before its first change. Either way the changed
+    object no longer matches the blob, and is written to a new one when sent.
+    Blobs are reference counted and reclaimed once released, which Pipeline does after posting the element holding them.
+
+    :param threshold: Minimum size in bytes for an object to be put in the store
+    :type threshold: int
+
+    :param max_age: If set, blobs created this many seconds ago are reclaimed even if they were never released
+        (i.e. because the element holding them was dropped rather than posted)
+    :type max_age: float
+    """
+    def __init__(self, threshold : int = 65536, max_age : float = None):
+        self.threshold = threshold
+        self.max_age = max_age
+
+        self.blocks : Dict[str, shared_memory.SharedMemory] = {} # Blocks created by this store
+        self.ref_counts : Dict[str, int] = {}
+        self.created : Dict[str, float] = {} # Name of block -> when it was created
+        self.object_handles : Dict[int, BlobHandle] = {} # id of object rebuilt from a blob -> handle for that blob
+
+        # Reentrant, since an object's finalizer can run (and forget its handle) while lock is held on the same thread
+        self.lock = threading.RLock()
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            return {
+                "num_blobs" : len(self.blocks),
+                "total_bytes" : sum(block.size for block in self.blocks.values())
+            }
+
+    def should_store(self, obj : Any) -> bool:
+        """
+        Should this object be put in the store rather than sent as is?
+        """
+        if isinstance(obj, np.ndarray):
+            return obj.nbytes >= self.threshold
+        if isinstance(obj, Image.Image):
+            return obj.width * obj.height * len(obj.getbands()) >= self.threshold
+        return False
+
+    @staticmethod
+    def unchanged(obj : Any) -> bool:
+        """
+        Is an object rebuilt from a blob still the same as the blob? Rebuilt arrays can't be changed in place, and
+        rebuilt images stop being read-only once PIL copies them to make a change.
+        """
+        if isinstance(obj, Image.Image):
+            return bool(obj.readonly)
+        return True
+
+    def handle_of(self, obj : Any) -> Optional[BlobHandle]:
+        """
+        Handle of blob object was read from, if any. If object has been changed since, the blob no longer holds it,
+        so the object's reference to the blob is released and None is returned.
+        """
+        with self.lock:
+            handle = self.object_handles.get(id(obj))
+            if handle is None:
+                return None
+            if self.unchanged(obj):
+                return handle
+            del self.object_handles[id(obj)]
+        self.release(handle)
+        return None
+
+    def remember(self, obj : Any, handle : BlobHandle):
+        """
+        Associate object rebuilt from a blob with its handle for as long as the object is alive and unchanged.
+        """
+        key = id(obj)
+        with self.lock:
+            if key not in self.object_handles:
+                weakref.finalize(obj, self.forget, key)
+            self.object_handles[key] = handle
+
+    def forget(self, key : int):
+        with self.lock:
+            self.object_handles.pop(key, None)
+
+    def put(self, obj : Any) -> BlobHandle:
+        """
+        Write an image or array to shared memory with a reference count of 1.
+        If object was rebuilt from a blob and is unchanged, returns the existing handle instead.
+        """
+        handle = self.handle_of(obj)
+        if handle is not None:
+            return handle
+
+        if isinstance(obj, Image.Image):
+            data = obj.tobytes()
+            handle = BlobHandle(
+                kind = "image", nbytes = len(data),
+                meta = [obj.mode, obj.width, obj.height, obj.getpalette() if obj.mode == "P" else None]
+            )
+        elif isinstance(obj, np.ndarray):
+            data = np.ascontiguousarray(obj).data.cast('B')
+            handle = BlobHandle(kind = "array", nbytes = obj.nbytes, meta = [obj.dtype.str, list(obj.shape)])
+        else:
+            raise Exception(f"Error: Cannot put object of type {type(obj)} in blob store")
+
+        block = shared_memory.SharedMemory(create = True, size = max(handle.nbytes, 1))
+        block.buf[:handle.nbytes] = data
+        handle.name = block.name
+
+        with self.lock:
+            self.blocks[block.name] = block
+            self.ref_counts[block.name] = 1
+            self.created[block.name] = time.time()
+        # Object itself is not remembered, since it may be changed in place without any way to tell
+        if self.max_age is not None:
+            self.reclaim_stale()
+
+        return handle
+
+    def get(self, handle : BlobHandle) -> Any:
+        """
+        Rebuild object from handle. Works from any process on this machine while the blob exists,
+        though processes other than the one that created the blob should be started from it (i.e. worker processes).
+        """
+        with self.lock:
+            block = self.blocks.get(handle.name)
+
+        owned = block is not None
+        if not owned:
+            try:
+                # Only the creating process should unlink the block
+                block = shared_memory.SharedMemory(name = handle.name, track = False)
+            except TypeError:
+                # Before Python 3.13 blocks are always tracked. Processes started from the creating process share its
+                # resource tracker, so this is only a problem for unrelated processes, which may unlink the block on exit
+                block = shared_memory.SharedMemory(name = handle.name)
+
+        try:
+            buf = block.buf[:handle.nbytes]
+            if handle.kind == "image":
+                mode, width, height, palette = handle.meta
+                obj = Image.frombytes(mode, (width, height), buf)
+                if palette is not None: obj.putpalette(palette)
+                obj.readonly = 1 # PIL copies image before changing it, which is how it is told apart from blob
+            else:
+                dtype, shape = handle.meta
+                # Backed by immutable bytes, so it can't be made writable and changed in place
+                obj = np.frombuffer(bytes(buf), dtype = dtype).reshape(shape)
+            del buf
+        finally:
+            if not owned: block.close()
+
+        self.remember(obj, handle)
+        return obj
+
+    def acquire(self, handle : BlobHandle):
+        """
+        Add a reference to a blob (i.e. when it is shared between several elements).
+        """
+        with self.lock:
+            if handle.name in self.ref_counts:
+                self.ref_counts[handle.name] += 1
+
+    def release(self, handle : BlobHandle):
+        """
+        Remove a reference to a blob, reclaiming its memory once there are none left.
+        Does nothing for blobs created by another process.
+        """
+        with self.lock:
+            if handle.name not in self.ref_counts:
+                return
+            self.ref_counts[handle.name] -= 1
+            if self.ref_counts[handle.name] > 0:
+                return
+            del self.ref_counts[handle.name]
+            del self.created[handle.name]
+            block = self.blocks.pop(handle.name)
+
+        block.close()
+        block.unlink()
+
+    def reclaim_stale(self) -> int:
+        """
+        Reclaim blobs older than max_age, whether or not they were released.
+
+        :return: Number of blobs reclaimed
+        :rtype: int
+        """
+        cutoff = time.time() - self.max_age
+        with self.lock:
+            stale = [name for name, created in self.created.items() if created < cutoff]
+            blocks = [self.blocks.pop(name) for name in stale]
+            for name in stale:
+                del self.ref_counts[name]
+                del self.created[name]
+
+        for block in blocks:
+            block.close()
+            block.unlink()
+        if stale:
+            print(f"Warning: Reclaimed {len(stale)} blobs that were not released within {self.max_age}s")
+        return len(stale)
+
+    def release_element(self, obj : Any):
+        """
+        Release every blob referenced by the fields of a BatchElement, including ones nested in lists and dictionaries.
+        """
+        handles = {}
+
+        def visit(value):
+            handle = self.handle_of(value)
+            if handle is not None:
+                handles[handle.name] = handle
+            elif isinstance(value, dict):
+                for v in value.values(): visit(v)
+            elif isinstance(value, (list, tuple)):
+                for v in value: visit(v)
+            elif is_dataclass(value) and not isinstance(value, type):
+                for f in fields(value): visit(getattr(value, f.name))
+
+        visit(obj)
+        for handle in handles.values():
+            self.release(handle)
+
+    def close(self):
+        """
+        Reclaim all blobs regardless of references.
+        """
+        with self.lock:
+            blocks = list(self.blocks.values())
+            self.blocks = {}
+            self.ref_counts = {}
+            self.created = {}
+
+        for block in blocks:
+            block.close()
+            block.unlink()
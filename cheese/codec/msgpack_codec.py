@@ -0,0 +1,119 @@
+from dataclasses import fields
+from typing import Any, List
+
+import struct
+
+import msgpack
+import numpy as np
+from PIL import Image
+
+from cheese.codec import Codec, blob_handle, load_blob
+from cheese.codec.blob_store import BlobHandle
+from cheese.data import ELEMENT_TYPES, element_type_name
+from cheese.tasks import Task
+
+# Extension type codes
+EXT_IMAGE = 1
+EXT_ARRAY = 2
+EXT_TUPLE = 3
+EXT_BLOB = 4
+
+# Frame header: length of packed fields, number of binary buffers
+HEADER = struct.Struct("<II")
+
+class MsgpackCodec(Codec):
+    """
+    Codec that packs the dataclass fields of a BatchElement with msgpack. PIL images and numpy arrays
+    (i.e. audio) anywhere in the fields are sent as raw binary buffers after the packed fields rather than being serialized.
+    If a blob store is set, large images and arrays are put there and only their handles are sent.
+    Only registered BatchElement types and plain data are rebuilt, so unlike pickle decoding cannot run arbitrary code.
+    Receivers only rule pickle out once it is no longer allowed (see cheese.codec.set_allowed_codecs).
+
+    Frame layout is [header][buffer lengths][packed fields][buffer 0][buffer 1]...
+    """
+    name = "msgpack"
+
+    def encode(self, task : Task) -> List[Any]:
+        buffers : List[Any] = []
+
+        def default(obj):
+            handle = blob_handle(obj)
+            if handle is not None:
+                info = [handle.name, handle.kind, handle.nbytes, handle.meta]
+                return msgpack.ExtType(EXT_BLOB, msgpack.packb(info))
+            if isinstance(obj, Image.Image):
+                buffers.append(obj.tobytes())
+                info = [len(buffers) - 1, obj.mode, obj.width, obj.height, obj.getpalette() if obj.mode == "P" else None]
+                return msgpack.ExtType(EXT_IMAGE, msgpack.packb(info))
+            if isinstance(obj, np.ndarray):
+                obj = np.ascontiguousarray(obj)
+                buffers.append(obj.data)
+                info = [len(buffers) - 1, obj.dtype.str, list(obj.shape)]
+                return msgpack.ExtType(EXT_ARRAY, msgpack.packb(info))
+            if isinstance(obj, tuple):
+                return msgpack.ExtType(EXT_TUPLE, msgpack.packb(list(obj), default = default, strict_types = True))
+            if isinstance(obj, np.generic):
+                return obj.item()
+            # Subclasses of basic types (i.e. OrderedDict) are sent as the basic type
+            for base in (dict, list, str, bytes, int, float):
+                if isinstance(obj, base):
+                    return base(obj)
+            raise TypeError(f"Error: Cannot encode object of type {type(obj)} with msgpack codec")
+
+        data = task.data
+        packed = msgpack.packb(
+            [
+                task.client_id, task.terminate, task.waiting, task.fetch_id,
+                None if data is None else element_type_name(type(data)),
+                None if data is None else {f.name : getattr(data, f.name) for f in fields(data)}
+            ],
+            default = default, strict_types = True
+        )
+
+        lengths = struct.pack(f"<{len(buffers)}Q", *[memoryview(buf).nbytes for buf in buffers])
+        return [HEADER.pack(len(packed), len(buffers)), lengths, packed] + buffers
+
+    def decode(self, payload : memoryview) -> Task:
+        packed_len, n_buffers = HEADER.unpack_from(payload, 0)
+        offset = HEADER.size
+        lengths = struct.unpack_from(f"<{n_buffers}Q", payload, offset)
+        offset += 8 * n_buffers
+
+        packed = payload[offset:offset + packed_len]
+        offset += packed_len
+
+        buffers = []
+        for length in lengths:
+            buffers.append(payload[offset:offset + length])
+            offset += length
+
+        def ext_hook(code, data):
+            if code == EXT_IMAGE:
+                idx, mode, width, height, palette = msgpack.unpackb(data)
+                img = Image.frombytes(mode, (width, height), buffers[idx])
+                if palette is not None: img.putpalette(palette)
+                return img
+            if code == EXT_ARRAY:
+                idx, dtype, shape = msgpack.unpackb(data)
+                return np.frombuffer(buffers[idx], dtype = dtype).reshape(shape).copy()
+            if code == EXT_BLOB:
+                return load_blob(BlobHandle(*msgpack.unpackb(data)))
+            if code == EXT_TUPLE:
+                return tuple(msgpack.unpackb(data, ext_hook = ext_hook, strict_map_key = False))
+            return msgpack.ExtType(code, data)
+
+        client_id, terminate, waiting, fetch_id, type_name, values = msgpack.unpackb(
+            packed, ext_hook = ext_hook, strict_map_key = False
+        )
+
+        if type_name is None:
+            return Task(client_id = client_id, terminate = terminate, waiting = waiting, fetch_id = fetch_id)
+        if type_name not in ELEMENT_TYPES:
+            raise Exception(f"Error: Received BatchElement of unknown type {type_name}")
+
+        # Like pickle, rebuild the element without calling its constructor
+        cls = ELEMENT_TYPES[type_name]
+        data = cls.__new__(cls)
+        data.__dict__.update(values)
+
+        return Task(data = data, client_id = client_id, terminate = terminate, waiting = waiting, fetch_id = fetch_id)
@@ -1,4 +1,14 @@
 from dataclasses import dataclass
+from typing import ClassVar, Dict
+
+# All BatchElement types by name, used by codecs to rebuild elements without pickle
+ELEMENT_TYPES : Dict[str, type] = {}
+
+def element_type_name(cls : type) -> str:
+    """
+    Name a BatchElement type is registered under.
+    """
+    return f"{cls.__module__}.{cls.__qualname__}"
 
 @dataclass
 class BatchElement:
@@ -25,7 +35,14 @@ class BatchElement:
 
     :param end_time: Timestamp for when data was sent back to pipeline
     :type end_time: float
+
+    :param codec: Class attribute naming the codec used to send this data between components (see cheese.codec).
+        Defaults to "pickle". Subclasses can set it to "msgpack" (as a plain class attribute, without
+        a type annotation) to have fields encoded individually, with images and arrays sent as raw binary buffers.
+    :type codec: str
     """
+    codec : ClassVar[str] = "pickle"
+
     client_id : int = -1
     trip : int = 0 
     trip_start : str = "client" 
@@ -34,6 +51,10 @@ class BatchElement:
     start_time : float = -1.0
     end_time : float = -1.0
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        ELEMENT_TYPES[element_type_name(cls)] = cls
+
     def early_finish(self):
         """
         Calling this sets trip to trip_max, resulting in data immediately being sent to pipeline.
@@ -48,3 +69,5 @@ class BatchElement:
             return -1.0
 
         return self.end_time - self.start_time
+
+ELEMENT_TYPES[element_type_name(BatchElement)] = BatchElement
@@ -1,56 +1,235 @@
 from abc import abstractmethod
-from typing import Iterable, Any
-
-import pickle
+from typing import Callable, Deque, Dict, Iterable, Any, List, Optional, Tuple
+from collections import deque, OrderedDict
+from dataclasses import fields
 
 from cheese.data import BatchElement
+from cheese.utils.disk_cache import GenerationCache
 from cheese.tasks import Task
+from cheese.codec import encode_task, decode_task
 
-from b_rabbit import BRabbit
+from cheese.transport import Transport
 from cheese.utils.rabbit_utils import rabbitmq_callback
 
+import threading
+import bisect
+import math
+import time
+
+# Upper bounds in milliseconds of buckets for queue wait histogram
+WAIT_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
 class BaseModel:
     """
     BaseModel object handles anything that may require a model for processing data. It can also be used more generally
     just to handle data processing separately from the pipeline and client.
 
+    Tasks are processed on a dedicated worker thread, so new tasks keep being received while the model is busy.
+    The thread is only started once the first task arrives, so models that never receive tasks themselves
+    (i.e. the replicas of a ReplicaModel, which are only given batches to process) do not have one.
+    If processing a batch raises, its tasks are sent on with error set, so nothing waiting on them stalls.
+
     :param batch_size: The maximum number of elements to process at once. If there are not this many elements available,
-        the model will simply process everything that is in the task queue.
+        the model will simply process everything that is in the task queue (after waiting up to max_wait_ms for more).
     :type batch_size: int
+
+    :param max_wait_ms: Longest time in milliseconds the oldest queued task waits for a batch to fill up before
+        whatever is queued is processed. Defaults to 0, so tasks are processed as soon as the model is free.
+        With bucket_key, this also bounds how long any task waits while fuller buckets are processed before its own.
+    :type max_wait_ms: float
+
+    :param bucket_key: If given, tasks are grouped into buckets by this cost (i.e. token count of a prompt), computed
+        from their BatchElement, and batches are only made from a single bucket, so similar sized inputs are batched
+        together. Full buckets are processed first, until the oldest task has waited max_wait_ms, at which point
+        its bucket is processed whether full or not. Should be used with max_wait_ms above 0.
+    :type bucket_key: Callable[[BatchElement], float]
+
+    :param bucket_bounds: Upper bounds of costs in each bucket, in increasing order. Costs above the last bound go in
+        a bucket of their own. Defaults to powers of two.
+    :type bucket_bounds: List[float]
+
+    :param memo_key: If given, results of process are memoized. Called on an incoming BatchElement to get whatever its
+        result depends on (i.e. a tuple or dictionary of its input fields), which is hashed into the key results are
+        stored under. Must be JSON serializable, apart from arrays, images and bytes, which are hashed by their contents.
+        Elements whose result is known skip the model entirely and are sent straight on.
+    :type memo_key: Callable[[BatchElement], Any]
+
+    :param memo_fields: Fields of BatchElement that process sets, which are what gets memoized. Defaults to every field
+        of the BatchElement's class that it doesn't inherit from BatchElement, so set this if clients fill in fields too.
+    :type memo_fields: List[str]
+
+    :param memo_size: Number of results to keep memoized in memory. Least recently used ones are dropped first.
+    :type memo_size: int
+
+    :param memo_path: Directory to also memoize results on disk in, so they are kept across restarts
+    :type memo_path: str
+
+    :param memo_bytes: With memo_path, most bytes of results to keep on disk
+    :type memo_bytes: int
     """
-    def __init__(self, batch_size : int = 1):
+    def __init__(
+        self, batch_size : int = 1, max_wait_ms : float = 0,
+        bucket_key : Callable[[BatchElement], float] = None, bucket_bounds : List[float] = None,
+        memo_key : Callable[[BatchElement], Any] = None, memo_fields : List[str] = None,
+        memo_size : int = 1024, memo_path : str = None, memo_bytes : int = 2 ** 30
+        ):
         self.publisher = None
         self.subscriber = None
 
-        self.task_queue = []
-        self.working = False # Is task loop running?
+        # Tasks waiting to be processed, when they arrived, their bucket and their memo key, oldest first
+        self.task_queue : Deque[Tuple[Task, float, int, Optional[str]]] = deque()
+        self.queue_cond = threading.Condition() # Guards task_queue and wakes worker
+        self.working = False # Is model processing a batch?
 
         self.batch_size = batch_size
+        self.max_wait_ms = max_wait_ms
+
+        self.bucket_key = bucket_key
+        self.bucket_bounds = bucket_bounds
+        self.bucket_counts : Dict[int, int] = {} # Bucket -> number of queued tasks in it
+
+        self.memo_key = memo_key
+        self.memo_fields = memo_fields
+        self.memo_size = memo_size
+        self.memo : OrderedDict[str, Dict[str, Any]] = OrderedDict() # Key -> memoized fields, least recently used first
+        self.memo_disk = GenerationCache(memo_path, memo_bytes) if memo_key is not None and memo_path is not None else None
+        self.memo_lock = threading.Lock()
+        self.memo_hits = 0
+        self.memo_disk_hits = 0
+        self.memo_misses = 0
+
+        self.batch_sizes : Dict[int, int] = {} # Batch size -> number of batches of that size processed
+        self.wait_counts = [0] * (len(WAIT_BUCKETS_MS) + 1) # Tasks by how long they were queued (last bucket is overflow)
+        self.processed = 0
+        self.failed = 0 # Tasks sent on as errors because their batch could not be processed
+
+        self.stop_worker = False
+        self.worker_thread : threading.Thread = None
     
     def get_stats(self) -> dict:
         """
         Get statistics about the model.
+
+        :return: Dictionary containing following statistics:
+            - num_tasks: Number of tasks waiting to be processed
+            - processed: Number of tasks processed overall
+            - failed: Number of tasks sent on as errors because processing their batch raised
+            - batch_sizes: Number of batches processed of each size
+            - queue_wait_ms: Number of tasks by how long they waited in queue, keyed by upper bound in milliseconds
+            - queued_buckets: With bucket_key, number of queued tasks in each bucket
+            - memo: With memo_key, memoization hits (including those from disk), disk hits, misses and hit rate
+        """
+        with self.queue_cond:
+            wait_hist = {f"<={bound}" : cnt for bound, cnt in zip(WAIT_BUCKETS_MS, self.wait_counts)}
+            wait_hist[f">{WAIT_BUCKETS_MS[-1]}"] = self.wait_counts[-1]
+            return {
+                "num_tasks" : len(self.task_queue),
+                "processed" : self.processed,
+                "failed" : self.failed,
+                "batch_sizes" : dict(sorted(self.batch_sizes.items())),
+                "queue_wait_ms" : wait_hist,
+                "queued_buckets" : dict(sorted(self.bucket_counts.items())) if self.bucket_key is not None else None,
+                "memo" : self.memo_stats()
+            }
+
+    def memo_stats(self) -> Dict[str, Any]:
+        if self.memo_key is None:
+            return None
+        with self.memo_lock:
+            lookups = self.memo_hits + self.memo_misses
+            return {
+                "hits" : self.memo_hits,
+                "disk_hits" : self.memo_disk_hits,
+                "misses" : self.memo_misses,
+                "hit_rate" : self.memo_hits / lookups if lookups else 0.0,
+                "size" : len(self.memo)
+            }
+
+    def memo_lookup_key(self, batch_element : BatchElement) -> str:
+        return GenerationCache.make_key(self.memo_key(batch_element))
+
+    def batch_keys(self, tasks : List[Task], keys : List[Optional[str]] = None) -> Optional[List[str]]:
+        """
+        Memo keys for a batch of tasks, reusing those worked out when the tasks arrived and working out any that are
+        missing (raising if that fails). None if results are not memoized.
+        """
+        if self.memo_key is None:
+            return None
+        if keys is None:
+            keys = [None] * len(tasks)
+        return [self.memo_lookup_key(task.data) if key is None else key for key, task in zip(keys, tasks)]
+
+    def output_fields(self, batch_element : BatchElement) -> List[str]:
         """
-        return {"num_tasks": len(self.task_queue)}
+        Fields that are memoized for a BatchElement.
+        """
+        if self.memo_fields is not None:
+            return self.memo_fields
+        base = {f.name for f in fields(BatchElement)}
+        return [f.name for f in fields(batch_element) if f.name not in base]
+
+    def recall(self, key : str, batch_element : BatchElement) -> bool:
+        """
+        If result for key is memoized, set its fields on batch element.
 
-    def init_connection(self, connection : BRabbit):
+        :return: Whether result was memoized
+        :rtype: bool
         """
-        Initialize RabbitMQ connection
+        with self.memo_lock:
+            outputs = self.memo.get(key)
+            if outputs is not None:
+                self.memo.move_to_end(key)
+        if outputs is None and self.memo_disk is not None:
+            outputs = self.memo_disk.get(key)
+            if outputs is not None:
+                with self.memo_lock:
+                    self.memo_disk_hits += 1
+                    self.store_in_memory(key, outputs)
+
+        with self.memo_lock:
+            if outputs is None:
+                self.memo_misses += 1
+                return False
+            self.memo_hits += 1
+        for name, value in outputs.items():
+            setattr(batch_element, name, value)
+        return True
+
+    def remember(self, keys : List[str], tasks : List[Task]):
         """
-        self.publisher = connection.EventPublisher(
-            b_rabbit = connection,
+        Memoize results of processed tasks, given the keys of their inputs.
+        """
+        for key, task in zip(keys, tasks):
+            outputs = {name : getattr(task.data, name) for name in self.output_fields(task.data)}
+            with self.memo_lock:
+                self.store_in_memory(key, outputs)
+            if self.memo_disk is not None:
+                self.memo_disk.put(key, outputs)
+
+    def store_in_memory(self, key : str, outputs : Dict[str, Any]):
+        """
+        Should be called with memo_lock held.
+        """
+        self.memo[key] = outputs
+        self.memo.move_to_end(key)
+        while len(self.memo) > self.memo_size:
+            self.memo.popitem(last = False)
+
+    def init_connection(self, connection : Transport):
+        """
+        Initialize message channels
+        """
+        self.publisher = connection.publisher(
             publisher_name = 'model'
         )
 
-        self.subscriber_client = connection.EventSubscriber(
-            b_rabbit = connection,
+        self.subscriber_client = connection.subscriber(
             routing_key = 'model',
             publisher_name = 'client',
             event_listener = self.dequeue_task
         )
 
-        self.subscriber_pipeline = connection.EventSubscriber(
-            b_rabbit = connection,
+        self.subscriber_pipeline = connection.subscriber(
             routing_key = 'model',
             publisher_name = 'pipeline',
             event_listener = self.dequeue_task
@@ -69,27 +248,175 @@ class BaseModel:
         """
         pass
 
-    def handle_queued_tasks(self):
+    def next_batch(self) -> Tuple[List[Task], List[Optional[str]]]:
         """
-        Handle every task in queue. New tasks can be added to queue if needed. Should not be called again if still running.
+        Take next batch of tasks from queue. Should be called with queue_cond held and tasks in queue.
+
+        :return: Tasks, and their memo keys if they were worked out when they arrived
         """
-        if self.working:
-            raise Exception("Error: Tried to handle model queue twice after already calling method once.")
-        
-        self.working = True
+        now = time.time()
+        tasks, keys = [], []
+        if self.bucket_key is None:
+            while self.task_queue and len(tasks) < self.batch_size:
+                task, arrived, _, key = self.task_queue.popleft()
+                self.record_wait(now - arrived)
+                tasks.append(task)
+                keys.append(key)
+            return tasks, keys
+
+        # Oldest task's bucket once it has waited long enough, otherwise the fullest one
+        bucket = self.task_queue[0][2]
+        if not self.overdue():
+            full = max(self.bucket_counts, key = lambda b: self.bucket_counts[b])
+            if self.bucket_counts[full] >= self.batch_size:
+                bucket = full
 
+        remaining = deque()
         while self.task_queue:
-            tasks = self.task_queue[:self.batch_size]
-            self.task_queue = self.task_queue[self.batch_size:]
+            entry = self.task_queue.popleft()
+            task, arrived, task_bucket, key = entry
+            if task_bucket == bucket and len(tasks) < self.batch_size:
+                self.record_wait(now - arrived)
+                tasks.append(task)
+                keys.append(key)
+            else:
+                remaining.append(entry)
+        self.task_queue = remaining
+
+        self.bucket_counts[bucket] -= len(tasks)
+        if self.bucket_counts[bucket] == 0:
+            del self.bucket_counts[bucket]
+        return tasks, keys
+
+    def bucket_of(self, batch_element : BatchElement) -> int:
+        """
+        Bucket a task goes into, from the cost bucket_key gives its BatchElement.
+        """
+        cost = self.bucket_key(batch_element)
+        if self.bucket_bounds is not None:
+            return bisect.bisect_left(self.bucket_bounds, cost)
+        return math.ceil(math.log2(cost)) if cost > 1 else 0
+
+    def overdue(self) -> bool:
+        """
+        Has the oldest queued task waited max_wait_ms? Should be called with queue_cond held and tasks in queue.
+        """
+        return time.time() - self.task_queue[0][1] >= self.max_wait_ms / 1000
+
+    def record_wait(self, wait : float):
+        """
+        Add time a task spent queued to histogram. Should be called with queue_cond held.
+        """
+        wait_ms = wait * 1000
+        for i, bound in enumerate(WAIT_BUCKETS_MS):
+            if wait_ms <= bound:
+                self.wait_counts[i] += 1
+                return
+        self.wait_counts[-1] += 1
+
+    def batch_ready(self) -> bool:
+        """
+        Should queued tasks be processed now, rather than waiting for more? True once there are enough for a full batch
+        (in a single bucket, with bucket_key), or the oldest has waited max_wait_ms.
+        Should be called with queue_cond held and tasks in queue.
+        """
+        if self.bucket_key is not None:
+            if max(self.bucket_counts.values()) >= self.batch_size:
+                return True
+        elif len(self.task_queue) >= self.batch_size:
+            return True
+        return self.overdue()
+
+    def batch_wait_time(self) -> float:
+        """
+        Seconds until batch_ready may become true without any new tasks arriving.
+        Should be called with queue_cond held and tasks in queue.
+        """
+        return self.task_queue[0][1] + self.max_wait_ms / 1000 - time.time()
+
+    def worker_loop(self):
+        """
+        Worker thread. Waits until a batch is ready, then processes it and sends its tasks on.
+        """
+        while True:
+            with self.queue_cond:
+                while True:
+                    if self.stop_worker:
+                        return
+                    if self.task_queue and self.batch_ready():
+                        break
+                    self.queue_cond.wait(timeout = self.batch_wait_time() if self.task_queue else None)
+                tasks, keys = self.next_batch()
+
+            try:
+                self.handle_batch(tasks, keys)
+            except Exception as e:
+                print(f"Warning: Exception while sending on batch of {len(tasks)} tasks: {repr(e)}")
+
+    def handle_batch(self, tasks : List[Task], keys : List[Optional[str]] = None):
+        """
+        Process a batch of tasks with the model and send them on.
+
+        :param keys: Memo keys of tasks, if they are already known. Any that are missing are worked out.
+        """
+        try:
+            keys = self.batch_keys(tasks, keys)
+
+            self.working = True
+            try:
+                data_list = list(self.process([task.data for task in tasks]))
+            finally:
+                self.working = False
+            if len(data_list) != len(tasks):
+                raise Exception(f"Error: Model returned {len(data_list)} elements for batch of {len(tasks)}")
+        except Exception as e:
+            self.fail_batch(tasks, e)
+            return
+
+        for i, data in enumerate(data_list):
+            tasks[i].data = data
+        if keys is not None:
+            self.remember(keys, tasks)
+
+        with self.queue_cond:
+            self.batch_sizes[len(tasks)] = self.batch_sizes.get(len(tasks), 0) + 1
+            self.processed += len(tasks)
 
-            data_list = self.process([task.data for task in tasks])
-            for i, data in enumerate(data_list):
-                tasks[i].data = data
-            
-            while tasks:
-                self.queue_task(tasks.pop(0))
+        for task in tasks:
+            self.queue_task(task)
 
-        self.working = False
+    def fail_batch(self, tasks : List[Task], error : Exception):
+        """
+        Send on tasks of a batch that could not be processed, with error set, so the client or pipeline waiting on
+        them can handle them instead of waiting forever.
+        """
+        print(f"Warning: Exception while processing batch of {len(tasks)} tasks, sending them on as errors: {repr(error)}")
+        with self.queue_cond:
+            self.failed += len(tasks)
+        for task in tasks:
+            task.data.error = True
+            self.queue_task(task)
+
+    def handle_queued_tasks(self):
+        """
+        Handle every task in queue right away on the calling thread, without waiting for batches to fill up.
+        """
+        while True:
+            with self.queue_cond:
+                if not self.task_queue:
+                    return
+                tasks, keys = self.next_batch()
+            self.handle_batch(tasks, keys)
+
+    def close(self):
+        """
+        Stop worker once it finishes any batch it is processing. Tasks still queued are not processed.
+        """
+        with self.queue_cond:
+            self.stop_worker = True
+            self.queue_cond.notify_all()
+        if self.worker_thread is not None:
+            self.worker_thread.join()
 
     def queue_task(self, task : Task):
         """
@@ -104,7 +431,7 @@ class BaseModel:
         else:
             route = 'active'
 
-        tasks = pickle.dumps(task)
+        tasks = encode_task(task)
         
         self.publisher.publish(
             routing_key = route,
@@ -115,11 +442,31 @@ class BaseModel:
     def dequeue_task(self, tasks : str):
         """Check inbound queue for completed task."""
         
-        task = pickle.loads(tasks)
+        task = decode_task(tasks)
         task.data.trip += 1
 
-        self.task_queue.append(task)
+        key = None
+        if self.memo_key is not None:
+            try:
+                key = self.memo_lookup_key(task.data)
+                known = self.recall(key, task.data)
+            except Exception as e:
+                # Batch it anyway, so it is sent on as an error rather than dropped here
+                print(f"Warning: Could not look up memoized result: {repr(e)}")
+                known = False
+            if known:
+                # Result is already known, so model is skipped
+                self.queue_task(task)
+                return
 
-        if not self.working:
-            self.handle_queued_tasks()
+        bucket = self.bucket_of(task.data) if self.bucket_key is not None else 0
+        with self.queue_cond:
+            # Key is kept with task so it is not worked out again when the result is memoized
+            self.task_queue.append((task, time.time(), bucket, key))
+            if self.worker_thread is None and not self.stop_worker:
+                self.worker_thread = threading.Thread(target = self.worker_loop, daemon = True)
+                self.worker_thread.start()
+            if self.bucket_key is not None:
+                self.bucket_counts[bucket] = self.bucket_counts.get(bucket, 0) + 1
+            self.queue_cond.notify()
     
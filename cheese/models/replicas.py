@@ -0,0 +1,153 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from cheese.models import BaseModel
+from cheese.data import BatchElement
+from cheese.tasks import Task
+
+import multiprocessing
+import threading
+import time
+import os
+
+replica_model : BaseModel = None # Model hosted by a replica process
+
+# Keyword arguments of BaseModel handled by ReplicaModel, which are kept from replicas. Besides not being needed there,
+# they may not be picklable (i.e. lambdas for bucket_key or memo_key), and memo_path would have every replica open the cache.
+BATCHING_KWARGS = [
+    "batch_size", "max_wait_ms", "bucket_key", "bucket_bounds",
+    "memo_key", "memo_fields", "memo_size", "memo_path", "memo_bytes"
+]
+
+def init_replica(model_cls : Callable[..., BaseModel], model_kwargs : Dict[str, Any]):
+    global replica_model
+    replica_model = model_cls(**model_kwargs)
+
+def run_replica(data : List[BatchElement]) -> Tuple[int, List[BatchElement], float]:
+    """
+    Process a batch on the model hosted by this replica.
+
+    :return: Process ID of replica, processed batch, and seconds spent processing it
+    """
+    start = time.time()
+    res = list(replica_model.process(data))
+    return os.getpid(), res, time.time() - start
+
+class ReplicaModel(BaseModel):
+    """
+    Runs several replicas of a model, each in its own worker process hosting its own instance of the model.
+    Tasks are received and batched in this process as with any BaseModel. Batches are put on a shared queue that
+    replicas take from whenever they are free, and processed tasks are sent on from this process as usual
+    (to the client working on them via the 'active' route, or to the pipeline once their trip is done).
+    CHEESE creates one when given model_replicas.
+
+    :param model_cls: Class for model. Must be importable by the worker processes, which are spawned.
+    :type model_cls: Callable[, BaseModel]
+
+    :param model_kwargs: Keyword arguments for model constructor. Batching and memoization settings (see BATCHING_KWARGS)
+        are taken from these and handled in this process, and replicas are constructed with the rest, which must be picklable.
+    :type model_kwargs: Dict[str, Any]
+
+    :param replicas: Number of worker processes
+    :type replicas: int
+    """
+    def __init__(self, model_cls : Callable[..., BaseModel], model_kwargs : Dict[str, Any] = {}, replicas : int = 2):
+        super().__init__(**{name : value for name, value in model_kwargs.items() if name in BATCHING_KWARGS})
+        replica_kwargs = {name : value for name, value in model_kwargs.items() if name not in BATCHING_KWARGS}
+
+        self.replicas = replicas
+        self.executor = ProcessPoolExecutor(
+            max_workers = replicas,
+            mp_context = multiprocessing.get_context("spawn"),
+            initializer = init_replica,
+            initargs = (model_cls, replica_kwargs)
+        )
+        # Batches are only handed out when a replica is free, so the rest keep batching up in the task queue
+        self.free_replicas = threading.Semaphore(replicas)
+        self.publish_lock = threading.Lock() # Tasks are sent on from the threads collecting results
+
+        self.replica_stats : Dict[int, Dict[str, Any]] = {} # Process ID of replica -> its statistics
+
+    def process(self, data : List[BatchElement]) -> List[BatchElement]:
+        """
+        Process a batch on whichever replica is free, waiting for it to be done.
+        """
+        return self.collect(self.executor.submit(run_replica, data))
+
+    def collect(self, future : Future) -> List[BatchElement]:
+        """
+        Get result of a batch from a replica, recording its statistics.
+        """
+        pid, res, elapsed = future.result()
+        with self.queue_cond:
+            stats = self.replica_stats.setdefault(pid, {"processed" : 0, "batches" : 0, "busy_time" : 0.0})
+            stats["processed"] += len(res)
+            stats["batches"] += 1
+            stats["busy_time"] += elapsed
+        return res
+
+    def handle_batch(self, tasks : List[Task], keys : List[Optional[str]] = None):
+        """
+        Hand batch to a free replica, waiting for one to be free if needed. Its tasks are sent on once it is done.
+        """
+        try:
+            keys = self.batch_keys(tasks, keys)
+        except Exception as e:
+            self.fail_batch(tasks, e)
+            return
+
+        self.free_replicas.acquire()
+        try:
+            future = self.executor.submit(run_replica, [task.data for task in tasks])
+        except Exception as e:
+            # i.e. a replica died, breaking the pool
+            self.free_replicas.release()
+            self.fail_batch(tasks, e)
+            return
+        future.add_done_callback(lambda future: self.batch_done(tasks, keys, future))
+
+    def batch_done(self, tasks : List[Task], keys : List[str], future : Future):
+        try:
+            try:
+                data_list = self.collect(future)
+                if len(data_list) != len(tasks):
+                    raise Exception(f"Error: Model returned {len(data_list)} elements for batch of {len(tasks)}")
+            except Exception as e:
+                self.fail_batch(tasks, e)
+                return
+
+            for i, data in enumerate(data_list):
+                tasks[i].data = data
+            if keys is not None:
+                self.remember(keys, tasks)
+
+            with self.queue_cond:
+                self.batch_sizes[len(tasks)] = self.batch_sizes.get(len(tasks), 0) + 1
+                self.processed += len(tasks)
+
+            for task in tasks:
+                self.queue_task(task)
+        except Exception as e:
+            print(f"Warning: Exception while sending on batch of {len(tasks)} tasks from replica: {repr(e)}")
+        finally:
+            self.free_replicas.release()
+
+    def queue_task(self, task : Task):
+        with self.publish_lock:
+            super().queue_task(task)
+
+    def get_stats(self) -> dict:
+        """
+        Get statistics about the model, including those of each replica under "replicas", keyed by its process ID.
+        """
+        stats = super().get_stats()
+        with self.queue_cond:
+            stats["replicas"] = {pid : dict(replica) for pid, replica in self.replica_stats.items()}
+        return stats
+
+    def close(self):
+        """
+        Stop batching, wait for batches on replicas to finish, then shut replicas down.
+        """
+        super().close()
+        self.executor.shutdown(wait = True)
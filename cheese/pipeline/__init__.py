@@ -1,41 +1,104 @@
 from abc import abstractmethod
-from typing import List, Dict
-import pickle
+from typing import Any, List, Dict
 
 from pyparsing import ParseExpression
 from cheese.data import BatchElement
 from cheese.tasks import Task
+from cheese.codec import encode_task, decode_task, release_blobs
 
-from b_rabbit import BRabbit
+from cheese.transport import Transport
 from cheese.utils.rabbit_utils import rabbitmq_callback
 
+import threading
+import atexit
+import queue
+import time
+
 class Pipeline:
     """
     Abstract base class for a data pipeline. Processes data by fetching from source of data
     and posting to destination of data
+
+    :param write_behind: If true, completed elements are posted by a dedicated writer thread instead of the thread
+        receiving them, and are committed (see Pipeline.commit) in groups rather than one at a time. Elements whose post
+        raises are kept and retried with later groups, and the error is raised by the next flush or close.
+    :type write_behind: bool
+
+    :param flush_interval: With write_behind, longest time in seconds an element waits before its group is committed
+    :type flush_interval: float
+
+    :param flush_size: With write_behind, most elements to post before committing
+    :type flush_size: int
+
+    :param max_pending: With write_behind, most elements that can wait to be posted. Once this many are waiting,
+        receiving more completed elements blocks until the writer catches up.
+    :type max_pending: int
+
+    :param prefetch: If above 0, a background thread keeps up to this many fetched elements ready to be queued,
+        so slow fetches don't hold up clients waiting for tasks. Elements are fetched in order, and fetching stops
+        while pipeline is exhausted. Hits, misses and fetch times are reported in prefetch_stats.
+    :type prefetch: int
+
+    :param prefetch_low: With prefetch, number of ready elements at or below which fetching starts again,
+        after having filled up to prefetch. Defaults to half of prefetch.
+    :type prefetch_low: int
     """
-    def __init__(self):
+    def __init__(
+        self, write_behind : bool = False,
+        flush_interval : float = 0.2, flush_size : int = 500, max_pending : int = 2000,
+        prefetch : int = 0, prefetch_low : int = None
+        ):
         self.publisher = None
         self.subscriber = None
 
-    def init_connection(self, connection : BRabbit):
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.write_queue : queue.Queue = None
+        self.writer_thread : threading.Thread = None
+        self.failed_posts : List[BatchElement] = [] # Elements writer could not post yet, retried with the next group
+        self.write_error : Exception = None # Last error writer hit, until a group is written without any
+        self.closed = False
+        self.exit_registered = False
+        # Fetch IDs of elements on this side, by id() of element. They travel with the element's task, not the element
+        self.fetch_ids : Dict[int, int] = {}
+
+        if self.write_behind:
+            self.write_queue = queue.Queue(maxsize = max_pending)
+            self.writer_thread = threading.Thread(target = self.write_loop, daemon = True)
+            self.writer_thread.start()
+            self.close_on_exit()
+
+        self.prefetch = prefetch
+        self.prefetch_low = prefetch // 2 if prefetch_low is None else prefetch_low
+        self.ready : List[BatchElement] = [] # Prefetched elements, in the order they were fetched
+        self.fetch_lock = threading.Lock() # Held while fetching, so elements are fetched one at a time and in order
+        self.prefetch_cond = threading.Condition() # Guards ready and wakes prefetch thread
+        self.prefetch_thread : threading.Thread = None
+        self.prefetch_stop = False
+        self.prefetch_error : Exception = None
+
+        self.prefetch_hits = 0 # Elements that were ready when queued
+        self.prefetch_misses = 0 # Elements that had to be fetched when queued
+        self.fetch_count = 0
+        self.fetch_time = 0.0 # Total time spent fetching
+        self.wait_time = 0.0 # Total time queue_task spent getting elements
+
+    def init_connection(self, connection : Transport):
         """
-        Initialize RabbitMQ connection
+        Initialize message channels
         """
-        self.publisher = connection.EventPublisher(
-            b_rabbit = connection,
+        self.publisher = connection.publisher(
             publisher_name = 'pipeline'
         )
 
-        self.subscriber = connection.EventSubscriber(
-            b_rabbit = connection,
+        self.subscriber = connection.subscriber(
             routing_key = 'pipeline',
             publisher_name = 'client',
             event_listener = self.dequeue_task
         )
 
-        self.model_subscriber = connection.EventSubscriber(
-            b_rabbit = connection,
+        self.model_subscriber = connection.subscriber(
             routing_key = 'pipeline',
             publisher_name = 'model',
             event_listener = self.dequeue_task
@@ -72,6 +135,143 @@ class Pipeline:
         """
         pass
 
+    def observe_consumption(self, rate : float):
+        """
+        Called by CHEESE with the estimated number of tasks per second clients are completing, i.e. so pipelines
+        can size buffers to match. Only called for pipelines that override it, at most every
+        CHEESE.CONSUMPTION_INTERVAL seconds. Does nothing by default.
+        """
+        pass
+
+    def set_fetch_id(self, batch_element : BatchElement, fetch_id : int):
+        """
+        Tag element with an ID, i.e. so pipelines that log their progress can tell which fetched element is posted.
+        The ID is sent with the element's task and given back to the element when it returns to be posted.
+        """
+        self.fetch_ids[id(batch_element)] = fetch_id
+
+    def get_fetch_id(self, batch_element : BatchElement) -> int:
+        """
+        ID element was tagged with by set_fetch_id, or -1 if it was not.
+        """
+        return self.fetch_ids.get(id(batch_element), -1)
+
+    def pop_fetch_id(self, batch_element : BatchElement) -> int:
+        """
+        Like get_fetch_id, but forgets the ID, i.e. once element is sent off or posted.
+        """
+        return self.fetch_ids.pop(id(batch_element), -1)
+
+    def fetch_element(self) -> BatchElement:
+        """
+        Get next element to queue. Calls fetch by default, but pipelines can override this to keep track of what they fetch.
+        """
+        return self.fetch()
+
+    def timed_fetch(self) -> BatchElement:
+        """
+        Fetch an element, keeping track of time spent fetching. Should be called with fetch_lock held.
+        """
+        start = time.time()
+        batch_element = self.fetch_element()
+        self.fetch_time += time.time() - start
+        self.fetch_count += 1
+        return batch_element
+
+    def prefetch_loop(self):
+        """
+        Prefetch thread. Fills ready up to prefetch elements, then waits until it drains to prefetch_low.
+        """
+        while True:
+            with self.prefetch_cond:
+                self.prefetch_cond.wait_for(lambda: self.prefetch_stop or len(self.ready) <= self.prefetch_low)
+                if self.prefetch_stop:
+                    return
+
+            while True:
+                with self.fetch_lock:
+                    with self.prefetch_cond:
+                        if self.prefetch_stop or len(self.ready) >= self.prefetch:
+                            break
+                    if self.exhausted():
+                        break
+                    try:
+                        batch_element = self.timed_fetch()
+                    except Exception as e:
+                        print(f"Warning: Exception while prefetching element: {repr(e)}")
+                        self.prefetch_error = e
+                        return
+                    with self.prefetch_cond:
+                        self.ready.append(batch_element)
+
+            if self.exhausted():
+                # Check again in a while, in case pipeline gets more data
+                with self.prefetch_cond:
+                    self.prefetch_cond.wait(timeout = 1.0)
+
+    def next_element(self) -> BatchElement:
+        """
+        Get next element to queue, taking it from prefetched elements if there are any. Returns None if pipeline is exhausted.
+        """
+        start = time.time()
+        if self.prefetch > 0 and self.prefetch_thread is None:
+            # Started on first use rather than in init, so subclass is fully set up
+            self.prefetch_thread = threading.Thread(target = self.prefetch_loop, daemon = True)
+            self.prefetch_thread.start()
+
+        batch_element = self.pop_ready()
+        if batch_element is not None:
+            self.prefetch_hits += 1
+        else:
+            if self.prefetch_error is not None:
+                raise self.prefetch_error
+
+            with self.fetch_lock:
+                # Prefetch thread may have finished an element while we waited for it
+                batch_element = self.pop_ready()
+                if batch_element is None:
+                    if self.exhausted():
+                        return None
+                    batch_element = self.timed_fetch()
+                    if self.prefetch > 0:
+                        self.prefetch_misses += 1
+                else:
+                    self.prefetch_hits += 1
+
+        self.wait_time += time.time() - start
+        return batch_element
+
+    def pop_ready(self) -> BatchElement:
+        with self.prefetch_cond:
+            if not self.ready:
+                return None
+            batch_element = self.ready.pop(0)
+            self.prefetch_cond.notify_all()
+            return batch_element
+
+    def prefetch_stats(self) -> Dict[str, Any]:
+        """
+        Statistics about prefetching, or None if it is not used.
+
+        :return: Dictionary containing following statistics:
+            - ready: Number of elements fetched and ready to be queued
+            - hits: Number of elements that were ready when they were queued
+            - misses: Number of elements that had to be fetched when they were queued
+            - avg_fetch_time: Average time in seconds taken to fetch an element
+            - avg_wait_time: Average time in seconds spent getting an element to queue
+        """
+        if self.prefetch <= 0:
+            return None
+
+        queued = self.prefetch_hits + self.prefetch_misses
+        return {
+            "ready" : len(self.ready),
+            "hits" : self.prefetch_hits,
+            "misses" : self.prefetch_misses,
+            "avg_fetch_time" : self.fetch_time / self.fetch_count if self.fetch_count else 0.0,
+            "avg_wait_time" : self.wait_time / queued if queued else 0.0
+        }
+
     def queue_task(self) -> bool:
         """
         Creates a task and queue to client.
@@ -80,16 +280,15 @@ class Pipeline:
         :rtype: bool
         """
         
-        if self.exhausted():
+        batch_element = self.next_element()
+        if batch_element is None:
             return False
-        
-        batch_element = self.fetch()
 
-        task = Task(batch_element)
+        task = Task(batch_element, fetch_id = self.pop_fetch_id(batch_element))
 
         route = 'client' if batch_element.trip_start == "client" else 'model'
 
-        tasks = pickle.dumps(task)
+        tasks = encode_task(task)
 
         self.publisher.publish(
             routing_key = route,
@@ -98,13 +297,155 @@ class Pipeline:
 
         return True
 
+    def commit(self):
+        """
+        Make everything posted so far durable (i.e. save result dataset). With write_behind, this is called once after
+        each group of posts. Default does nothing.
+        """
+        pass
+
+    def flush(self):
+        """
+        Post and commit everything received so far. With write_behind, waits for the writer to get through every element
+        it has been given, then raises if any of them could not be posted (they are still retried) or committing failed.
+        """
+        if self.writer_thread is None:
+            self.commit()
+            return
+
+        done = threading.Event()
+        self.write_queue.put(done)
+        done.wait()
+        self.raise_write_error()
+
+    def raise_write_error(self):
+        error = self.write_error
+        if error is not None:
+            raise Exception(
+                f"Error: Writer failed, with {len(self.failed_posts)} elements still to be posted: {repr(error)}"
+            ) from error
+
+    def close(self):
+        """
+        Stop prefetching, then post and commit any elements still waiting on the writer and stop it.
+        Raises if any elements could not be posted, in which case they are left in failed_posts.
+        Does nothing if pipeline is already closed.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.exit_registered:
+            atexit.unregister(self.close_at_exit)
+            self.exit_registered = False
+
+        if self.prefetch_thread is not None:
+            with self.prefetch_cond:
+                self.prefetch_stop = True
+                self.prefetch_cond.notify_all()
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
+
+        if self.writer_thread is None:
+            return
+
+        self.write_queue.put(None)
+        self.writer_thread.join()
+        self.writer_thread = None
+        self.raise_write_error()
+
+    def close_on_exit(self):
+        """
+        Make sure pipeline is closed when the program exits, if it is not closed before. Subclasses call this once
+        they hold something that would be lost otherwise, i.e. elements waiting on the writer or an open log.
+        """
+        if not (self.closed or self.exit_registered):
+            atexit.register(self.close_at_exit)
+            self.exit_registered = True
+
+    def close_at_exit(self):
+        try:
+            self.close()
+        except Exception as e:
+            print(f"Warning: Could not close pipeline on exit ({e}). Call close() before exiting.")
+
+    def post_element(self, batch_element : BatchElement):
+        """
+        Post element, then reclaim any large fields it kept in shared memory now that it has been consumed.
+        If post raises, they are kept so element can be posted again.
+        """
+        self.post(batch_element)
+        release_blobs(batch_element)
+
+    def write_loop(self):
+        """
+        Writer thread for write_behind. Posts elements as they arrive and commits them in groups, once flush_size
+        have been posted or flush_interval has passed since the first of them arrived. A group is also written
+        straight away when flush is called, and after flush_interval if elements are waiting to be retried.
+        """
+        stopping = False
+        while not stopping:
+            group : List[BatchElement] = []
+            flushes : List[threading.Event] = []
+            deadline = None
+            while len(group) < self.flush_size:
+                if deadline is None:
+                    timeout = self.flush_interval if self.failed_posts else None
+                else:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                try:
+                    item = self.write_queue.get(timeout = timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                if isinstance(item, threading.Event):
+                    flushes.append(item)
+                    break
+                group.append(item)
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+
+            self.write_group(group)
+            for done in flushes:
+                done.set()
+
+    def write_group(self, group : List[BatchElement]):
+        """
+        Post elements that failed to post before, then group, then commit. Elements whose post raises are kept to retry.
+        """
+        retries, self.failed_posts = self.failed_posts, []
+        error = None
+        for batch_element in retries + group:
+            try:
+                self.post_element(batch_element)
+            except Exception as e:
+                print(f"Warning: Exception while posting element, it will be retried: {repr(e)}")
+                self.failed_posts.append(batch_element)
+                error = e
+
+        try:
+            self.commit()
+        except Exception as e:
+            print(f"Warning: Exception while committing posted elements: {repr(e)}")
+            error = e
+        self.write_error = error
+
     @rabbitmq_callback
     def dequeue_task(self, tasks : str):
         """
         Dequeue a task that has been sent to the pipeline, extract the data inside and post
         to data destination.
         """
-        task = pickle.loads(tasks)
+        task = decode_task(tasks)
         batch_element = task.data
+        if task.fetch_id >= 0:
+            self.set_fetch_id(batch_element, task.fetch_id)
 
-        self.post(batch_element)
+        if self.write_queue is not None:
+            # Blocks if writer has fallen behind, which holds back further messages
+            self.write_queue.put(batch_element)
+        else:
+            self.post_element(batch_element)
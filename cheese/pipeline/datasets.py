@@ -1,36 +1,92 @@
 from abc import abstractmethod
-from typing import Iterable, Dict, Any
+from typing import Iterable, Dict, Any, List
 
-from datasets import Dataset
+from datasets import Dataset, concatenate_datasets
 
 from cheese.pipeline import Pipeline
+from cheese.pipeline.wal import PipelineLog, replace_path
+from cheese.data import BatchElement
 from cheese.utils import safe_mkdir
 
 import pandas as pd
+import threading
+import shutil
+import json
+import os
 
 class DatasetPipeline(Pipeline):
     """
     Base class for any pipeline thats data destination is a datasets.Dataset object
-    
-    :param format: Format to save result dataset to. Defaults to arrow. Can be arrow or csv.
+
+    :param format: Format to save result dataset to. Defaults to csv. Can be arrow, csv or parquet.
     :type format: str
 
-    :param save_every: Save dataset whenever this number of rows is added.
+    :param save_every: Save dataset whenever this number of rows is added. With write_behind, dataset is instead saved
+        once per group of posts. Saving is atomic, the dataset is written beside the write path then moved into place.
     :type save_every: int
+
+    :param log_results: If true, each row is appended to a JSON lines log beside the write path instead of rewriting
+        the whole result dataset. Saving then only flushes the log, and the log is compacted into the result dataset
+        every compact_every rows and when the pipeline is closed (at the latest, on exit). Resuming reads the log back.
+    :type log_results: bool
+
+    :param compact_every: With log_results, compact log into result dataset whenever this many rows are in it.
+        If None, only compacts when pipeline is closed.
+    :type compact_every: int
+
+    :param checkpoint_every: For pipelines that log their progress (see start_progress_log), snapshot their state
+        whenever this many events have been logged since the last snapshot.
+    :type checkpoint_every: int
+
+    :param kwargs: Keyword arguments for Pipeline (i.e. write_behind)
     """
-    def __init__(self, format : str = "csv", save_every  : int = 1):
-        super().__init__()
+    def __init__(
+        self, format : str = "csv", save_every  : int = 1,
+        log_results : bool = False, compact_every : int = None,
+        checkpoint_every : int = 1000, **kwargs
+        ):
+        super().__init__(**kwargs)
 
         self.write_path : str = None
         self.res_dataset : Dataset = None
         self.format = format
-        
+
         self.save_every = save_every
         self.save_accum = 0
+        self.checkpoint_due = False # Set when rows are saved while posting, so progress is checkpointed once it is logged
+
+        self.log_results = log_results
+        self.compact_every = compact_every
+        self.log_file = None
+        self.log_rows : List[Dict[str, Any]] = [] # Rows in log that are not in res_dataset yet
+        self.log_lock = threading.RLock()
+        self.resumed = False # Set once a previous result dataset or log has been loaded
+        self.log_damaged = False # Set if last line of log was cut off
+
+        self.checkpoint_every = checkpoint_every
+        self.progress_log : PipelineLog = None
+        self.state_lock = threading.RLock() # Held while posting or changing progress, so snapshots are consistent
+
+        if self.save_every > 1:
+            # Rows added since the last save would be lost
+            self.close_on_exit()
+
+    def log_path(self) -> str:
+        """
+        Path of the result log, next to the write path.
+        """
+        return self.write_path.rstrip("/\\") + ".log.jsonl"
+
+    def num_rows(self) -> int:
+        """
+        Number of rows in result dataset, including any only in the log so far.
+        """
+        return (0 if self.res_dataset is None else len(self.res_dataset)) + len(self.log_rows)
 
     def load_dataset(self) -> bool:
         """
         Loads the results dataset from a given path. Returns false if load fails. Assumes write_path has been set already.
+        With log_results, also reads back rows from the log that were not yet compacted into the dataset.
 
         :return: Whether load was successful
         :rtype: bool
@@ -40,48 +96,329 @@ class DatasetPipeline(Pipeline):
             raise Exception("Error: Attempted to load results dataset without ever specifiying a path to write it to")
 
         try:
-            if self.format == "arrow":
-                self.res_dataset = Dataset.load_from_disk(self.write_path)
-            elif self.format == "csv":
-                self.res_dataset = pd.read_csv(self.write_path)
-            return True
+            if not self.log_results or os.path.exists(self.write_path):
+                self.res_dataset = self.read_dataset()
+            if self.log_results and not self.read_log() and self.res_dataset is None:
+                return False
         except:
             return False
 
+        self.resumed = True
+        return True
+
+    def read_dataset(self) -> Any:
+        """
+        Read result dataset at write path in its final format.
+        """
+        if self.format == "arrow":
+            return Dataset.load_from_disk(self.write_path)
+        elif self.format == "csv":
+            return pd.read_csv(self.write_path)
+        elif self.format == "parquet":
+            return pd.read_parquet(self.write_path)
+        raise Exception(f"Error: Unknown result dataset format {self.format}")
+
+    def read_log(self) -> bool:
+        """
+        Read rows from the log that are not yet in res_dataset into log_rows.
+        The first line of the log records how many rows the dataset had when the log was started,
+        so rows that were compacted just before a crash are not added twice.
+
+        :return: Whether there was a log to read
+        :rtype: bool
+        """
+        if not os.path.exists(self.log_path()):
+            return False
+
+        with open(self.log_path(), "r") as f:
+            lines = f.read().splitlines()
+
+        records = []
+        for i, line in enumerate(lines):
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                if i < len(lines) - 1:
+                    raise
+                # Last write was cut off, rewrite log without it once it is reopened
+                self.log_damaged = True
+
+        if not records:
+            return True
+
+        base = records[0]["base"]
+        skip = (0 if self.res_dataset is None else len(self.res_dataset)) - base
+        self.log_rows = records[1:][max(skip, 0):]
+        return True
+
+    def open_log(self, rewrite : bool = False):
+        """
+        Open log for appending rows. When starting fresh (or when rewrite is set), the log is rewritten from the
+        rows that have not been compacted yet.
+        """
+        if self.log_file is not None:
+            self.log_file.close()
+        self.close_on_exit()
+
+        if self.resumed and not (rewrite or self.log_damaged):
+            self.log_file = open(self.log_path(), "a")
+            return
+
+        if not self.resumed and self.res_dataset is None:
+            # Starting a new dataset, so results from an older run must not be mixed with this log
+            self.remove_dataset()
+
+        self.log_file = open(self.log_path(), "w")
+        self.log_file.write(json.dumps({"base" : 0 if self.res_dataset is None else len(self.res_dataset)}) + "\n")
+        for row in self.log_rows:
+            self.log_file.write(json.dumps(row) + "\n")
+        self.log_file.flush()
+        self.resumed = True
+        self.log_damaged = False
+
+    def remove_dataset(self):
+        """
+        Remove any result dataset left at write path.
+        """
+        if os.path.isdir(self.write_path):
+            shutil.rmtree(self.write_path)
+        elif os.path.exists(self.write_path):
+            os.remove(self.write_path)
+
+    def write_dataset(self):
+        """
+        Write the whole result dataset to the write path in its final format.
+        """
+        # Written beside write path and then moved into place, so a crash never leaves a partially written dataset
+        # (and for arrow, because dataset may be memory mapped from write path)
+        tmp_path = self.write_path.rstrip("/\\") + ".tmp"
+        if self.format == "arrow":
+            self.res_dataset.save_to_disk(tmp_path)
+        elif self.format == "csv":
+            self.res_dataset.to_csv(tmp_path, index = False)
+        elif self.format == "parquet":
+            self.res_dataset.to_parquet(tmp_path, index = False)
+        replace_path(tmp_path, self.write_path)
+
+        if self.format == "arrow":
+            self.res_dataset = Dataset.load_from_disk(self.write_path)
+
     def save_dataset(self):
         """
         Saves the result dataset to the write path (assuming it has been specified by subclass).
-        Does nothing if there is no data to save yet.
+        Does nothing if there is no data to save yet. With log_results, only flushes the log.
         """
+        if self.log_results:
+            with self.log_lock:
+                if self.log_file is not None:
+                    self.log_file.flush()
+            return
+
         if self.res_dataset is None:
             return
         if self.write_path is None:
             raise Exception("Error: Attempted to save result dataset without ever specifiying a path to write to")
 
-        if self.format == "arrow":
-            self.res_dataset.save_to_disk(self.write_path)
-        elif self.format == "csv":
-            self.res_dataset.to_csv(self.write_path, index = False)
+        self.write_dataset()
+
+    def compact(self):
+        """
+        Merge rows from the log into the result dataset, write it in its final format and start a new log.
+        """
+        with self.log_lock:
+            if not self.log_rows:
+                return
+
+            if self.format == "arrow":
+                new_rows = Dataset.from_list(self.log_rows)
+                self.res_dataset = new_rows if self.res_dataset is None else \
+                    concatenate_datasets([self.res_dataset, new_rows])
+            else:
+                new_df = pd.DataFrame(self.log_rows)
+                self.res_dataset = new_df if self.res_dataset is None else \
+                    pd.concat([self.res_dataset, new_df], ignore_index = True)
+            self.log_rows = []
+
+            self.write_dataset()
+            self.open_log(rewrite = True)
+
+    def start_progress_log(self, resume : bool) -> bool:
+        """
+        Start logging progress of pipeline to a write-ahead log beside the write path. Subclasses that use this should log
+        events with log_event and implement checkpoint_state, restore_state and replay_event. Result dataset should be loaded
+        before resuming, since posts whose rows did not make it into the dataset are not replayed, so they are labelled again.
+
+        :param resume: Whether to restore state from a previous log, or start a new one
+        :type resume: bool
+
+        :return: Whether any previous state was restored
+        :rtype: bool
+        """
+        self.progress_log = PipelineLog(self.write_path.rstrip("/\\"), snapshot_every = self.checkpoint_every)
+        self.close_on_exit()
+        if not resume:
+            # Rows in an older dataset would be mistaken for ones posted in this run
+            if self.res_dataset is None:
+                self.remove_dataset()
+            self.progress_log.reset()
+            return False
+
+        state, events = self.progress_log.recover()
+        if state is None and not events:
+            return False
+
+        if state is not None:
+            self.restore_state(state)
+        rows = self.num_rows()
+        for event in events:
+            if "post" in event and event["rows"] > rows:
+                continue
+            self.replay_event(event)
+        return True
+
+    def log_event(self, event : Dict[str, Any]):
+        """
+        Log event (i.e. {"fetch" : id} or {"post" : id}) to progress log, if there is one. Post events should be logged
+        once the element's row has been added, and have the number of rows at that point under "rows".
+        Should be called with state_lock held, along with the change to the pipeline's state the event records.
+        """
+        if self.progress_log is not None:
+            self.progress_log.append(event)
+
+    def checkpoint_state(self) -> Dict[str, Any]:
+        """
+        State of pipeline to snapshot, as a JSON serializable dictionary. Must include every event logged so far.
+        """
+        return {}
+
+    def restore_state(self, state : Dict[str, Any]):
+        """
+        Restore state of pipeline from a snapshot.
+        """
+        pass
+
+    def replay_event(self, event : Dict[str, Any]):
+        """
+        Apply an event logged after the last snapshot to state of pipeline.
+        """
+        pass
+
+    def checkpoint(self, force : bool = False):
+        """
+        Make sure progress logged so far is on disk, and take a snapshot of pipeline state if one is due.
+        Should only be called once rows that have been added are saved.
+        """
+        if self.progress_log is None:
+            return
+
+        with self.state_lock:
+            if not (force or self.progress_log.snapshot_due()):
+                self.progress_log.sync()
+                return
+
+            if self.log_results:
+                # Snapshot can't refer to rows that are not on disk yet
+                with self.log_lock:
+                    if self.log_file is not None:
+                        self.log_file.flush()
+                        os.fsync(self.log_file.fileno())
+            self.progress_log.snapshot(self.checkpoint_state())
+
+    def element_posted(self, batch_element : BatchElement):
+        """
+        Called after an element is posted, i.e. to log that it was. Does nothing by default.
+        """
+        pass
+
+    def post_element(self, batch_element : BatchElement):
+        with self.state_lock:
+            super().post_element(batch_element)
+            self.element_posted(batch_element)
+            if self.checkpoint_due:
+                self.checkpoint_due = False
+                self.checkpoint()
+
+    def commit(self):
+        """
+        Save dataset if any rows were added since it was last saved, then checkpoint progress.
+        """
+        with self.state_lock:
+            if self.save_accum > 0:
+                self.save_dataset()
+                self.save_accum = 0
+            self.checkpoint()
+
+    def close(self):
+        """
+        Post and save any rows still waiting to be, snapshot progress, then compact any remaining logged rows into
+        the result dataset and close the log. Rows that were posted are saved even if writer failed to post some elements,
+        then its error is raised. Does nothing if pipeline is already closed.
+        """
+        if self.closed:
+            return
+
+        error = None
+        try:
+            super().close()
+        except Exception as e:
+            error = e
+
+        with self.state_lock:
+            self.commit()
+            if self.progress_log is not None:
+                self.checkpoint(force = True)
+                self.progress_log.close()
+                self.progress_log = None
+
+        if self.log_results:
+            with self.log_lock:
+                self.compact()
+                if self.log_file is not None:
+                    self.log_file.close()
+                    self.log_file = None
+
+        if error is not None:
+            raise error
 
     def add_row_to_dataset(self, row : Dict[str, Any]):
         """
-        Add single row to result dataset and then saves.
+        Add single row to result dataset. It is saved every save_every rows, or with write_behind, once the writer
+        commits the group of elements being posted. With log_results, the row is appended to the log.
 
         :param row: The row, as a dictionary, to add to the result dataset
         :type row: Dict[str, Any]
         """
+        if self.log_results:
+            with self.log_lock:
+                if self.log_file is None:
+                    self.open_log()
+                self.log_file.write(json.dumps(row) + "\n")
+                self.log_rows.append(row)
+                self.save_accum += 1
+
+                if self.compact_every is not None and len(self.log_rows) >= self.compact_every:
+                    self.compact()
+            self.save_if_due()
+            return
+
         row = {key : [row[key]] for key in row}
         if self.res_dataset is None:
             self.res_dataset = Dataset.from_dict(row) if self.format == "arrow" else pd.DataFrame(row)
         else:
             if self.format == "arrow":
-                self.res_dataset = self.res_dataset.append(row)
+                self.res_dataset = self.res_dataset.add_item({key : row[key][0] for key in row})
             else:
                 new_df = pd.DataFrame(row)
                 self.res_dataset = pd.concat([self.res_dataset, new_df], ignore_index = True)
 
         self.save_accum += 1
-        if self.save_accum >= self.save_every:
+        self.save_if_due()
+
+    def save_if_due(self):
+        # Writer saves once per group in commit instead
+        if self.write_behind or self.save_accum < self.save_every:
+            return
+        with self.state_lock:
             self.save_dataset()
             self.save_accum = 0
-
+            self.checkpoint_due = True
@@ -1,21 +1,37 @@
 from abc import abstractmethod
-from typing import Iterable, Dict, Any
+from typing import Callable, Deque, Iterable, Dict, Any, List, Set, Tuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from collections import deque
 
 from cheese.pipeline.write_only import WriteOnlyPipeline
+from cheese.pipeline.sources import ResumableSource, as_source
+from cheese.utils.disk_cache import GenerationCache
 from cheese.data import BatchElement
 
+import multiprocessing
 import threading
-import joblib
+import math
 import time
 
+worker_generator : Callable = None # Generator loaded by a worker process
+
+def init_worker(make_generator : Callable[[], Callable]):
+    global worker_generator
+    worker_generator = make_generator()
+
+def run_worker(model_input : List[Dict]) -> List[BatchElement]:
+    return list(worker_generator(model_input))
+
 class GenerativePipeline(WriteOnlyPipeline):
     """
     Base pipeline for any task that requires creating model generations and
-    displaying them to users efficiently. Fills up a buffer with generations continuously,
-    then serves them to users as they request them.
+    displaying them to users efficiently. A producer thread fills up a buffer with generations,
+    refilling it whenever it drains to buffer_low, and serves them to users as they request them.
 
     :param iterator: If model needs prompts or some predefined input data,
-    it should be provided by some iterator. Iterator should create some sort of dictionary
+    it should be provided by some iterator. Iterator should create some sort of dictionary. If it is a ResumableSource,
+    or has its own state_dict and load_state_dict (i.e. datasets.IterableDataset), resuming skips straight to the first input
+    that has not been posted. Otherwise it is replayed up to that point.
     :type iterator: Iterable[Dict]
 
     :param batch_size: The number of generations to produce in a single step
@@ -24,53 +40,157 @@ class GenerativePipeline(WriteOnlyPipeline):
     :param buffer_size: The number of generations to keep in the buffer
     :type buffer_size: int
 
-    :param log_progress: Whether to log progress through iterator into a file
+    :param buffer_low: Number of generations in buffer at or below which it is refilled. Defaults to half of buffer_size.
+    :type buffer_low: int
+
+    :param num_workers: If above 0, generations are made by this many worker processes instead of generate, each
+        loading its own generator with make_generator. Batches are handed to whichever worker is free, and their
+        generations are added to the buffer in the order their inputs were read.
+    :type num_workers: int
+
+    :param make_generator: With num_workers, called once in each worker process to load the generator, which
+        takes a batch of inputs and returns their BatchElements just like generate. Must be picklable
+        (i.e. a module level function, or functools.partial of one).
+    :type make_generator: Callable[[], Callable[[List[Dict]], Iterable[BatchElement]]]
+
+    :param adaptive_buffer: If true, buffer_size and buffer_low are adjusted as the pipeline runs, so that the buffer
+        holds enough generations to cover the time a batch takes to generate at the rate clients are consuming them,
+        times safety_margin. buffer_size and buffer_low are then only starting points.
+    :type adaptive_buffer: bool
+
+    :param safety_margin: With adaptive_buffer, factor on the number of generations consumed while a batch generates
+    :type safety_margin: float
+
+    :param max_buffer_size: With adaptive_buffer, largest size buffer can grow to. Defaults to four times buffer_size.
+    :type max_buffer_size: int
+
+    :param cache_path: Directory for a cache of generations. If given, generations are cached on disk keyed by their input,
+        and generation_config (see generation_key), and cached ones are used instead of generating again.
+        Generations left in the buffer are kept in the cache when the pipeline is closed, so after a restart they
+        are served again without being regenerated.
+    :type cache_path: str
+
+    :param cache_bytes: Most bytes of generations to keep in cache. Least recently used ones are evicted first.
+    :type cache_bytes: int
+
+    :param log_progress: Whether to log progress through iterator to a write-ahead log beside write_path. On resume,
+        inputs whose generations were already posted are skipped, and all others are generated again.
+        Assumes generate returns one element per input, in the same order.
+    :type log_progress: bool
+
     :param write_path: The path to write the result dataset to
     :type write_path: str
 
     :param force_new: Whether to force a new dataset to be created, even if one already exists at the write path
     :type force_new: bool
     """
-    def  __init__(self, iterator : Iterable[Dict], batch_size : int = 1, buffer_size : int = 32, log_progress : bool = True, max_length : int = None, **kwargs):
+    def  __init__(
+        self, iterator : Iterable[Dict], batch_size : int = 1, buffer_size : int = 32, buffer_low : int = None,
+        num_workers : int = 0, make_generator : Callable[[], Callable] = None,
+        adaptive_buffer : bool = False, safety_margin : float = 1.5, max_buffer_size : int = None,
+        cache_path : str = None, cache_bytes : int = 2 ** 30, log_progress : bool = True, max_length : int = None, **kwargs
+        ):
         super().__init__(**kwargs)
 
-        self.iterator = iterator
+        self.source : ResumableSource = as_source(iterator)
+        self.iterator = self.source if self.source is not None else iterator
         self.iterator_exhausted = False
 
         self.batch_size = batch_size
         self.buffer_size = buffer_size
+        self.buffer_low = buffer_size // 2 if buffer_low is None else buffer_low
 
-        self.buffer = []
+        self.buffer = deque()
         self.buffer_ready = False # Becomes true when buffer gets intial item
+        self.buffer_cond = threading.Condition() # Guards buffer, wakes producer when it drains and fetch when it fills
+        self.buffer_thread : threading.Thread = None
+        self.generating = False # Whether producer is generating a batch
+        self.producer_done = False # Set once producer has stopped
+        self.stop_buffer = False
+
+        self.fill_time = None # Seconds taken by last refill of buffer
+        self.gen_time = 0.0 # Total seconds spent generating
+        self.gen_count = 0 # Total generations produced
+
+        self.num_workers = num_workers
+        self.make_generator = make_generator
+        self.executor : ProcessPoolExecutor = None
+        if self.num_workers > 0 and self.make_generator is None:
+            raise Exception("Error: GenerativePipeline needs make_generator to generate with worker processes")
+
+        self.adaptive_buffer = adaptive_buffer
+        self.safety_margin = safety_margin
+        self.max_buffer_size = 4 * buffer_size if max_buffer_size is None else max_buffer_size
+        self.batch_latency : float = None # Moving average of seconds from starting a batch to its generations being ready
+        self.fetch_interval : float = None # Moving average of seconds between fetches
+        self.last_fetch_time : float = None
+        self.client_rate = 0.0 # Tasks per second clients are completing, as estimated by CHEESE
+
+        self.gen_cache = GenerationCache(cache_path, cache_bytes) if cache_path is not None else None
+        self.step_keys : Dict[int, str] = {} # Cache keys for generations of steps that have not been posted
+        if self.gen_cache is not None:
+            # Generations left in buffer are only cached on close
+            self.close_on_exit()
 
         self.progress = 0
         self.log_progress = log_progress
         self.max_length = max_length
-    
-        if self.log_progress and not self.force_new:
-            # If we're logging progress, try to load progress and update iterator to reflect it
-            try:
-                self.progress = joblib.load("save_data/progress.joblib")
-                for _ in range(self.progress): next(self.iterator)
-            except Exception as e:
-                print("Error loading progress:", e.with_traceback())
-                pass
+
+        self.iter_steps = 0 # Steps taken through iterator
+        self.done_steps = 0 # Generations for all inputs before this step have been posted
+        self.done : Set[int] = set() # Steps past done_steps whose generations have been posted
+        self.done_position : Dict[str, Any] = None # Position of source at done_steps
+        self.step_positions : Dict[int, Dict[str, Any]] = {} # Positions of source at steps from done_steps on
+
+        if self.log_progress:
+            self.start_progress_log(resume = not self.force_new)
+
+        if self.source is not None:
+            if self.done_position is not None:
+                # Skip straight past inputs that are done
+                self.source.load_state_dict(self.done_position)
+                self.iter_steps = self.done_steps
+            self.step_positions[self.iter_steps] = self.source.state_dict()
     
     def init_buffer(self):
         """
         Start filling buffer. Must call this in subclass, ideally at end of init
         """
-        self.buffer_thread = threading.Thread(target=self.populate_buffer)
+        if self.num_workers > 0:
+            # Spawned rather than forked, since this process has threads running and may have a GPU initialized
+            self.executor = ProcessPoolExecutor(
+                max_workers = self.num_workers,
+                mp_context = multiprocessing.get_context("spawn"),
+                initializer = init_worker,
+                initargs = (self.make_generator,)
+            )
+        self.buffer_thread = threading.Thread(target = self.populate_buffer, daemon = True)
         self.buffer_thread.start()
 
     @abstractmethod
     def generate(self, model_input : Iterable[Dict]) -> Iterable[BatchElement]:
         """
         Generate a batch of generations from input data. It is assumed
-        the input is a batch.
+        the input is a batch. Should give one generation per input, in the same order.
         """
         pass
 
+    def generation_config(self) -> Dict[str, Any]:
+        """
+        Everything other than its input that determines a generation (i.e. model, sampling settings and seed),
+        as a JSON serializable dictionary. Part of the key generations are cached under. Empty by default.
+        """
+        return {}
+
+    def generation_key(self, model_input : Any) -> str:
+        """
+        Key a generation is cached under, given its input. Depends only on the input and generation_config, so the same
+        input gives the same key wherever it is in the iterator. If generations are random, each input should carry the
+        seed it is generated with (i.e. one derived from its prompt and index), so inputs that should give different
+        generations have different keys.
+        """
+        return GenerationCache.make_key({"input" : model_input, "config" : self.generation_config()})
+
     @abstractmethod
     def extract_data(self, batch_element : BatchElement) -> Dict:
         """
@@ -83,21 +203,96 @@ class GenerativePipeline(WriteOnlyPipeline):
         return {
             "progress" : self.progress,
             "buffer_content" : self.buffer_content(),
-            "ready" : self.buffer_ready
+            "ready" : self.buffer_ready,
+            "buffer_fill_time" : self.fill_time,
+            "generation_rate" : self.gen_count / self.gen_time if self.gen_time > 0 else None,
+            "buffer_size" : self.buffer_size,
+            "buffer_low" : self.buffer_low,
+            "consumption_rate" : self.consumption_rate(),
+            "batch_latency" : self.batch_latency,
+            "cache_stats" : self.gen_cache.get_stats() if self.gen_cache is not None else None
         }
 
+    def consumption_rate(self) -> float:
+        """
+        Estimated number of generations consumed per second. Takes the larger of the rate clients are completing tasks
+        at and the rate generations are being fetched at, so neither lagging estimate leaves the buffer too small.
+        """
+        fetch_rate = 1 / self.fetch_interval if self.fetch_interval else 0.0
+        return max(self.client_rate, fetch_rate)
+
+    def observe_consumption(self, rate : float):
+        self.client_rate = rate
+        self.resize_buffer()
+
+    def resize_buffer(self):
+        """
+        With adaptive_buffer, set buffer_low to the number of generations consumed while a batch generates,
+        times safety_margin, and buffer_size to leave room above that for a batch per worker.
+        """
+        rate = self.consumption_rate()
+        if not self.adaptive_buffer or self.batch_latency is None or rate <= 0:
+            return
+
+        per_round = self.batch_size * max(self.num_workers, 1) # Generations added by one batch per worker
+        low = math.ceil(rate * self.batch_latency * self.safety_margin)
+        low = max(0, min(low, self.max_buffer_size - per_round))
+        with self.buffer_cond:
+            self.buffer_low = low
+            self.buffer_size = low + per_round
+            self.buffer_cond.notify_all()
+
     def exhausted(self) -> bool:
         """
-        Is there any more data to read?
+        Is there any more data to read? Generations still in the buffer or being generated count as data.
         """
-        if self.iterator_exhausted or self.progress >= self.max_length:
+        if self.max_length is not None and self.progress >= self.max_length:
             return True
-        return False
-    
-    def save_dataset(self):
-        super().save_dataset()
-        if self.log_progress:
-            joblib.dump(self.progress, "save_data/progress.joblib")
+        with self.buffer_cond:
+            return self.iterator_exhausted and not self.generating and len(self.buffer) == 0
+
+    def checkpoint_state(self) -> Dict[str, Any]:
+        return {
+            "progress" : self.progress,
+            "done_steps" : self.done_steps,
+            "done" : sorted(self.done),
+            "done_position" : self.step_positions.get(self.done_steps)
+        }
+
+    def restore_state(self, state : Dict[str, Any]):
+        self.progress = state["progress"]
+        self.done_steps = state["done_steps"]
+        self.done = set(state["done"])
+        self.done_position = state.get("done_position")
+
+    def replay_event(self, event : Dict[str, Any]):
+        if "post" in event:
+            self.mark_done(event["post"])
+            self.progress = event["progress"]
+            if event.get("done_steps") == self.done_steps:
+                self.done_position = event.get("done_position")
+
+    def mark_done(self, step : int):
+        """
+        Mark generation for input at given step of iterator as posted.
+        """
+        if step < self.done_steps:
+            return
+        self.done.add(step)
+        while self.done_steps in self.done:
+            self.done.remove(self.done_steps)
+            self.step_positions.pop(self.done_steps, None)
+            self.step_keys.pop(self.done_steps, None)
+            self.done_steps += 1
+
+    def element_posted(self, batch_element : BatchElement):
+        step = self.pop_fetch_id(batch_element)
+        if step >= 0:
+            self.mark_done(step)
+        self.log_event({
+            "post" : step, "rows" : self.num_rows(), "progress" : self.progress,
+            "done_steps" : self.done_steps, "done_position" : self.step_positions.get(self.done_steps)
+        })
 
     def buffer_content(self) -> int:
         """
@@ -105,29 +300,187 @@ class GenerativePipeline(WriteOnlyPipeline):
         """
         return len(self.buffer)
 
+    def next_inputs(self) -> Tuple[List[Dict], List[int]]:
+        """
+        Take next batch of inputs from iterator, skipping any whose generations were posted before a restart.
+
+        :return: Inputs and the steps of the iterator they were taken from
+        """
+        model_input, steps = [], []
+        try:
+            while len(model_input) < self.batch_size:
+                x = next(self.iterator)
+                step = self.iter_steps
+                self.iter_steps += 1
+
+                with self.state_lock:
+                    if self.source is not None:
+                        self.step_positions[self.iter_steps] = self.source.state_dict()
+                    if step < self.done_steps or step in self.done:
+                        continue
+                model_input.append(x)
+                steps.append(step)
+        except StopIteration:
+            self.iterator_exhausted = True
+        return model_input, steps
+
     def populate_buffer(self):
         """
-        Fill up the buffer with new generations
+        Producer thread. Fills the buffer up to buffer_size with new generations, then waits until it drains
+        to buffer_low before filling it again. Stops once iterator is exhausted or the pipeline is closed.
         """
-        while len(self.buffer) < self.buffer_size and not self.exhausted():
+        # Batches being generated, with their steps and when they were started, in iterator order
+        in_flight : Deque[Tuple[List[int], Future, float]] = deque()
+        try:
+            while True:
+                with self.buffer_cond:
+                    self.buffer_cond.wait_for(lambda: self.stop_buffer or len(self.buffer) <= self.buffer_low)
+                    if self.stop_buffer:
+                        return
+
+                start = time.time()
+                while not self.stop_buffer:
+                    # Keep a batch in flight for each worker, as long as there is room in buffer for its generations
+                    while len(in_flight) < max(self.num_workers, 1) and not self.iterator_exhausted:
+                        if self.max_length is not None and self.progress >= self.max_length:
+                            break
+                        with self.buffer_cond:
+                            if len(self.buffer) + sum(len(steps) for steps, _, _ in in_flight) >= self.buffer_size:
+                                break
+                            self.generating = True
+                        model_input, steps = self.next_inputs()
+                        if model_input:
+                            submitted = time.time()
+                            in_flight.append((steps, self.submit_batch(model_input, steps), submitted))
+
+                    with self.buffer_cond:
+                        self.generating = len(in_flight) > 0
+                    if not in_flight:
+                        break
+
+                    steps, future, submitted = in_flight.popleft()
+                    new_elems : List[BatchElement] = list(future.result())
+                    latency = time.time() - submitted
+                    self.batch_latency = latency if self.batch_latency is None else 0.8 * self.batch_latency + 0.2 * latency
+                    self.resize_buffer()
+                    self.gen_count += len(new_elems)
+                    for step, elem in zip(steps, new_elems):
+                        self.set_fetch_id(elem, step)
+
+                    with self.buffer_cond:
+                        self.buffer.extend(new_elems)
+                        if new_elems:
+                            self.buffer_ready = True
+                        self.buffer_cond.notify_all()
+                self.gen_time += time.time() - start
+                self.fill_time = time.time() - start
+
+                if self.iterator_exhausted or (self.max_length is not None and self.progress >= self.max_length):
+                    return
+        finally:
+            with self.buffer_cond:
+                self.producer_done = True
+                self.generating = False
+                self.buffer_cond.notify_all()
+
+    def submit_batch(self, model_input : List[Dict], steps : List[int]) -> Future:
+        """
+        Start generating a batch, on a worker process if there are any, otherwise right away with generate.
+        With a generation cache, only inputs whose generations are not cached are generated, and their
+        generations are then cached.
+
+        :return: Future for generations of whole batch, in order of inputs. Fails if generate did not give one
+            generation for each input.
+        :rtype: Future
+        """
+        keys, cached = None, None
+        if self.gen_cache is not None:
+            keys = [self.generation_key(x) for x in model_input]
+            cached = [self.gen_cache.get(key) for key in keys]
+            with self.state_lock:
+                self.step_keys.update(zip(steps, keys))
+            model_input = [x for x, elem in zip(model_input, cached) if elem is None]
+
+        result = Future()
+        def finish(generated : Future):
+            try:
+                new_elems = [] if generated is None else list(generated.result())
+                if len(new_elems) != len(model_input):
+                    # Generations are matched to inputs by position, so any other number would misattribute them
+                    raise Exception(
+                        f"Error: Generation should give one element per input, but gave {len(new_elems)} for {len(model_input)} inputs"
+                    )
+                if cached is None:
+                    result.set_result(new_elems)
+                    return
+
+                new_elems = iter(new_elems)
+                elems = []
+                for key, elem in zip(keys, cached):
+                    if elem is None:
+                        elem = next(new_elems)
+                        self.gen_cache.put(key, elem)
+                    elems.append(elem)
+                result.set_result(elems)
+            except Exception as e:
+                result.set_exception(e)
+
+        if not model_input:
+            finish(None)
+        elif self.executor is not None:
+            self.executor.submit(run_worker, model_input).add_done_callback(finish)
+        else:
+            generated = Future()
             try:
-                model_input = [next(self.iterator) for _ in range(self.batch_size)]
-                new_elems : Iterable[BatchElement] = self.generate(model_input)
-                self.buffer += new_elems
-                self.buffer_ready = True
-            except StopIteration:
-                self.iterator_exhausted = True
-                break
+                generated.set_result(self.generate(model_input))
+            except Exception as e:
+                generated.set_exception(e)
+            finish(generated)
+        return result
 
     def fetch(self) -> BatchElement:
-        if len(self.buffer) == 0:
-            # Stall until buffer is ready
-            print("Warning: Tried to fetch data before any was created. Please wait longer for buffer to fill or increase its capacity. Execution  will now stall until buffer is ready.")
-            while len(self.buffer) == 0:
-                time.sleep(1)
-
-        elem = self.buffer.pop(0)
-        return elem
+        with self.buffer_cond:
+            if len(self.buffer) == 0 and not self.buffer_ready:
+                print("Warning: Tried to fetch data before any was created. Please wait longer for buffer to fill or increase its capacity. Execution  will now stall until buffer is ready.")
+            # Stall until producer adds to buffer
+            self.buffer_cond.wait_for(lambda: len(self.buffer) > 0 or self.producer_done)
+            if len(self.buffer) == 0:
+                raise Exception("Error: Tried to fetch from generative pipeline after it stopped generating")
+
+            elem = self.buffer.popleft()
+            self.buffer_cond.notify_all()
+
+            now = time.time()
+            if self.last_fetch_time is not None:
+                interval = now - self.last_fetch_time
+                self.fetch_interval = interval if self.fetch_interval is None else 0.8 * self.fetch_interval + 0.2 * interval
+            self.last_fetch_time = now
+            return elem
+
+    def close(self):
+        """
+        Stop producer once it finishes any batch it is waiting on, shut down worker processes, keep generations
+        left in buffer in the cache (if there is one), then close as usual. Does nothing if already closed.
+        """
+        if self.closed:
+            return
+
+        if self.buffer_thread is not None:
+            with self.buffer_cond:
+                self.stop_buffer = True
+                self.buffer_cond.notify_all()
+            self.buffer_thread.join()
+            self.buffer_thread = None
+        if self.gen_cache is not None:
+            with self.buffer_cond:
+                for elem in self.buffer:
+                    key = self.step_keys.get(self.get_fetch_id(elem))
+                    if key is not None and not self.gen_cache.touch(key):
+                        self.gen_cache.put(key, elem)
+        if self.executor is not None:
+            self.executor.shutdown(wait = True, cancel_futures = True)
+            self.executor = None
+        super().close()
     
     def post(self, be : BatchElement):
         self.progress += 1
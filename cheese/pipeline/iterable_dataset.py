@@ -1,12 +1,12 @@
 from abc import abstractmethod
-from typing import Dict, Any, Iterable
+from typing import Dict, Any, Iterable, List, Tuple
 
 from datasets import load_from_disk, Dataset
 import pandas as pd
-import joblib
 import numpy as np
 
 from cheese.pipeline.datasets import DatasetPipeline
+from cheese.pipeline.sources import ResumableSource, ShardedSource, as_source
 from cheese.data import BatchElement
 from cheese.utils import safe_mkdir
 
@@ -15,7 +15,10 @@ class IterablePipeline(DatasetPipeline):
     Base class for any pipeline reading from an iterable dataset
     Writes results to Datasets dataset
 
-    :param iter: The iterable to be used to read data from
+    :param iter: The iterable to be used to read data from. If it is a ResumableSource, or has its own state_dict and
+        load_state_dict (i.e. datasets.IterableDataset), resuming skips straight to where it left off.
+        Otherwise it is replayed up to that point. A ShardedSource reads a list of shards in parallel, and unless it has
+        a transform of its own, preprocess is run on its workers, skipping data that raises InvalidDataException.
     :type iter: Iterable
 
     :param write_path: Path to write result dataset to
@@ -25,11 +28,22 @@ class IterablePipeline(DatasetPipeline):
     :type force_new: bool
 
     :param max_length: Maximum number of entries to produce for output dataset. Defaults to infinity.
+
+    Progress is kept in a write-ahead log beside write_path, recording which steps of the iterator went into each
+    fetched element and which elements were posted. On resume, elements that were fetched but never posted are fetched
+    again and served first, so nothing is lost or labelled twice. This assumes fetch and preprocess are deterministic.
     """
     def __init__(self, iter : Iterable, write_path : str, force_new : bool = False, max_length = np.inf, **kwargs):
         super().__init__(**kwargs)
 
-        self.data_source = iter
+        self.source : ResumableSource = as_source(iter)
+        self.data_source = self.source if self.source is not None else iter
+
+        # Whether data source already preprocesses and validates data on its own workers
+        self.preprocessed = isinstance(self.source, ShardedSource)
+        if self.preprocessed and self.source.transform is None:
+            self.source.transform = self.preprocess
+            self.source.skip = (InvalidDataException,)
         self.iter_steps = 0 # How many steps through iterator have been taken (counting bad data)
         self.progress = 0 # How much data we have succesfully written to target
 
@@ -38,33 +52,117 @@ class IterablePipeline(DatasetPipeline):
         self.write_path = write_path
         self.max_length = max_length
 
-        try:
-            assert not force_new
-            assert self.load_dataset()
-            self.iter_steps, self.progress = joblib.load("save_data/progress.joblib")
-            for _ in range(self.iter_steps):
-                next(self.data_source)
-
-        except:
-            safe_mkdir("save_data")
-            self.progress = 0
-            self.save_dataset()
+        self.fetched_steps = 0 # Steps through iterator covered by fetched elements
+        self.fetched_position = self.position() # Position of source after fetched_steps
+        self.next_fetch_id = 0
+        # Fetched elements that are not posted yet -> their iterator steps and position of source before them
+        self.unposted : Dict[int, Tuple[int, int, Dict]] = {}
+        self.to_refetch : List[Tuple[int, int, Dict]] = [] # Unposted elements from before a restart
+
+        if not force_new:
+            self.load_dataset()
+        if self.start_progress_log(resume = not force_new):
+            self.to_refetch = sorted(
+                [(id, start, position) for id, (start, _, position) in self.unposted.items()],
+                key = lambda x: x[1]
+            )
 
     def get_stats(self) -> Dict:
-        return {
+        stats = {
             "progress" : self.progress,
             "iter_steps" : self.iter_steps
         }
+        if isinstance(self.source, ShardedSource):
+            stats.update(self.source.get_stats())
+        return stats
 
     def exhausted(self) -> bool:
         return self.progress >= self.max_length or self.fail_next
 
-    def save_dataset(self):
+    def checkpoint_state(self) -> Dict[str, Any]:
+        return {
+            "fetched_steps" : self.fetched_steps,
+            "fetched_position" : self.fetched_position,
+            "progress" : self.progress,
+            "next_fetch_id" : self.next_fetch_id,
+            "unposted" : [[id, start, end, position] for id, (start, end, position) in self.unposted.items()]
+        }
+
+    def restore_state(self, state : Dict[str, Any]):
+        self.fetched_steps = state["fetched_steps"]
+        self.fetched_position = state.get("fetched_position")
+        self.progress = state["progress"]
+        self.next_fetch_id = state["next_fetch_id"]
+        self.unposted = {id : (start, end, position) for id, start, end, position in state["unposted"]}
+
+    def replay_event(self, event : Dict[str, Any]):
+        if "fetch" in event:
+            self.unposted[event["fetch"]] = (event["start"], event["end"], event.get("position"))
+            self.fetched_steps = event["end"]
+            self.fetched_position = event.get("next_position")
+            self.next_fetch_id = event["fetch"] + 1
+        elif "post" in event:
+            self.unposted.pop(event["post"], None)
+            self.progress = event["progress"]
+
+    def position(self) -> Dict[str, Any]:
         """
-        Save dataset and progress.
+        Position of data source, or None if it can't be resumed from a position.
         """
-        super().save_dataset()
-        joblib.dump([self.iter_steps, self.progress], "save_data/progress.joblib")
+        return self.source.state_dict() if self.source is not None else None
+
+    def skip_to(self, step : int, position : Dict[str, Any] = None):
+        """
+        Move data source to given number of steps through it. Jumps straight there if data source is resumable
+        and its position at that step is given, otherwise advances through it step by step.
+        """
+        if self.iter_steps == step:
+            return
+
+        if position is not None and self.source is not None:
+            self.source.load_state_dict(position)
+            self.iter_steps = step
+            return
+
+        if step < self.iter_steps:
+            raise Exception("Error: Cannot move data source backwards without a position to resume from")
+        while self.iter_steps < step:
+            next(self.data_source)
+            self.iter_steps += 1
+
+    def fetch_element(self) -> BatchElement:
+        """
+        Fetch next element, logging which steps of the iterator went into it. Elements left unposted before a restart
+        are fetched again first.
+        """
+        with self.state_lock:
+            if self.to_refetch:
+                id, start, position = self.to_refetch.pop(0)
+                self.skip_to(start, position)
+                batch_element = self.fetch()
+                self.set_fetch_id(batch_element, id)
+                return batch_element
+
+            self.skip_to(self.fetched_steps, self.fetched_position)
+            start, position = self.iter_steps, self.fetched_position
+            batch_element = self.fetch()
+            fetch_id = self.next_fetch_id
+            self.set_fetch_id(batch_element, fetch_id)
+            self.next_fetch_id += 1
+
+            self.fetched_steps = self.iter_steps
+            self.fetched_position = self.position()
+            self.unposted[fetch_id] = (start, self.fetched_steps, position)
+            self.log_event({
+                "fetch" : fetch_id, "start" : start, "end" : self.fetched_steps,
+                "position" : position, "next_position" : self.fetched_position
+            })
+            return batch_element
+
+    def element_posted(self, batch_element : BatchElement):
+        fetch_id = self.pop_fetch_id(batch_element)
+        self.unposted.pop(fetch_id, None)
+        self.log_event({"post" : fetch_id, "rows" : self.num_rows(), "progress" : self.progress})
 
     def preprocess(self, x : Any) -> Any:
         """
@@ -87,6 +185,9 @@ class IterablePipeline(DatasetPipeline):
         try:
             while True:
                 res = next(self.data_source)
+                self.iter_steps += 1
+                if self.preprocessed:
+                    return res
                 try:
                     return self.preprocess(res)
                 except Exception as e:
@@ -109,9 +210,14 @@ class IterablePipeline(DatasetPipeline):
         """
         pass
 
+    def close(self):
+        super().close()
+        if isinstance(self.source, ShardedSource):
+            self.source.stop()
+
     def post_row(self, row : Dict[str, Any]):
         """
-        Given a row to add to result dataset: updates progress, adds row and saves.
+        Given a row to add to result dataset: updates progress and adds row.
         """
         super().add_row_to_dataset(row)
         self.progress += 1
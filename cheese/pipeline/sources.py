@@ -0,0 +1,401 @@
+from abc import abstractmethod
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import threading
+import posixpath
+import tarfile
+import queue
+import copy
+
+class ResumableSource:
+    """
+    Abstract base class for data sources that can report their position and later resume from it, without replaying
+    everything that came before. Pipelines log state_dict along with their progress and call load_state_dict on resume.
+    Any other iterable can still be used as a data source, but is replayed from the start on resume.
+    """
+    def __iter__(self):
+        return self
+
+    @abstractmethod
+    def __next__(self) -> Any:
+        pass
+
+    @abstractmethod
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        Position of source, as a JSON serializable dictionary. The next item after loading it is the one that would
+        have come next when it was taken.
+        """
+        pass
+
+    @abstractmethod
+    def load_state_dict(self, state : Dict[str, Any]):
+        """
+        Move source to a position taken with state_dict.
+        """
+        pass
+
+class StatefulIterableSource(ResumableSource):
+    """
+    Adapter for iterables that track their own position with state_dict and load_state_dict (i.e. datasets.IterableDataset,
+    including streaming datasets). Resuming skips straight to the right shard and example.
+
+    :param iterable: Iterable with state_dict and load_state_dict methods
+    """
+    def __init__(self, iterable : Any):
+        self.iterable = iterable
+        self.iterator = None
+
+    def __next__(self) -> Any:
+        if self.iterator is None:
+            self.iterator = iter(self.iterable)
+        return next(self.iterator)
+
+    def state_dict(self) -> Dict[str, Any]:
+        return copy.deepcopy(self.iterable.state_dict())
+
+    def load_state_dict(self, state : Dict[str, Any]):
+        self.iterable.load_state_dict(copy.deepcopy(state))
+        self.iterator = None # Position is picked up when iteration starts again
+
+class TextFileSource(ResumableSource):
+    """
+    Reads lines (without line endings) from one or more text files, resuming from a byte offset.
+
+    :param paths: Path or list of paths to read, in order
+    :type paths: Union[str, List[str]]
+
+    :param encoding: Encoding of files
+    :type encoding: str
+    """
+    def __init__(self, paths : Union[str, List[str]], encoding : str = "utf-8"):
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+        self.encoding = encoding
+
+        self.file_idx = 0
+        self.file = None
+        self.offset = 0
+
+    def __next__(self) -> str:
+        while self.file_idx < len(self.paths):
+            if self.file is None:
+                self.file = open(self.paths[self.file_idx], "rb")
+                self.file.seek(self.offset)
+
+            line = self.file.readline()
+            if line:
+                self.offset = self.file.tell()
+                return line.decode(self.encoding).rstrip("\r\n")
+
+            self.file.close()
+            self.file = None
+            self.file_idx += 1
+            self.offset = 0
+
+        raise StopIteration
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {"file" : self.file_idx, "offset" : self.offset}
+
+    def load_state_dict(self, state : Dict[str, Any]):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.file_idx = state["file"]
+        self.offset = state["offset"]
+
+class TarShardSource(ResumableSource):
+    """
+    Reads samples from uncompressed tar shards in webdataset layout. Files with the same key (path up to the first dot
+    of the file name) are grouped into one sample, a dictionary from extension to file contents with the key under "__key__".
+    Resumes from a shard index and the offset of the header of the first member of the next sample in it.
+
+    :param paths: Path or list of paths to tar shards, in order
+    :type paths: Union[str, List[str]]
+    """
+    def __init__(self, paths : Union[str, List[str]]):
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+
+        self.shard = 0
+        self.offset = 0 # Offset of header of first member of next sample in current shard
+        self.file = None
+
+    def close_shard(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+
+    def read_sample(self) -> Optional[Dict[str, Any]]:
+        """
+        Read next sample from current shard, moving on to the next shard once it is done. Returns None if the shard
+        had no more samples. Each sample is read by opening the archive at its offset, so members read before it are
+        not kept around, and the header of the member that ends it is read again as the start of the next one.
+        """
+        if self.file is None:
+            self.file = open(self.paths[self.shard], "rb")
+        self.file.seek(self.offset)
+        tar = tarfile.open(fileobj = self.file, mode = "r:")
+
+        sample = None
+        for member in tar:
+            if not member.isfile():
+                continue
+
+            directory, name = posixpath.split(member.name)
+            base, _, ext = name.partition(".")
+            key = posixpath.join(directory, base)
+
+            if sample is not None and key != sample["__key__"]:
+                self.offset = member.offset
+                tar.close()
+                return sample
+
+            if sample is None:
+                sample = {"__key__" : key}
+            sample[ext] = tar.extractfile(member).read()
+
+        tar.close()
+        self.close_shard()
+        self.shard += 1
+        self.offset = 0
+        return sample
+
+    def __next__(self) -> Dict[str, Any]:
+        while self.shard < len(self.paths):
+            sample = self.read_sample()
+            if sample is not None:
+                return sample
+
+        raise StopIteration
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {"shard" : self.shard, "offset" : self.offset}
+
+    def load_state_dict(self, state : Dict[str, Any]):
+        self.close_shard()
+        self.shard = state["shard"]
+        self.offset = state["offset"]
+
+def open_shard(path : str) -> ResumableSource:
+    """
+    Default reader for a shard: TarShardSource for tar archives, TextFileSource for anything else.
+    """
+    if path.endswith(".tar"):
+        return TarShardSource(path)
+    return TextFileSource(path)
+
+# Markers workers put in a shard's queue after its last item, or if reading it failed
+SHARD_END = object()
+SHARD_ERROR = object()
+
+class ShardCursor:
+    """
+    How far an open shard has been read: its source, once a worker has opened it, and the items read ahead from it
+    along with the shard's position after each. Only one worker reads a shard at a time.
+    """
+    def __init__(self, shard : int, position : Optional[Dict[str, Any]], queue_size : int):
+        self.shard = shard
+        self.position = position # Position to open source at
+        self.source : ResumableSource = None
+        self.ready : queue.Queue = queue.Queue(maxsize = queue_size)
+        self.scheduled = False # Waiting for or being read by a worker
+        self.done = False # Last entry (SHARD_END or SHARD_ERROR) has been read
+
+class ShardedSource(ResumableSource):
+    """
+    Reads a list of shards (i.e. files or tar archives) in parallel. Up to num_workers shards are open at once,
+    each read ahead into its own bounded queue by a fixed pool of num_workers threads, with an optional transform
+    (i.e. preprocessing and validation) applied on the worker. Items are interleaved round robin across open shards, and once a shard runs out, the next
+    unopened one takes its place. Interleaving is deterministic, so resuming from a position gives exactly the items that
+    would have come next, and the position only records the open shards and how far each of them has been read.
+
+    :param shards: Paths to shards, in the order they should be opened
+    :type shards: List[str]
+
+    :param num_workers: Number of shards open at once, and of threads reading them
+    :type num_workers: int
+
+    :param ready_size: Total number of items read ahead across all open shards
+    :type ready_size: int
+
+    :param reader: Creates a resumable source for a shard from its path. Defaults to open_shard.
+    :type reader: Callable[[str], ResumableSource]
+
+    :param transform: Applied to each item on the worker reading it
+    :type transform: Callable[[Any], Any]
+
+    :param skip: Exception types that, when raised by transform, mean the item should be skipped
+    :type skip: Tuple[type]
+    """
+    def __init__(
+        self, shards : List[str], num_workers : int = 4, ready_size : int = 64,
+        reader : Callable[[str], ResumableSource] = open_shard,
+        transform : Callable[[Any], Any] = None, skip : Tuple[type] = ()
+        ):
+        self.shards = list(shards)
+        self.num_workers = num_workers
+        self.queue_size = max(1, ready_size // num_workers)
+        self.reader = reader
+        self.transform = transform
+        self.skip = skip
+
+        self.active : List[int] = [] # Open shards in the order they are read from
+        self.positions : Dict[int, Dict[str, Any]] = {} # Open shard -> position after last item taken from it
+        self.next_shard = 0 # First shard that has not been opened
+        self.turn = 0 # Index into active of shard to take next item from
+
+        self.started = False
+        self.cursors : Dict[int, ShardCursor] = {} # Open shard -> how far it has been read
+        self.work : queue.Queue = None # Cursors of shards with room for more items, for workers to read
+        self.workers : List[threading.Thread] = []
+        self.lock = threading.Lock() # Guards whether cursors are scheduled
+        self.stop_event = threading.Event()
+
+    def schedule(self, cursor : ShardCursor):
+        """
+        Give cursor to a worker to read its next item, unless it already has one or has no room for it.
+        """
+        with self.lock:
+            if cursor.scheduled or cursor.done or cursor.ready.full():
+                return
+            cursor.scheduled = True
+        self.work.put(cursor)
+
+    def read_item(self, cursor : ShardCursor):
+        """
+        Read next item of a shard into its queue, or SHARD_END or SHARD_ERROR if there are none. Never blocks,
+        since cursors are only scheduled when their queue has room.
+        """
+        try:
+            if cursor.source is None:
+                cursor.source = self.reader(self.shards[cursor.shard])
+                if cursor.position is not None:
+                    cursor.source.load_state_dict(cursor.position)
+
+            while True:
+                try:
+                    item = next(cursor.source)
+                except StopIteration:
+                    cursor.done = True
+                    cursor.ready.put((SHARD_END, None))
+                    return
+                if self.transform is not None:
+                    try:
+                        item = self.transform(item)
+                    except self.skip:
+                        continue
+                cursor.ready.put((item, cursor.source.state_dict()))
+                return
+        except Exception as e:
+            cursor.done = True
+            cursor.ready.put((SHARD_ERROR, e))
+
+    def work_loop(self):
+        """
+        Worker thread. Reads an item at a time from whichever shard is next in line, so shards take turns.
+        """
+        while not self.stop_event.is_set():
+            try:
+                cursor = self.work.get(timeout = 0.1)
+            except queue.Empty:
+                continue
+            self.read_item(cursor)
+            with self.lock:
+                cursor.scheduled = False
+            self.schedule(cursor)
+
+    def open(self, shard : int):
+        self.cursors[shard] = ShardCursor(shard, self.positions.get(shard), self.queue_size)
+        self.schedule(self.cursors[shard])
+
+    def start(self):
+        """
+        Start workers and open shards from current position, filling free slots with unopened shards.
+        """
+        self.stop_event.clear()
+        self.work = queue.Queue()
+        self.workers = [threading.Thread(target = self.work_loop, daemon = True) for _ in range(self.num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+        while len(self.active) < self.num_workers and self.next_shard < len(self.shards):
+            self.active.append(self.next_shard)
+            self.next_shard += 1
+        for shard in self.active:
+            self.open(shard)
+        self.started = True
+
+    def stop(self):
+        """
+        Stop all workers, discarding whatever they read ahead.
+        """
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.cursors = {}
+        self.started = False
+
+    def __next__(self) -> Any:
+        if not self.started:
+            self.start()
+
+        while self.active:
+            shard = self.active[self.turn]
+            cursor = self.cursors[shard]
+            item, position = cursor.ready.get()
+            self.schedule(cursor) # Now it has room for another
+
+            if item is SHARD_ERROR:
+                raise position
+            if item is SHARD_END:
+                # Next shard takes its place, or if there are none left, the slot is dropped
+                del self.cursors[shard]
+                self.positions.pop(shard, None)
+                if self.next_shard < len(self.shards):
+                    self.active[self.turn] = self.next_shard
+                    self.next_shard += 1
+                    self.open(self.active[self.turn])
+                else:
+                    self.active.pop(self.turn)
+                    if self.turn >= len(self.active): self.turn = 0
+                continue
+
+            self.positions[shard] = position
+            self.turn = (self.turn + 1) % len(self.active)
+            return item
+
+        self.stop() # Every shard has been read, so workers have nothing left to do
+        raise StopIteration
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {
+            "active" : [[shard, self.positions.get(shard)] for shard in self.active],
+            "next_shard" : self.next_shard,
+            "turn" : self.turn
+        }
+
+    def load_state_dict(self, state : Dict[str, Any]):
+        self.stop()
+        self.active = [shard for shard, _ in state["active"]]
+        self.positions = {shard : position for shard, position in state["active"] if position is not None}
+        self.next_shard = state["next_shard"]
+        self.turn = state["turn"]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "open_shards" : len(self.active),
+            "remaining_shards" : len(self.shards) - self.next_shard,
+            "ready" : sum(cursor.ready.qsize() for cursor in self.cursors.values())
+        }
+
+def as_source(iterable : Iterable) -> Optional[ResumableSource]:
+    """
+    Get a resumable source for iterable, if it supports resuming. Returns ResumableSources as they are, and wraps
+    iterables with their own state_dict and load_state_dict (i.e. datasets.IterableDataset). Returns None otherwise.
+    """
+    if isinstance(iterable, ResumableSource):
+        return iterable
+    if hasattr(iterable, "state_dict") and hasattr(iterable, "load_state_dict") and not hasattr(iterable, "__next__"):
+        return StatefulIterableSource(iterable)
+    return None
@@ -0,0 +1,152 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+import threading
+import shutil
+import json
+import os
+
+def fsync_path(path : str):
+    """
+    Flush a file, or every file in a directory, to disk.
+    """
+    paths = [path]
+    if os.path.isdir(path):
+        paths = [os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+
+    for p in paths:
+        fd = os.open(p, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def replace_path(tmp_path : str, path : str):
+    """
+    Flush tmp_path to disk and move it to path, replacing whatever was there. Atomic for files. For directories,
+    the old directory is removed just before the new one is moved in.
+    """
+    fsync_path(tmp_path)
+    if os.path.isdir(tmp_path) and os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+class PipelineLog:
+    """
+    Write-ahead log of a pipeline's progress with periodic atomic snapshots. Events (i.e. an element being fetched or posted)
+    are appended to a JSON lines log as they happen and flushed to disk in batches with sync. Every so often the pipeline's
+    whole state is snapshotted to a temporary file that is then moved into place, after which the log starts over.
+    Recovering loads the last snapshot and the events logged after it.
+
+    :param path: Base path for files. Snapshot is written to path + ".state.json" and log to path + ".wal.jsonl"
+    :type path: str
+
+    :param snapshot_every: Number of logged events after which a snapshot is due
+    :type snapshot_every: int
+    """
+    def __init__(self, path : str, snapshot_every : int = 1000):
+        self.state_path = path + ".state.json"
+        self.log_path = path + ".wal.jsonl"
+        self.snapshot_every = snapshot_every
+
+        self.log_file = None
+        self.seq = 0 # Sequence number of last logged event
+        self.events_since_snapshot = 0
+        self.lock = threading.Lock()
+
+    def reset(self):
+        """
+        Remove any previous snapshot and log to start over.
+        """
+        for path in [self.state_path, self.log_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.seq = 0
+        self.events_since_snapshot = 0
+
+    def recover(self) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        Read last snapshot and events logged since it was taken.
+
+        :return: State from snapshot (None if there is none) and list of events in the order they were logged
+        """
+        state, snapshot_seq = None, 0
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as f:
+                snapshot = json.load(f)
+            state, snapshot_seq = snapshot["state"], snapshot["seq"]
+
+        events = []
+        damaged = False
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r") as f:
+                lines = f.read().splitlines()
+            for i, line in enumerate(lines):
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    if i < len(lines) - 1:
+                        raise
+                    damaged = True # Last write was cut off
+                    break
+                # Log may not have been cleared after last snapshot was taken
+                if event["seq"] > snapshot_seq:
+                    events.append(event)
+
+        self.seq = events[-1]["seq"] if events else snapshot_seq
+        self.events_since_snapshot = len(events)
+
+        if damaged:
+            # Rewrite log without cut off line, so new events are not appended to it
+            tmp_path = self.log_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                for event in events:
+                    f.write(json.dumps(event) + "\n")
+            replace_path(tmp_path, self.log_path)
+
+        return state, events
+
+    def append(self, event : Dict[str, Any]):
+        """
+        Log an event. It is written out immediately, but only guaranteed to be on disk after next sync.
+        """
+        with self.lock:
+            if self.log_file is None:
+                self.log_file = open(self.log_path, "a")
+            self.seq += 1
+            event["seq"] = self.seq
+            self.log_file.write(json.dumps(event) + "\n")
+            self.log_file.flush()
+            self.events_since_snapshot += 1
+
+    def sync(self):
+        """
+        Make sure all logged events are on disk.
+        """
+        with self.lock:
+            if self.log_file is not None:
+                os.fsync(self.log_file.fileno())
+
+    def snapshot_due(self) -> bool:
+        return self.events_since_snapshot >= self.snapshot_every
+
+    def snapshot(self, state : Dict[str, Any]):
+        """
+        Atomically write a snapshot of state, which must include every event logged so far, then clear the log.
+        """
+        with self.lock:
+            tmp_path = self.state_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"seq" : self.seq, "state" : state}, f)
+            replace_path(tmp_path, self.state_path)
+
+            if self.log_file is not None:
+                self.log_file.close()
+            self.log_file = open(self.log_path, "w")
+            self.events_since_snapshot = 0
+
+    def close(self):
+        self.sync()
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
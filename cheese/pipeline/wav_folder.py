@@ -1,9 +1,8 @@
 from abc import abstractmethod
-from typing import Iterable, Dict, Any
+from typing import Iterable, Dict, Any, List
 
 import pandas as pd
 import os
-import joblib
 from datasets import load_from_disk, Dataset
 
 import numpy as np
@@ -28,9 +27,12 @@ class WavFolderPipeline(DatasetPipeline):
 
     :param force_new: Whether to force a new dataset (as opposed to recovering saved progress from write_path)
     :type force_new: bool
+
+    Which files have been labelled is kept in a write-ahead log beside write_path, so on resume every file that was
+    not posted is served again.
     """
-    def __init__(self, read_path : str, write_path : str, force_new : bool = False):
-        super().__init__()
+    def __init__(self, read_path : str, write_path : str, force_new : bool = False, **kwargs):
+        super().__init__(**kwargs)
 
         self.read_path = read_path
         self.write_path = write_path
@@ -39,23 +41,25 @@ class WavFolderPipeline(DatasetPipeline):
         # Result will be a dataset containing rows of form
         # ([file].wav, rating, comment, more comments...)
 
-        self.total_items = len(os.listdir(self.read_path))
-        try:
-            assert not force_new
-            assert self.load_dataset()
-            self.index_book = joblib.load("save_data/index_book.joblib")
-        except:
-            
+        self.index_book : Dict[int, List] = None
+        if not force_new:
+            self.load_dataset()
+        self.start_progress_log(resume = not force_new)
+
+        if self.index_book is None:
             # Objects for keeping track of what data has been processed
-            safe_mkdir("save_data")
             self.index_book = {}
             for i, path in enumerate(filter(valid_audio_file, os.listdir(self.read_path))):
                 self.index_book[i] = [path, False] # Path and status (i.e. has it been labelled yet)
+
+            # Files are listed in no particular order, so this one has to be kept
+            self.checkpoint(force = True)
+        self.total_items = len(self.index_book)
         
         # From index book, build queue in terms of ids
         print("Preparing Data Queue")
         self.id_queue = []
-        for i in range(self.total_items):
+        for i in sorted(self.index_book):
             _, done = self.index_book[i]
             if not done:
                 self.id_queue.append(i)
@@ -63,13 +67,15 @@ class WavFolderPipeline(DatasetPipeline):
     def exhausted(self) -> bool:
         return not self.id_queue
 
-    def save_dataset(self):
-        """
-        Saves result dataset, as well as (in specific case of WavFolderPipeline) an index book of which audio files have been 
-        looked at so far
-        """
-        super().save_dataset()
-        joblib.dump(self.index_book, "save_data/index_book.joblib")
+    def checkpoint_state(self) -> Dict[str, Any]:
+        return {"index_book" : [[id, path, done] for id, (path, done) in self.index_book.items()]}
+
+    def restore_state(self, state : Dict[str, Any]):
+        self.index_book = {id : [path, done] for id, path, done in state["index_book"]}
+
+    def replay_event(self, event : Dict[str, Any]):
+        if "post" in event:
+            self.index_book[event["post"]][1] = True
 
     @abstractmethod
     def fetch(self) -> BatchElement:
@@ -100,9 +106,7 @@ class WavFolderPipeline(DatasetPipeline):
         """
         Given a row to add to dataset, marks corresponding entry in index_book complete
         """
-        path, _ = self.index_book[id]
-        self.add_row_to_dataset(row)
-
         self.index_book[id][1] = True
-        self.save_dataset()
+        self.add_row_to_dataset(row)
+        self.log_event({"post" : id, "rows" : self.num_rows()})
 
@@ -28,7 +28,7 @@ class WriteOnlyPipeline(DatasetPipeline):
         try:
             assert not force_new
             assert self.load_dataset()
-            print(f"Succesfully loaded dataset with {len(self.res_dataset)} entries.")
+            print(f"Succesfully loaded dataset with {self.num_rows()} entries.")
         except:
             pass
 
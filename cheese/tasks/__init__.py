@@ -15,7 +15,15 @@ class Task:
 
     :param terminate: A flag to tell the client to terminate
     :type terminate: bool
+
+    :param waiting: A flag to tell the client there is no task for it yet, and that it should ask again later
+    :type waiting: bool
+
+    :param fetch_id: Set by pipelines that log their progress, to tell which fetched element is being posted
+    :type fetch_id: int
     """
     data : BatchElement = None
     client_id : int = -1
     terminate : bool = False
+    waiting : bool = False
+    fetch_id : int = -1
@@ -0,0 +1,97 @@
+from abc import abstractmethod
+from typing import Callable, Union
+
+class Publisher:
+    """
+    Abstract base class for the sending end of a channel. Messages are published to some routing key
+    and delivered to every subscriber bound to this publisher with that routing key.
+    """
+    @abstractmethod
+    def publish(self, routing_key : str, payload : Union[str, bytes]):
+        """
+        Publish a payload under given routing key.
+
+        :param routing_key: Routing key for message (i.e. 'pipeline', 'client', 'model', 'active', 'main', 'api')
+        :type routing_key: str
+
+        :param payload: Message contents
+        :type payload: Union[str, bytes]
+        """
+        pass
+
+class Subscriber:
+    """
+    Abstract base class for the receiving end of a channel.
+    The event listener is called with message objects whose contents are found in their body attribute.
+    """
+    @abstractmethod
+    def subscribe_on_thread(self):
+        """
+        Start consuming messages on a separate thread.
+        """
+        pass
+
+class Transport:
+    """
+    Abstract base class for the messaging layer that connects the components of CHEESE (pipeline, clients, model, main object and API).
+    Routing works as it does with RabbitMQ topic exchanges: each publisher has a name,
+    and subscribers bind to a (publisher name, routing key) pair.
+    """
+    @abstractmethod
+    def publisher(self, publisher_name : str) -> Publisher:
+        """
+        Create a publisher.
+
+        :param publisher_name: Name that subscribers will use to bind to this publisher
+        :type publisher_name: str
+        """
+        pass
+
+    @abstractmethod
+    def subscriber(self, routing_key : str, publisher_name : str, event_listener : Callable) -> Subscriber:
+        """
+        Create a subscriber. Subscribers with the same routing key and publisher name share one queue,
+        so each message is consumed by only one of them.
+
+        :param routing_key: Routing key to listen for
+        :type routing_key: str
+
+        :param publisher_name: Name of publisher to listen to
+        :type publisher_name: str
+
+        :param event_listener: Callback for received messages
+        :type event_listener: Callable
+        """
+        pass
+
+    def close(self):
+        """
+        Release any resources held by the transport.
+        """
+        pass
+
+def make_transport(transport : Union[str, Transport] = "rabbitmq", host : str = 'localhost', port : int = 5672) -> Transport:
+    """
+    Create a transport from its name. Transport objects are returned as is.
+
+    :param transport: "rabbitmq" to use a RabbitMQ server, "in_process" when every component runs in a single Python process,
+        or an existing Transport
+    :type transport: Union[str, Transport]
+
+    :param host: Host for rabbitmq server
+    :type host: str
+
+    :param port: Port for rabbitmq server
+    :type port: int
+    """
+    if isinstance(transport, Transport):
+        return transport
+
+    if transport == "rabbitmq":
+        from cheese.transport.rabbit import RabbitTransport
+        return RabbitTransport(host = host, port = port)
+    elif transport == "in_process":
+        from cheese.transport.in_process import InProcessTransport
+        return InProcessTransport()
+
+    raise Exception(f"Error: Unknown transport {transport}")
@@ -0,0 +1,95 @@
+from typing import Callable, Dict, List, Tuple, Union
+from dataclasses import dataclass
+
+import threading
+import queue
+
+from cheese.transport import Transport, Publisher, Subscriber
+
+@dataclass
+class InProcessMessage:
+    """
+    Stand-in for a RabbitMQ message so callbacks decorated with rabbitmq_callback work unchanged.
+    """
+    body : bytes = None
+
+class InProcessPublisher(Publisher):
+    def __init__(self, transport, publisher_name : str):
+        self.transport : InProcessTransport = transport
+        self.publisher_name = publisher_name
+
+    def publish(self, routing_key : str, payload : Union[str, bytes]):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+
+        self.transport.get_queue(self.publisher_name, routing_key).put(InProcessMessage(payload))
+        return True
+
+class InProcessSubscriber(Subscriber):
+    def __init__(self, transport, routing_key : str, publisher_name : str, event_listener : Callable):
+        self.transport : InProcessTransport = transport
+        self.queue : queue.Queue = transport.get_queue(publisher_name, routing_key)
+        self.event_listener = event_listener
+        self.thread : threading.Thread = None
+
+    def consume(self):
+        while True:
+            msg = self.queue.get()
+            if msg is None:
+                # Shutdown signal
+                break
+            try:
+                self.event_listener(msg)
+            except Exception as e:
+                # Mirror RabbitMQ subscribers, where an exception in a callback only affects that message
+                print(f"Warning: Exception in in-process subscriber callback: {repr(e)}")
+
+    def subscribe_on_thread(self):
+        self.thread = threading.Thread(target = self.consume, daemon = True)
+        self.thread.start()
+        self.transport.add_subscriber(self)
+
+class InProcessTransport(Transport):
+    """
+    Transport for when pipeline, clients, model and main object all live in one Python process.
+    Every (publisher name, routing key) pair is backed by a thread-safe queue, so there
+    is no broker round trip and no RabbitMQ server is needed. Messages published before
+    any subscriber exists are kept until one subscribes, as with a durable RabbitMQ queue.
+    """
+    def __init__(self):
+        self.queues : Dict[Tuple[str, str], queue.Queue] = {}
+        self.subscribers : List[InProcessSubscriber] = []
+        self.lock = threading.Lock()
+
+    def get_queue(self, publisher_name : str, routing_key : str) -> queue.Queue:
+        """
+        Get queue for a (publisher name, routing key) pair, creating it if it does not exist yet.
+        """
+        key = (publisher_name, routing_key)
+        with self.lock:
+            if key not in self.queues:
+                self.queues[key] = queue.Queue()
+            return self.queues[key]
+
+    def add_subscriber(self, subscriber : InProcessSubscriber):
+        with self.lock:
+            self.subscribers.append(subscriber)
+
+    def publisher(self, publisher_name : str) -> InProcessPublisher:
+        return InProcessPublisher(self, publisher_name)
+
+    def subscriber(self, routing_key : str, publisher_name : str, event_listener : Callable) -> InProcessSubscriber:
+        return InProcessSubscriber(self, routing_key, publisher_name, event_listener)
+
+    def close(self):
+        """
+        Stop all subscriber threads once they have handled the messages already queued.
+        """
+        with self.lock:
+            subscribers = self.subscribers
+            self.subscribers = []
+
+        for subscriber in subscribers:
+            subscriber.queue.put(None)
+        for subscriber in subscribers:
+            subscriber.thread.join()
@@ -0,0 +1,35 @@
+from typing import Callable
+
+from b_rabbit import BRabbit
+
+from cheese.transport import Transport, Publisher, Subscriber
+
+class RabbitTransport(Transport):
+    """
+    Transport backed by a RabbitMQ server through BRabbit.
+
+    :param host: Host for rabbitmq server. Normally just locahost if you are running locally
+    :type host: str
+
+    :param port: Port to run rabbitmq server on
+    :type port: int
+    """
+    def __init__(self, host : str = 'localhost', port : int = 5672):
+        self.connection = BRabbit(host=host, port=port)
+
+    def publisher(self, publisher_name : str) -> Publisher:
+        return self.connection.EventPublisher(
+            b_rabbit = self.connection,
+            publisher_name = publisher_name
+        )
+
+    def subscriber(self, routing_key : str, publisher_name : str, event_listener : Callable) -> Subscriber:
+        return self.connection.EventSubscriber(
+            b_rabbit = self.connection,
+            routing_key = routing_key,
+            publisher_name = publisher_name,
+            event_listener = event_listener
+        )
+
+    def close(self):
+        self.connection.close_connection()
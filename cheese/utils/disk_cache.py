@@ -0,0 +1,171 @@
+from typing import Any, Dict
+from collections import OrderedDict
+
+from PIL import Image
+import numpy as np
+
+import threading
+import hashlib
+import pickle
+import json
+import os
+
+def key_default(obj : Any) -> Any:
+    """
+    Describe an object JSON can't serialize, for use in a key. Arrays, images and bytes are described by a hash of their
+    raw contents along with their shape and type, since their repr leaves out most of their contents.
+    """
+    if isinstance(obj, np.ndarray):
+        if obj.dtype == object:
+            return obj.tolist()
+        return {
+            "ndarray" : hashlib.sha256(np.ascontiguousarray(obj).tobytes()).hexdigest(),
+            "dtype" : obj.dtype.str, "shape" : obj.shape
+        }
+    if isinstance(obj, Image.Image):
+        return {"image" : hashlib.sha256(obj.tobytes()).hexdigest(), "mode" : obj.mode, "size" : obj.size}
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return {"bytes" : hashlib.sha256(obj).hexdigest()}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise Exception(
+        f"Error: Can't make key from object of type {type(obj).__name__}. "
+        "Keys must be made of JSON serializable values, arrays, images and bytes"
+    )
+
+class GenerationCache:
+    """
+    Content-addressed disk cache for generations (also used by models to memoize results). Each generation is pickled
+    to its own file, named by a hash of everything that determines it (see make_key). Once the cache is over max_bytes, least recently used generations
+    are evicted. Files are written beside their final path and then moved into place, so an interrupted write never
+    leaves a partial entry. Since entries are pickled, only use a cache directory you trust.
+
+    :param path: Directory to keep cache in
+    :type path: str
+
+    :param max_bytes: Most bytes of pickled generations to keep
+    :type max_bytes: int
+    """
+    def __init__(self, path : str, max_bytes : int = 2 ** 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok = True)
+
+        self.lock = threading.Lock()
+        self.index : OrderedDict[str, int] = OrderedDict() # Key -> size of entry, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        # Rebuild index from last run, with recency taken from modification times (entries are touched when used)
+        entries = []
+        for name in os.listdir(self.path):
+            file_path = os.path.join(self.path, name)
+            if name.endswith(".tmp"):
+                os.remove(file_path)
+            elif name.endswith(".pkl"):
+                stat = os.stat(file_path)
+                entries.append((stat.st_mtime, name[:-len(".pkl")], stat.st_size))
+        for _, key, size in sorted(entries):
+            self.index[key] = size
+            self.total_bytes += size
+        self.evict()
+
+    @staticmethod
+    def make_key(description : Any) -> str:
+        """
+        Key for a generation from a JSON serializable description of everything that determines it
+        (i.e. prompt, seed and generator config). Arrays, images and bytes in it are hashed by their contents.
+        Raises for anything else that isn't JSON serializable, rather than risk two different values sharing a key.
+        """
+        return hashlib.sha256(json.dumps(description, sort_keys = True, default = key_default).encode("utf-8")).hexdigest()
+
+    def file_path(self, key : str) -> str:
+        return os.path.join(self.path, key + ".pkl")
+
+    def get(self, key : str) -> Any:
+        """
+        Get cached generation, or None if it isn't cached.
+        """
+        with self.lock:
+            if key not in self.index:
+                self.misses += 1
+                return None
+            try:
+                with open(self.file_path(key), "rb") as f:
+                    value = pickle.load(f)
+            except Exception:
+                # Entry is unreadable (i.e. removed from outside the cache), so drop it
+                self.drop(key)
+                self.misses += 1
+                return None
+            self.mark_used(key)
+            self.hits += 1
+            return value
+
+    def put(self, key : str, value : Any):
+        """
+        Cache a generation under key, evicting least recently used ones if the cache is over its size.
+        """
+        data = pickle.dumps(value, protocol = pickle.HIGHEST_PROTOCOL)
+        tmp_path = self.file_path(key) + f".{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.file_path(key))
+
+        with self.lock:
+            if key in self.index:
+                self.total_bytes -= self.index[key]
+            self.index[key] = len(data)
+            self.index.move_to_end(key)
+            self.total_bytes += len(data)
+            self.evict()
+
+    def touch(self, key : str) -> bool:
+        """
+        Mark generation as just used, so it is the last to be evicted.
+
+        :return: Whether generation is cached
+        :rtype: bool
+        """
+        with self.lock:
+            if key not in self.index:
+                return False
+            self.mark_used(key)
+            return True
+
+    def mark_used(self, key : str):
+        """
+        Should be called with lock held.
+        """
+        self.index.move_to_end(key)
+        try:
+            os.utime(self.file_path(key))
+        except OSError:
+            pass
+
+    def drop(self, key : str):
+        """
+        Remove entry. Should be called with lock held.
+        """
+        self.total_bytes -= self.index.pop(key)
+        try:
+            os.remove(self.file_path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        """
+        Remove least recently used entries until cache is within max_bytes. Should be called with lock held.
+        """
+        while self.total_bytes > self.max_bytes and self.index:
+            self.drop(next(iter(self.index)))
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "entries" : len(self.index),
+                "bytes" : self.total_bytes,
+                "hits" : self.hits,
+                "misses" : self.misses
+            }
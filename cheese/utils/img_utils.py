@@ -1,11 +1,338 @@
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict, deque
+
 from PIL import Image
+from requests.adapters import HTTPAdapter
 import requests
 from io import BytesIO
 
-def url2img(url : str, timeout = 1) -> Image:
+import threading
+import hashlib
+import time
+import os
+
+# Responses worth trying again, since the server may well give the image next time
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+class ImageFetcher:
+    """
+    Fetches images from URLs over a pooled HTTP session, on a pool of worker threads. Images are validated,
+    shrunk to fit display_size (so clients are not sent anything larger than they show) and kept in a
+    size bounded LRU memory cache, as well as a disk cache if cache_dir is given. Requests that fail in a way that may
+    not happen again (i.e. timeouts, dropped connections, 503s) are retried with exponential backoff. URLs that still
+    fail to give a valid image are remembered as dead for a while.
+
+    :param display_size: Largest width and height images are shown at. Larger images are shrunk to fit,
+        keeping their aspect ratio. If None, images are kept at their original size.
+    :type display_size: Tuple[int, int]
+
+    :param cache_dir: Directory for disk cache. If None, only the memory cache is used.
+    :type cache_dir: str
+
+    :param cache_bytes: Most bytes of encoded images to keep in the memory cache
+    :type cache_bytes: int
+
+    :param timeout: Timeout in seconds for each request
+    :type timeout: float
+
+    :param max_workers: Number of images fetched at once. Also the size of the connection pool.
+    :type max_workers: int
+
+    :param retries: Number of times to retry a request after a transient failure
+    :type retries: int
+
+    :param backoff: Seconds to wait before first retry, doubling with each one after
+    :type backoff: float
+
+    :param dead_ttl: Seconds a URL is considered dead for before it is tried again
+    :type dead_ttl: float
+
+    :param max_dead: Most dead URLs to remember. Once there are more, the ones marked dead longest ago are forgotten.
+    :type max_dead: int
+    """
+    def __init__(
+        self, display_size : Tuple[int, int] = None, cache_dir : str = None,
+        cache_bytes : int = 256 * 2 ** 20, timeout : float = 5.0, max_workers : int = 8,
+        retries : int = 2, backoff : float = 0.5, dead_ttl : float = 600.0, max_dead : int = 100000
+        ):
+        self.display_size = display_size
+        self.cache_dir = cache_dir
+        self.cache_bytes = cache_bytes
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.dead_ttl = dead_ttl
+        self.max_dead = max_dead
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = max_workers, pool_maxsize = max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers = max_workers)
+
+        self.lock = threading.Lock()
+        self.cache : OrderedDict[str, bytes] = OrderedDict() # URL -> encoded image, least recently used first
+        self.cached_bytes = 0
+        self.in_flight : Dict[str, Future] = {} # URL -> future for fetch in progress
+        self.dead : OrderedDict[str, float] = OrderedDict() # URL -> when it was marked dead, oldest first
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok = True)
+
+    def disk_path(self, url : str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".png")
+
+    def cache_put(self, url : str, data : bytes):
+        """
+        Add encoded image to memory cache, evicting least recently used images to stay within cache_bytes.
+        Should be called with lock held.
+        """
+        if url in self.cache:
+            return
+        self.cache[url] = data
+        self.cached_bytes += len(data)
+        while self.cached_bytes > self.cache_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last = False)
+            self.cached_bytes -= len(evicted)
+
+    def is_dead(self, url : str) -> bool:
+        """
+        Was URL marked dead less than dead_ttl seconds ago? Should be called with lock held.
+        """
+        marked = self.dead.get(url)
+        if marked is None:
+            return False
+        if time.time() - marked < self.dead_ttl:
+            return True
+        del self.dead[url]
+        return False
+
+    def mark_dead(self, url : str):
+        """
+        Should be called with lock held.
+        """
+        self.dead[url] = time.time()
+        self.dead.move_to_end(url)
+        while len(self.dead) > self.max_dead:
+            self.dead.popitem(last = False)
+
+    def request(self, url : str) -> requests.Response:
+        """
+        Get URL, retrying with exponential backoff after timeouts, dropped connections and statuses in RETRY_STATUSES.
+        Raises once out of retries, or straight away for any other error.
+        """
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                response = self.session.get(url, timeout = self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if last:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or last:
+                    response.raise_for_status()
+                    return response
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def download(self, url : str) -> bytes:
+        """
+        Download and validate image, shrink it to display size and encode it as PNG. Raises if it is not a valid image.
+        """
+        response = self.request(url)
+
+        img = Image.open(BytesIO(response.content))
+        img.load() # Decodes whole image, so truncated or corrupt images fail here
+        if self.display_size is not None:
+            img.thumbnail(self.display_size)
+        if img.mode not in ["RGB", "RGBA", "L", "LA", "P"]:
+            img = img.convert("RGB")
+
+        out = BytesIO()
+        img.save(out, format = "PNG")
+        return out.getvalue()
+
+    def fetch_bytes(self, url : str) -> Optional[bytes]:
+        """
+        Worker for prefetch. Gets encoded image from disk cache or by downloading it. Returns None if URL is dead,
+        or if fetching failed some other way, in which case it is not marked dead and is tried again next time.
+        Failing to read or write the disk cache only gives a warning.
+        """
+        data, dead = None, False
+        try:
+            if self.cache_dir is not None and os.path.exists(self.disk_path(url)):
+                data = self.read_cached(url)
+
+            if data is None:
+                try:
+                    data = self.download(url)
+                except (requests.RequestException, OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+                    # Server refused image even after retries, or what it sent is not a valid image
+                    dead = True
+                else:
+                    if self.cache_dir is not None:
+                        self.write_cached(url, data)
+        except Exception as e:
+            print(f"Warning: Could not fetch image from {url}: {repr(e)}")
+
+        with self.lock:
+            if dead:
+                self.mark_dead(url)
+            elif data is not None:
+                self.cache_put(url, data)
+            self.in_flight.pop(url, None)
+        return data
+
+    def read_cached(self, url : str) -> Optional[bytes]:
+        """
+        Read encoded image from disk cache, or None if it can't be read.
+        """
+        try:
+            with open(self.disk_path(url), "rb") as f:
+                data = f.read()
+        except OSError as e:
+            print(f"Warning: Could not read cached image for {url}, downloading it again: {repr(e)}")
+            return None
+        with self.lock:
+            self.disk_hits += 1
+        return data
+
+    def write_cached(self, url : str, data : bytes):
+        """
+        Write encoded image to disk cache. If that fails, image is only kept in memory.
+        """
+        tmp_path = self.disk_path(url) + f".{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.disk_path(url))
+        except OSError as e:
+            print(f"Warning: Could not cache image for {url} on disk: {repr(e)}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def prefetch(self, url : str) -> Future:
+        """
+        Start fetching an image in the background, if it isn't cached or being fetched already.
+
+        :return: Future for encoded image, which is None if URL is dead
+        :rtype: Future
+        """
+        with self.lock:
+            if url in self.cache:
+                self.cache.move_to_end(url)
+                self.hits += 1
+                future = Future()
+                future.set_result(self.cache[url])
+                return future
+            if self.is_dead(url):
+                future = Future()
+                future.set_result(None)
+                return future
+            if url in self.in_flight:
+                return self.in_flight[url]
+
+            self.misses += 1
+            future = self.executor.submit(self.fetch_bytes, url)
+            self.in_flight[url] = future
+            return future
+
+    def get_bytes(self, url : str) -> Optional[bytes]:
+        """
+        Get encoded image for URL, fetching it if needed. Returns None if URL is dead.
+        """
+        return self.prefetch(url).result()
+
+    def get(self, url : str) -> Optional[Image.Image]:
+        """
+        Get image for URL, fetching it if needed. Returns None if URL is dead.
+        """
+        data = self.get_bytes(url)
+        return None if data is None else Image.open(BytesIO(data))
+
+    def is_alive(self, url : str) -> bool:
+        """
+        Does URL give a valid image? Fetches it if needed. URLs that have been dead for over dead_ttl are tried again.
+        """
+        return self.get_bytes(url) is not None
+
+    def filter_alive(self, iterable : Iterable, key : Callable[[Any], Any] = None, lookahead : int = 16) -> Iterator:
+        """
+        Iterate over items, skipping those with any dead image URLs. Images for the next lookahead items are fetched
+        concurrently, so by the time an item is reached its images are usually cached. Items keep their order.
+
+        :param iterable: Items to filter
+        :type iterable: Iterable
+
+        :param key: Gets URL, or list of URLs, from an item. Defaults to the item itself.
+        :type key: Callable[[Any], Any]
+
+        :param lookahead: Number of upcoming items to fetch images for
+        :type lookahead: int
+        """
+        def urls(item):
+            res = item if key is None else key(item)
+            return [res] if isinstance(res, str) else list(res)
+
+        pending = deque()
+        iterator = iter(iterable)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < lookahead:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append((item, [self.prefetch(url) for url in urls(item)]))
+
+            if not pending:
+                return
+
+            item, futures = pending.popleft()
+            if all(future.result() is not None for future in futures):
+                yield item
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "cached_images" : len(self.cache),
+                "cached_bytes" : self.cached_bytes,
+                "hits" : self.hits,
+                "disk_hits" : self.disk_hits,
+                "misses" : self.misses,
+                "dead" : len(self.dead),
+                "in_flight" : len(self.in_flight)
+            }
+
+    def close(self):
+        self.executor.shutdown(wait = False, cancel_futures = True)
+        self.session.close()
+
+default_fetcher : ImageFetcher = None
+default_fetcher_lock = threading.Lock()
+
+def get_default_fetcher() -> ImageFetcher:
     """
-    Turn URL into PIL image. Can throw a timout error.
+    Shared ImageFetcher used by url2img, created on first use.
     """
+    global default_fetcher
+    with default_fetcher_lock:
+        if default_fetcher is None:
+            default_fetcher = ImageFetcher()
+        return default_fetcher
 
-    response = requests.get(url, timeout = timeout)
-    return Image.open(BytesIO(response.content))
+def url2img(url : str, timeout = 1, fetcher : ImageFetcher = None) -> Image:
+    """
+    Turn URL into PIL image, through fetcher's session and cache (by default a shared one).
+    Can throw a timeout error, or an error if URL does not give a valid image.
+    """
+    fetcher = fetcher if fetcher is not None else get_default_fetcher()
+    data = fetcher.prefetch(url).result(timeout = timeout)
+    if data is None:
+        raise Exception(f"Error: Could not fetch a valid image from {url}")
+    return Image.open(BytesIO(data))
@@ -1,3 +1,6 @@
+from dataclasses import dataclass
+from typing import Any, Tuple
+
 # Constants for basic messages
 SENT = "0"
 RECEIVED = "1"
@@ -8,4 +11,47 @@ LAUNCH = "launch"
 ADD = "add"
 REMOVE = "remove"
 STATS = "stats"
-DRAW = "draw"
\ No newline at end of file
+DRAW = "draw"
+ADD_MANY = "add_many"
+REMOVE_MANY = "remove_many"
+
+@dataclass
+class APIRequest:
+    """
+    Command sent from API to main server.
+
+    :param command: One of the API command constants above
+    :type command: str
+
+    :param args: Arguments for the command
+    :type args: Tuple
+
+    :param request_id: Unique ID for this request. The response carries the same ID so it can be matched to its caller.
+    :type request_id: str
+
+    :param reply_to: Routing key the response is published to, so it reaches the API that sent the request
+        even when several share a connection. Defaults to 'api'.
+    :type reply_to: str
+    """
+    command : str = None
+    args : Tuple = ()
+    request_id : str = None
+    reply_to : str = None
+
+@dataclass
+class APIResponse:
+    """
+    Result of an APIRequest sent back from main server.
+
+    :param request_id: ID of the request this responds to
+    :type request_id: str
+
+    :param result: Return value of the command
+    :type result: Any
+
+    :param error: If the command raised an exception, a description of it
+    :type error: str
+    """
+    request_id : str = None
+    result : Any = None
+    error : str = None
@@ -8,7 +8,7 @@ from cheese import CHEESE
 from dataclasses import dataclass
 
 from PIL import Image
-from cheese.utils.img_utils import url2img
+from cheese.utils.img_utils import ImageFetcher
 
 import gradio as gr
 import datasets
@@ -20,6 +20,10 @@ import time
     is not loading for them, they will be given an error button to specify they are not seeing any data.
 """
 
+# Images are shrunk to the size they are shown at, and cached in this directory
+DISPLAY_SIZE = (256, 256)
+IMG_CACHE_DIR = "./img_cache"
+
 # BatchElement should store everything you want to write to result dataset
 # And everything you want to show the labeller
 # Ensure every field has a default value
@@ -34,10 +38,19 @@ class ImageSelectionBatchElement(BatchElement):
     time : float = 0 # Time in seconds it took for user to select image
 
 class ImageSelectionPipeline(IterablePipeline):
+    def __init__(self, iter, **kwargs):
+        # Fetches images on a pool of threads and caches them, so labellers are not kept waiting on downloads
+        self.fetcher = ImageFetcher(display_size = DISPLAY_SIZE, cache_dir = IMG_CACHE_DIR)
+
+        # Iterator is used as is, so resuming can still skip straight to where it left off
+        super().__init__(iter, **kwargs)
+
     def preprocess(self, x):
         """
         Preprocess is called as soon as a new data element is drawn from iterator.
         """
+        # Start downloading image now, so both images of a pair download at once
+        self.fetcher.prefetch(x["URL"])
         return x["URL"]
     
     def fetch(self) -> ImageSelectionBatchElement:
@@ -51,7 +64,20 @@ class ImageSelectionPipeline(IterablePipeline):
         url2 = self.fetch_next()
         
         res = ImageSelectionBatchElement(img1_url = url1, img2_url = url2)
+        # Pairs with a dead link are still fetched, so every element covers the same rows of the iterator when resuming
+        res.error = any(url is not None and not self.fetcher.is_alive(url) for url in [url1, url2])
         return res
+
+    def fetch_element(self) -> ImageSelectionBatchElement:
+        """
+        Pairs with a dead link are posted straight away rather than shown to labellers. Post leaves them out of the
+        result dataset, but marks them done so they are not fetched again after a restart.
+        """
+        while True:
+            be = super().fetch_element()
+            if not be.error or self.exhausted():
+                return be
+            self.post_element(be)
     
     def post(self, be : ImageSelectionBatchElement):
         """
@@ -76,6 +102,10 @@ def make_iter():
 
 # The Front object is what will be responsible for showing data to the labeller and collecting their responses
 class ImageSelectionFront(GradioFront):
+    def __init__(self, *args, **kwargs):
+        # Pipeline fetched the images ahead of time, so they are read from the disk cache they share
+        self.fetcher = ImageFetcher(display_size = DISPLAY_SIZE, cache_dir = IMG_CACHE_DIR)
+        super().__init__(*args, **kwargs)
 
     # main() is where you create your UI
     def main(self):
@@ -145,10 +175,10 @@ class ImageSelectionFront(GradioFront):
         return task
     
     # Response finally calls present to create outputs for gradio to show user
-    # In this example, this is simply the next left and right image
+    # In this example, this is simply the next left and right image (already fetched and cached)
     def present(self, task):
         data : ImageSelectionBatchElement = task.data
-        return [data.img1_url, data.img2_url]
+        return [self.fetcher.get(data.img1_url), self.fetcher.get(data.img2_url)]
 
 if __name__ == "__main__":
     # The pipeline kwargs are inherited from IterablePipeline
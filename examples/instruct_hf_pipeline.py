@@ -5,7 +5,8 @@
 """
 
 from dataclasses import dataclass
-from typing import List, Iterable
+from typing import Callable, List, Iterable
+from functools import partial
 
 from transformers import pipeline
 import gradio as gr
@@ -21,6 +22,24 @@ class LMGenerationElement(BatchElement):
     completions : List[str] = None
     rankings : List[int] = None # Ordering for the completions w.r.t indices
 
+def load_generator(n_samples : int = 5, device : int = -1) -> Callable[[List[str]], List[LMGenerationElement]]:
+    """
+    Load language model and return a function generating a batch of elements from a batch of queries.
+    Module level so that worker processes can each load their own.
+    """
+    pipe = pipeline(task="text-generation", model = 'gpt2', device = device)
+    pipe.tokenizer.pad_token_id = pipe.model.config.eos_token_id
+
+    def generate(model_input : List[str]) -> List[LMGenerationElement]:
+        elements = []
+        for query in model_input:
+            completions = pipe(query, max_length=100, num_return_sequences=n_samples)
+            completions = [completion["generated_text"][len(query):] for completion in completions]
+            elements.append(LMGenerationElement(query=query, completions=completions))
+        return elements
+
+    return generate
+
 class LMPipeline(GenerativePipeline):
     """
     Pipeline for doing language model generation.
@@ -32,16 +51,16 @@ class LMPipeline(GenerativePipeline):
     :param device: Device to use for inference (any n > -1 uses cuda device n, -1 uses cpu). Defaults to 0.
     :type device: int
 
-    :param kwargs: Keyword arguments to pass to GenerativePipeline
+    :param kwargs: Keyword arguments to pass to GenerativePipeline. With num_workers (i.e. on CPU nodes),
+    each worker process loads its own model.
     :type kwargs: dict
     """
     def __init__(self, n_samples = 5, device : int = 0, **kwargs):
-        super().__init__(**kwargs)
+        super().__init__(make_generator = partial(load_generator, n_samples, device), **kwargs)
 
         self.n_samples = n_samples
-        self.pipe = pipeline(task="text-generation", model = 'gpt2')
-        self.pipe.tokenizer.pad_token_id = self.pipe.model.config.eos_token_id
-        
+        # Model is only needed in this process if there are no workers to generate with
+        self.generator = load_generator(n_samples, device) if self.num_workers == 0 else None
 
         self.init_buffer()
 
@@ -49,14 +68,7 @@ class LMPipeline(GenerativePipeline):
         """
         Generates a batch of elements using the pipeline's iterator.
         """
-        print("Generate called")
-        elements = []
-        for i in range(self.batch_size):
-            query = model_input[i]
-            completions = self.pipe(query, max_length=100, num_return_sequences=self.n_samples)
-            completions = [completion["generated_text"][len(query):] for completion in completions]
-            elements.append(LMGenerationElement(query=query, completions=completions))
-        return elements
+        return self.generator(model_input)
     
     def extract_data(self, batch_element : LMGenerationElement) -> dict:
         """
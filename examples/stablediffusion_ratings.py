@@ -13,7 +13,7 @@ from diffusers import StableDiffusionPipeline
 import torch
 import numpy as np
 import joblib
-import random
+import zlib
 import gradio as gr
 import datasets
 
@@ -32,10 +32,9 @@ class SDGenerationElement(BatchElement):
     seed : int = None
     img : Image.Image = None
     rating : float = -1
-    # The following attributes are important for
-    # reproducability if image is not saved
-    # Seed and these two attributes are sufficient
-    # to reproduce same images
+    # Each image has its own seed, so prompt and seed
+    # are sufficient to reproduce it if image is not saved,
+    # whatever batch it was generated in
     batch_size : int = 1
     batch_index : int = 0
 
@@ -43,7 +42,7 @@ class SDPipeline(GenerativePipeline):
     """
     Stable Diffusion Pipeline. See GenerativePipeline for all arguments.
     
-    :param iterator: Iterator used for prompting generation
+    :param iterator: Iterator of prompts and the seeds to generate them with (see make_iter)
     :type iterator: Iterable
 
     :param sampling_steps: The number of sampling steps to take for each image
@@ -73,27 +72,38 @@ class SDPipeline(GenerativePipeline):
         Given some input (potentially batched), generate
         a batch of images in the form of a list of data elements
         """
-        prompts = model_input
-        seed = random.randint(0, 2**32 - 1)
-        generator = torch.Generator("cuda").manual_seed(seed)
+        prompts = [x["prompt"] for x in model_input]
+        seeds = [x["seed"] for x in model_input]
+        # One generator per image, so each image depends only on its own prompt and seed
+        generators = [torch.Generator("cuda").manual_seed(seed) for seed in seeds]
 
         imgs = self.txt2img_pipeline(
             prompts,
             num_inference_steps = self.sampling_steps,
-            generator = generator,
+            generator = generators,
             batch_size = self.batch_size
         ).images
 
         return [
             SDGenerationElement(
                 prompt = prompts[i],
-                seed = seed,
+                seed = seeds[i],
                 img = img,
                 batch_size = self.batch_size,
                 batch_index = i
             ) for i, img in enumerate(imgs)
         ]
     
+    def generation_config(self) -> dict:
+        """
+        Settings that determine generations, so cached images are only reused with the same settings.
+        Seeds are part of each input, so they don't need to be part of this.
+        """
+        return {
+            "model" : "CompVis/stable-diffusion-v1-4",
+            "sampling_steps" : self.sampling_steps
+        }
+
     def extract_data(self, batch_element : SDGenerationElement) -> dict:
         """
         Turn a batch element into a dict that will be added as row to
@@ -107,14 +117,21 @@ class SDPipeline(GenerativePipeline):
             "batch_index" : batch_element.batch_index
         }
 
+def make_seed(prompt : str, index : int) -> int:
+    """
+    Seed for the image of a prompt at some index of the prompts. Same prompt and index always give the same seed,
+    so a restarted run generates (and finds cached) the same images, while repeats of a prompt still differ.
+    """
+    return zlib.crc32(f"{index}:{prompt}".encode("utf-8"))
+
 def make_iter():
-    "Create iterator to feed prompts to SDPipeline"
+    "Create iterator to feed prompts, with the seed to generate each one with, to SDPipeline"
     try:
         with open("prompts.txt", "r") as f:
             prompts = f.readlines()
-        return iter(prompts)
     except:
-        return iter(["A beautiful award winning portrait, digital art"] * 20000)
+        prompts = ["A beautiful award winning portrait, digital art"] * 20000
+    return ({"prompt" : prompt, "seed" : make_seed(prompt, i)} for i, prompt in enumerate(prompts))
 
 class SDFront(GradioFront):
     """
@@ -158,7 +175,9 @@ if __name__ == "__main__":
             "buffer_size" : 20,
             "batch_size" : 4,
             "force_new" : True,
-            "log_progress" : True
+            "log_progress" : True,
+            # Images left unrated when stopping are kept here, so they aren't generated again on restart
+            "cache_path" : "./sd_cache"
         },
         gradio = True
     )
@@ -0,0 +1,97 @@
+"""
+    This test script checks that API responses reach the request they answer when many requests are in flight at once,
+    from threads with CHEESEAPI and from coroutines with AsyncCHEESEAPI, including when several APIs share a connection,
+    using the in-process transport.
+"""
+
+from cheese import CHEESE
+from cheese.api import CHEESEAPI
+from cheese.api.async_api import AsyncCHEESEAPI
+from cheese.pipeline import Pipeline
+from cheese.data import BatchElement
+import cheese.utils.msg_constants as msg_constants
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import asyncio
+import time
+
+N_CLIENTS = 32
+
+class EmptyPipeline(Pipeline):
+    def exhausted(self):
+        return True
+
+    def fetch(self):
+        return BatchElement()
+
+    def post(self, be):
+        pass
+
+def settled(api : CHEESEAPI) -> bool:
+    # Requests stop being tracked from a callback that can run just after their result is handed out
+    start = time.time()
+    while api.pending and time.time() - start < 1:
+        time.sleep(0.01)
+    return not api.pending
+
+def make_cheese(listen : bool = True) -> CHEESE:
+    cheese = CHEESE(EmptyPipeline, transport = "in_process")
+    if listen:
+        threading.Thread(target = cheese.start_listening, args = (0.01,), daemon = True).start()
+    return cheese
+
+async def run_async(cheese : CHEESE):
+    api = await AsyncCHEESEAPI.create(transport = cheese.connection, timeout = 5)
+    ids = list(range(2 * N_CLIENTS))
+
+    # Responses resolve the coroutine that sent them, whatever order they come back in
+    credentials = await asyncio.gather(*[api.create_client(id) for id in ids])
+    assert [usr for usr, _ in credentials] == ids
+    assert (await api.get_stats())["num_clients"] == len(ids)
+
+    await asyncio.gather(*[api.remove_client(id) for id in ids[::2]])
+    assert (await api.get_stats())["num_clients"] == len(ids[1::2])
+
+    try:
+        await api.request("not_a_command")
+        assert False, "Failed command did not raise"
+    except Exception as e:
+        assert "Unknown API command" in str(e)
+    assert settled(api)
+
+async def run_async_timeout(cheese : CHEESE):
+    # Server is not listening, so request times out and stops being tracked
+    api = AsyncCHEESEAPI(transport = cheese.connection, timeout = 0.1)
+    try:
+        await api.request(msg_constants.READY)
+        assert False, "Request did not time out"
+    except asyncio.TimeoutError:
+        pass
+    assert settled(api)
+
+if __name__ == "__main__":
+    cheese = make_cheese()
+    api = CHEESEAPI(transport = cheese.connection, timeout = 5)
+
+    # Requests sent from many threads at once each get their own response
+    with ThreadPoolExecutor(max_workers = 8) as executor:
+        credentials = list(executor.map(api.create_client, range(N_CLIENTS)))
+    assert [usr for usr, _ in credentials] == list(range(N_CLIENTS))
+    assert api.get_stats()["num_clients"] == N_CLIENTS
+
+    # Futures can be collected out of order
+    futures = [api.send_request(msg_constants.READY) for _ in range(N_CLIENTS)]
+    assert all(future.result(timeout = 5) for future in reversed(futures))
+    assert settled(api)
+
+    # APIs sharing a connection each get their own responses, even with requests from all of them in flight at once
+    others = [CHEESEAPI(transport = cheese.connection, timeout = 5) for _ in range(3)]
+    futures = [(other, other.send_request(msg_constants.READY)) for other in others for _ in range(N_CLIENTS)]
+    assert all(future.result(timeout = 5) for _, future in futures)
+    assert all(settled(other) for other in others + [api])
+
+    asyncio.run(run_async(make_cheese()))
+    asyncio.run(run_async_timeout(make_cheese(listen = False)))
+
+    print("All Tests Passed")
@@ -0,0 +1,89 @@
+"""
+    This test script checks the shared memory blob store: large fields travel as handles, objects changed
+    after being received are written again, and blobs are reclaimed once released or too old.
+"""
+
+from cheese.codec import encode_task, decode_task, set_blob_store, release_blobs
+from cheese.codec.blob_store import BlobStore
+from cheese.data import BatchElement
+from cheese.tasks import Task
+
+from dataclasses import dataclass
+from PIL import Image
+import numpy as np
+import time
+
+@dataclass
+class ArrayElement(BatchElement):
+    audio : np.ndarray = None
+    clips : list = None
+    image : Image.Image = None
+
+def send(be):
+    return decode_task(encode_task(Task(data = be))).data
+
+def check_mutation(codec):
+    ArrayElement.codec = codec
+    store = BlobStore(threshold = 16)
+    set_blob_store(store)
+
+    be = send(ArrayElement(audio = np.zeros(8), image = Image.new("L", (4, 4))))
+    assert store.get_stats()["num_blobs"] == 2
+
+    # Sending unchanged objects on reuses their blobs
+    be = send(be)
+    assert store.get_stats()["num_blobs"] == 2
+
+    # Received arrays can't be changed in place, only copied
+    try:
+        be.audio[:] = 1
+        assert False, "Received array was changed in place"
+    except ValueError:
+        pass
+    be.audio = be.audio + 1
+    be = send(be)
+    assert np.array_equal(be.audio, np.ones(8))
+    assert store.get_stats()["num_blobs"] == 3
+
+    # Image changed in place is copied by PIL first, so it is written to a new blob and the old one is released
+    be.image.putpixel((0, 0), 255)
+    be = send(be)
+    assert be.image.getpixel((0, 0)) == 255
+    assert store.get_stats()["num_blobs"] == 3
+
+    release_blobs(be)
+    assert store.get_stats()["num_blobs"] == 1 # Blob of the replaced array, which only max_age reclaims
+    store.close()
+
+if __name__ == "__main__":
+    check_mutation("pickle")
+    check_mutation("msgpack")
+    ArrayElement.codec = "pickle"
+
+    store = BlobStore(threshold = 16)
+    set_blob_store(store)
+
+    # Small arrays are sent inline
+    be = send(ArrayElement(audio = np.zeros(1), clips = [np.zeros(8), np.ones(8)]))
+    assert store.get_stats()["num_blobs"] == 2
+
+    # Shared blob is only reclaimed once every reference is released
+    handle = store.handle_of(be.clips[0])
+    store.acquire(handle)
+    release_blobs(be)
+    assert store.get_stats()["num_blobs"] == 1
+    store.release(handle)
+    assert store.get_stats()["num_blobs"] == 0
+
+    # Blobs of elements that are never posted are reclaimed once too old
+    store.max_age = 0.05
+    send(ArrayElement(audio = np.zeros(8)))
+    time.sleep(0.1)
+    send(ArrayElement(audio = np.ones(8)))
+    assert store.get_stats()["num_blobs"] == 1
+
+    store.close()
+    assert store.get_stats()["num_blobs"] == 0
+    set_blob_store(None)
+
+    print("All Tests Passed")
@@ -0,0 +1,70 @@
+"""
+    This test script checks that tasks survive a round trip through each codec, and that receivers refuse
+    payloads encoded with a codec they do not allow.
+"""
+
+from cheese.codec import encode_task, decode_task, set_allowed_codecs
+from cheese.data import BatchElement
+from cheese.tasks import Task
+
+from dataclasses import dataclass
+from PIL import Image
+import numpy as np
+import pickle
+
+@dataclass
+class PickleElement(BatchElement):
+    text : str = None
+    img : Image.Image = None
+    audio : np.ndarray = None
+    meta : dict = None
+
+@dataclass
+class MsgpackElement(PickleElement):
+    codec = "msgpack"
+
+class Exploit:
+    def __reduce__(self):
+        return (print, ("Unpickled spoofed payload",))
+
+def make_element(cls):
+    return cls(
+        text = "hello", img = Image.new("RGB", (8, 4), (1, 2, 3)),
+        audio = np.arange(10, dtype = np.float32), meta = {"pair" : (1, "a"), "scores" : [0.5, 1]},
+        trip = 1, trip_max = 3, client_id = 2
+    )
+
+def check_round_trip(cls):
+    task = Task(data = make_element(cls), client_id = 5, waiting = True, fetch_id = 7)
+    res = decode_task(encode_task(task))
+
+    assert type(res.data) is cls
+    assert (res.client_id, res.terminate, res.waiting, res.fetch_id) == (5, False, True, 7)
+    assert (res.data.text, res.data.trip, res.data.trip_max, res.data.client_id) == ("hello", 1, 3, 2)
+    assert res.data.img.tobytes() == task.data.img.tobytes() and res.data.img.size == (8, 4)
+    assert np.array_equal(res.data.audio, task.data.audio) and res.data.audio.dtype == np.float32
+    assert res.data.meta == {"pair" : (1, "a"), "scores" : [0.5, 1]}
+
+if __name__ == "__main__":
+    check_round_trip(PickleElement)
+    check_round_trip(MsgpackElement)
+
+    # Tasks without data are sent as plain flags
+    for flags in [{"terminate" : True}, {"waiting" : True}]:
+        res = decode_task(encode_task(Task(client_id = 1, **flags)))
+        assert res.data is None and res.client_id == 1
+        assert (res.terminate, res.waiting) == (flags.get("terminate", False), flags.get("waiting", False))
+
+    # A payload claiming to be pickle is refused once only msgpack is allowed
+    header = b"pickle"
+    spoofed = bytes([len(header)]) + header + pickle.dumps(Exploit())
+    set_allowed_codecs(["msgpack"])
+    try:
+        decode_task(spoofed)
+        assert False, "Spoofed pickle payload was decoded"
+    except Exception as e:
+        assert "not allowed" in str(e)
+    check_round_trip(MsgpackElement)
+    set_allowed_codecs(None)
+
+    print("All Tests Passed")
@@ -0,0 +1,140 @@
+"""
+    This test script checks the on-disk generation cache: entries survive a restart, least recently used ones are
+    evicted first, and partial writes are cleaned up, and that keys tell apart arrays and images that differ anywhere. It then checks that a GenerativePipeline with a cache keeps the
+    generations left in its buffer when closed, and serves them after a restart without generating them again.
+"""
+
+from cheese.utils.disk_cache import GenerationCache
+from cheese.pipeline.generative import GenerativePipeline
+from cheese.data import BatchElement
+
+from dataclasses import dataclass
+from PIL import Image
+import numpy as np
+import tempfile
+import pickle
+import time
+import os
+
+N_INPUTS = 20
+
+@dataclass
+class NumberElement(BatchElement):
+    value : int = None
+
+class DoublingPipeline(GenerativePipeline):
+    """
+    Doubles each input, recording every input it is asked to generate for.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.generated = []
+        self.init_buffer()
+
+    def generate(self, model_input):
+        self.generated += model_input
+        return [NumberElement(value = 2 * x) for x in model_input]
+
+    def extract_data(self, be : NumberElement):
+        return {"value" : be.value}
+
+def wait_for(condition, timeout : float = 5) -> bool:
+    start = time.time()
+    while not condition() and time.time() - start < timeout:
+        time.sleep(0.01)
+    return condition()
+
+def check_cache(path : str):
+    entry_bytes = len(pickle.dumps("x" * 100, protocol = pickle.HIGHEST_PROTOCOL))
+    cache = GenerationCache(path, max_bytes = 2 * entry_bytes)
+    keys = [GenerationCache.make_key({"input" : i}) for i in range(3)]
+
+    assert cache.get(keys[0]) is None
+    cache.put(keys[0], "a" * 100)
+    cache.put(keys[1], "b" * 100)
+    assert cache.get(keys[0]) == "a" * 100
+
+    # keys[1] was used least recently, so it goes when the cache overflows
+    cache.put(keys[2], "c" * 100)
+    assert cache.get(keys[1]) is None
+    assert cache.get_stats() == {"entries" : 2, "bytes" : 2 * entry_bytes, "hits" : 1, "misses" : 2}
+
+    # Index is rebuilt from disk, and a write that was cut short is removed
+    open(os.path.join(path, keys[1] + ".pkl.123.tmp"), "wb").close()
+    cache = GenerationCache(path, max_bytes = 2 * entry_bytes)
+    assert cache.get(keys[0]) == "a" * 100 and cache.get(keys[2]) == "c" * 100
+    assert not any(name.endswith(".tmp") for name in os.listdir(path))
+
+    # Entry removed from outside the cache is a miss, and stops counting towards its size
+    os.remove(cache.file_path(keys[0]))
+    assert cache.get(keys[0]) is None
+    assert cache.get_stats()["entries"] == 1 and cache.get_stats()["bytes"] == entry_bytes
+
+    # Shrinking max_bytes on restart evicts down to it
+    cache = GenerationCache(path, max_bytes = 0)
+    assert cache.get_stats()["entries"] == 0 and os.listdir(path) == []
+
+def check_keys():
+    make_key = GenerationCache.make_key
+
+    # Large arrays differing only where their repr leaves out are still told apart
+    a, b = np.zeros(5000), np.zeros(5000)
+    b[2500] = 1
+    assert repr(a) == repr(b)
+    assert make_key({"input" : a}) != make_key({"input" : b})
+    assert make_key({"input" : a}) == make_key({"input" : np.zeros(5000)})
+
+    # Same bytes with a different shape or dtype are different inputs
+    assert make_key(a) != make_key(a.reshape(50, 100))
+    assert make_key(np.zeros(8, dtype = np.uint8)) != make_key(np.zeros(1, dtype = np.uint64))
+
+    image = Image.new("RGB", (64, 64))
+    changed = image.copy()
+    changed.putpixel((32, 32), (255, 255, 255))
+    assert make_key(image) != make_key(changed) and make_key(image) == make_key(Image.new("RGB", (64, 64)))
+    assert make_key(b"abc") != make_key(b"abd")
+
+    # Anything else JSON can't serialize is refused rather than described by its repr
+    try:
+        make_key({"input" : object()})
+        assert False, "Key made from unserializable object"
+    except Exception as e:
+        assert "Can't make key" in str(e)
+
+if __name__ == "__main__":
+    check_keys()
+    with tempfile.TemporaryDirectory() as tmp:
+        check_cache(os.path.join(tmp, "cache"))
+
+        kwargs = {
+            "batch_size" : 3, "buffer_size" : 9, "buffer_low" : 3,
+            "write_path" : os.path.join(tmp, "gen.csv"), "cache_path" : os.path.join(tmp, "gen_cache")
+        }
+
+        # Serve and post a few, then close with the rest of the buffer unserved
+        pipeline = DoublingPipeline(iterator = iter(range(N_INPUTS)), force_new = True, **kwargs)
+        assert wait_for(lambda: pipeline.buffer_content() == 9)
+        for _ in range(2):
+            pipeline.post_element(pipeline.fetch())
+
+        # Even if their entries were evicted since they were generated, generations in buffer are cached on close
+        max_bytes, pipeline.gen_cache.max_bytes = pipeline.gen_cache.max_bytes, 0
+        pipeline.gen_cache.put(GenerationCache.make_key("evict"), None)
+        pipeline.gen_cache.max_bytes = max_bytes
+        assert pipeline.gen_cache.get_stats()["entries"] == 0
+        pipeline.close()
+        assert pipeline.generated == list(range(9))
+
+        # After restarting, unserved generations come from the cache and only new inputs are generated
+        pipeline = DoublingPipeline(iterator = iter(range(N_INPUTS)), **kwargs)
+        served = []
+        while not pipeline.exhausted():
+            be = pipeline.fetch()
+            served.append(be.value)
+            pipeline.post_element(be)
+        assert served == [2 * x for x in range(2, N_INPUTS)]
+        assert pipeline.generated == list(range(9, N_INPUTS))
+        assert pipeline.get_stats()["cache_stats"]["hits"] == 7
+        pipeline.close()
+
+    print("All Tests Passed")
@@ -0,0 +1,160 @@
+"""
+    This test script checks the producer thread of GenerativePipeline: it fills the buffer up to buffer_size,
+    refills it only once it drains to buffer_low, serves generations in iterator order, stops when closed,
+    and after being stopped without closing, resumes without generating for inputs that were already posted.
+    It also checks that generations made by a pool of worker processes are served in iterator order, and that
+    a batch with a generation missing is refused rather than served.
+"""
+
+from cheese.pipeline.generative import GenerativePipeline
+from cheese.data import BatchElement
+from cheese.codec import decode_task
+
+from dataclasses import dataclass
+from types import SimpleNamespace
+import tempfile
+import atexit
+import time
+import os
+
+N_INPUTS = 20
+
+@dataclass
+class NumberElement(BatchElement):
+    value : int = None
+    worker : int = None
+
+def generate_in_worker(model_input):
+    # Every other batch is slow, so later batches finish first
+    if (model_input[0] // 3) % 2 == 0:
+        time.sleep(0.1)
+    return [NumberElement(value = 2 * x, worker = os.getpid()) for x in model_input]
+
+def load_generator():
+    return generate_in_worker
+
+class DoublingPipeline(GenerativePipeline):
+    """
+    Doubles each input, recording every batch it is asked to generate.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batches = []
+        self.init_buffer()
+
+    def generate(self, model_input):
+        self.batches.append(list(model_input))
+        return [NumberElement(value = 2 * x) for x in model_input]
+
+    def extract_data(self, be : NumberElement):
+        return {"value" : be.value}
+
+class DroppingPipeline(DoublingPipeline):
+    """
+    Leaves out the generation for the last input of each batch.
+    """
+    def generate(self, model_input):
+        return super().generate(model_input)[:-1]
+
+def wait_for(condition, timeout : float = 5) -> bool:
+    start = time.time()
+    while not condition() and time.time() - start < timeout:
+        time.sleep(0.01)
+    return condition()
+
+def idle(pipeline : DoublingPipeline) -> bool:
+    # Give producer time to start another batch if it was going to
+    time.sleep(0.2)
+    return not pipeline.generating
+
+def crash(pipeline : DoublingPipeline):
+    # Nothing is saved on the way out, producer is left waiting
+    atexit.unregister(pipeline.close_at_exit)
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        kwargs = {"batch_size" : 3, "buffer_size" : 9, "buffer_low" : 3, "write_path" : os.path.join(tmp, "gen.csv")}
+
+        # Buffer is filled up to buffer_size, then producer waits
+        pipeline = DoublingPipeline(iterator = iter(range(N_INPUTS)), force_new = True, **kwargs)
+        assert wait_for(lambda: pipeline.buffer_content() == 9) and idle(pipeline)
+        assert pipeline.batches == [[0, 1, 2], [3, 4, 5], [6, 7, 8]]
+
+        # Fetching down to just above buffer_low does not refill it
+        served = [pipeline.fetch() for _ in range(5)]
+        assert idle(pipeline) and pipeline.buffer_content() == 4 and len(pipeline.batches) == 3
+
+        # Reaching buffer_low does
+        served.append(pipeline.fetch())
+        assert wait_for(lambda: pipeline.buffer_content() == 9) and idle(pipeline)
+        assert len(pipeline.batches) == 5
+
+        # Generations are served in iterator order, tagged with the step of their input
+        served += [pipeline.fetch() for _ in range(N_INPUTS - len(served))]
+        assert [be.value for be in served] == [2 * x for x in range(N_INPUTS)]
+        assert [pipeline.get_fetch_id(be) for be in served] == list(range(N_INPUTS))
+        assert sum(len(batch) for batch in pipeline.batches) == N_INPUTS
+
+        # Nothing left once iterator and buffer are both empty
+        assert wait_for(lambda: pipeline.producer_done) and pipeline.exhausted()
+        try:
+            pipeline.fetch()
+            assert False, "Fetch from exhausted pipeline did not raise"
+        except Exception as e:
+            assert "stopped generating" in str(e)
+        pipeline.close()
+
+        # Closing stops producer even though iterator has more inputs
+        pipeline = DoublingPipeline(iterator = iter(range(N_INPUTS)), force_new = True, **kwargs)
+        assert wait_for(lambda: pipeline.buffer_content() == 9)
+        thread = pipeline.buffer_thread
+        pipeline.close()
+        assert not thread.is_alive() and pipeline.producer_done and not pipeline.exhausted()
+
+        # Stop without closing after posting some generations, out of order
+        pipeline = DoublingPipeline(iterator = iter(range(N_INPUTS)), force_new = True, **kwargs)
+        served = [pipeline.fetch() for _ in range(8)]
+        posted = [be.value // 2 for be in served[:2] + served[4:7]]
+        for be in served[:2] + served[4:7]:
+            pipeline.post_element(be)
+
+        # An element sent off in a task comes back as a new object, which is still known by its step
+        sent = []
+        pipeline.publisher = SimpleNamespace(publish = lambda routing_key, payload: sent.append(payload))
+        assert pipeline.queue_task() and decode_task(sent[0]).fetch_id == 8
+        pipeline.dequeue_task(SimpleNamespace(body = sent[0]))
+        posted.append(8)
+        crash(pipeline)
+
+        # Inputs whose generations were posted are skipped, every other one is generated and served once
+        pipeline = DoublingPipeline(iterator = iter(range(N_INPUTS)), **kwargs)
+        rest = []
+        while not pipeline.exhausted():
+            be = pipeline.fetch()
+            rest.append(be.value // 2)
+            pipeline.post_element(be)
+        generated = [x for batch in pipeline.batches for x in batch]
+        assert generated == rest == [x for x in range(N_INPUTS) if x not in posted]
+        pipeline.close()
+
+        # Worker processes make the generations instead of generate, and their batches are served in the order they were read
+        pipeline = DoublingPipeline(
+            iterator = iter(range(N_INPUTS)), num_workers = 2, make_generator = load_generator, force_new = True, **kwargs
+        )
+        served = []
+        while not pipeline.exhausted():
+            served.append(pipeline.fetch())
+        assert [be.value for be in served] == [2 * x for x in range(N_INPUTS)]
+        assert [pipeline.get_fetch_id(be) for be in served] == list(range(N_INPUTS))
+        assert pipeline.batches == [] and all(be.worker != os.getpid() for be in served)
+        pipeline.close()
+        assert pipeline.executor is None
+
+        # Generations can't be matched to inputs if there are fewer of them, so producer stops instead of serving them
+        pipeline = DroppingPipeline(iterator = iter(range(N_INPUTS)), force_new = True, **kwargs)
+        assert wait_for(lambda: pipeline.producer_done) and pipeline.buffer_content() == 0
+        error = pipeline.submit_batch([0, 1], [0, 1]).exception()
+        assert "one element per input" in str(error)
+        pipeline.close()
+
+    print("All Tests Passed")
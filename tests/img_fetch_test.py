@@ -0,0 +1,125 @@
+"""
+    This test script checks ImageFetcher against a local HTTP server: images are resized, cached in memory and on disk,
+    fetched once no matter how many times they are asked for, transient failures are retried, and dead or broken links
+    are filtered out until they have been dead for a while, while failing to write the disk cache does not make a link dead.
+"""
+
+from cheese.utils.img_utils import ImageFetcher, url2img
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image
+from io import BytesIO
+import tempfile
+import threading
+import os
+import time
+
+requests_served = {}
+unavailable = {"/flaky.png" : 2} # Path -> number of requests to fail with 503 before serving it
+
+def make_png(size):
+    out = BytesIO()
+    Image.new("RGB", size, (255, 0, 0)).save(out, format = "PNG")
+    return out.getvalue()
+
+FILES = {
+    "/big.png" : make_png((1024, 512)),
+    "/small.png" : make_png((64, 64)),
+    "/broken.png" : b"not an image",
+    "/flaky.png" : make_png((32, 32))
+}
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        requests_served[self.path] = requests_served.get(self.path, 0) + 1
+        if unavailable.get(self.path, 0) > 0:
+            unavailable[self.path] -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+        if self.path not in FILES:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(FILES[self.path])))
+        self.end_headers()
+        self.wfile.write(FILES[self.path])
+
+    def log_message(self, *args):
+        pass
+
+if __name__ == "__main__":
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        fetcher = ImageFetcher(display_size = (256, 256), cache_dir = cache_dir, max_workers = 4)
+
+        # Resized to fit display size, keeping aspect ratio
+        assert fetcher.get(base + "/big.png").size == (256, 128)
+        assert fetcher.get(base + "/small.png").size == (64, 64)
+
+        # Asked for many times at once, fetched once
+        futures = [fetcher.prefetch(base + "/big.png") for _ in range(10)]
+        assert all(f.result() is not None for f in futures)
+        assert requests_served["/big.png"] == 1
+
+        # Dead and broken links are filtered out, everything else keeps its order
+        urls = [base + path for path in ["/small.png", "/missing.png", "/big.png", "/broken.png", "/small.png"]]
+        assert list(fetcher.filter_alive(urls, lookahead = 3)) == [urls[0], urls[2], urls[4]]
+        assert not fetcher.is_alive(base + "/missing.png")
+        assert requests_served["/missing.png"] == 1
+
+        # A new fetcher reads from the disk cache instead of the server
+        fetcher2 = ImageFetcher(display_size = (256, 256), cache_dir = cache_dir)
+        assert fetcher2.get(base + "/big.png").size == (256, 128)
+        assert requests_served["/big.png"] == 1
+        assert fetcher2.get_stats()["disk_hits"] == 1
+
+        # Disk cache can't be written to, so image is only kept in memory rather than its URL being marked dead
+        unwritable = ImageFetcher(cache_dir = os.path.join(cache_dir, "gone"))
+        os.rmdir(unwritable.cache_dir)
+        assert unwritable.get(base + "/small.png").size == (64, 64)
+        assert unwritable.is_alive(base + "/small.png") and unwritable.get_stats()["dead"] == 0
+
+        # Memory cache stays within its size
+        small = ImageFetcher(cache_bytes = 1)
+        small.get(base + "/small.png")
+        small.get(base + "/big.png")
+        assert small.get_stats()["cached_images"] == 1
+
+        assert url2img(base + "/small.png").size == (64, 64)
+
+        # Server is briefly unavailable, so image is retried rather than marked dead
+        retrying = ImageFetcher(backoff = 0.01, retries = 2)
+        assert retrying.get(base + "/flaky.png").size == (32, 32)
+        assert requests_served["/flaky.png"] == 3
+
+        # Out of retries, so URL is dead, but only until dead_ttl passes
+        unavailable["/flaky.png"] = 3
+        forgetful = ImageFetcher(backoff = 0.01, retries = 2, dead_ttl = 0.2)
+        assert not forgetful.is_alive(base + "/flaky.png")
+        assert not forgetful.is_alive(base + "/flaky.png")
+        assert requests_served["/flaky.png"] == 6
+        time.sleep(0.3)
+        assert forgetful.is_alive(base + "/flaky.png")
+
+        # Links that are dead for good are not retried, and only so many are remembered
+        capped = ImageFetcher(backoff = 0.01, max_dead = 2)
+        for i in range(3):
+            assert not capped.is_alive(base + f"/gone{i}.png")
+            assert requests_served[f"/gone{i}.png"] == 1
+        assert capped.get_stats()["dead"] == 2
+
+        fetcher.close()
+        fetcher2.close()
+        small.close()
+        retrying.close()
+        forgetful.close()
+        capped.close()
+        unwritable.close()
+
+    server.shutdown()
+    print("All Tests Passed")
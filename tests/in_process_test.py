@@ -0,0 +1,170 @@
+"""
+    This test script runs the whole system (pipeline, model, client manager and API) in one process
+    using the in-process transport, so no RabbitMQ server is needed. Simulated labellers
+    label every item while the model processes them in between.
+"""
+
+from cheese import CHEESE
+from cheese.api import CHEESEAPI
+from cheese.pipeline import Pipeline
+from cheese.models import BaseModel
+from cheese.data import BatchElement
+from cheese.tasks import Task
+
+from dataclasses import dataclass
+import tempfile
+import threading
+import time
+
+N_ITEMS = 200
+N_CLIENTS = 8
+
+@dataclass
+class CountElement(BatchElement):
+    value : int = 0
+    doubled : int = 0
+    label : int = 0
+
+class CountPipeline(Pipeline):
+    def __init__(self, n_items : int, **kwargs):
+        super().__init__(**kwargs)
+        self.n_items = n_items
+        self.fetched = 0
+        self.results = []
+
+    def get_stats(self):
+        return {"fetched" : self.fetched, "posted" : len(self.results)}
+
+    def exhausted(self):
+        return self.fetched >= self.n_items
+
+    def fetch(self):
+        self.fetched += 1
+        return CountElement(value = self.fetched, trip_max = 3)
+
+    def post(self, be : CountElement):
+        self.results.append(be)
+
+class DoubleModel(BaseModel):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batches = [] # Values in each batch processed
+
+    def process(self, data):
+        self.batches.append([be.value for be in data])
+        for be in data:
+            be.doubled = 2 * be.value
+        return data
+
+def labeller(cheese : CHEESE, id : int):
+    manager = cheese.client_manager
+    task : Task = manager.await_new_task(id)
+    while not task.terminate:
+        if task.data.trip == 1:
+            # First visit, send to model
+            manager.submit_task(id, task)
+        else:
+            task.data.label = task.data.doubled + 1
+            manager.submit_task(id, task)
+        task = manager.await_new_task(id)
+
+def run(pipeline_kwargs, model_kwargs = {}, model_replicas = None, cheese_kwargs = {}, remove_mid_run = 0):
+    cheese = CHEESE(
+        CountPipeline, model_cls = DoubleModel,
+        pipeline_kwargs = {"n_items" : N_ITEMS, **pipeline_kwargs}, model_kwargs = model_kwargs,
+        model_replicas = model_replicas,
+        transport = "in_process", **cheese_kwargs
+    )
+    threading.Thread(target = cheese.start_listening, args = (0.01,), daemon = True).start()
+    api = CHEESEAPI(transport = cheese.connection)
+
+    labellers = []
+    for id in range(N_CLIENTS):
+        usr, pwd = api.create_client(id)
+        assert usr == id
+        labellers.append(threading.Thread(target = labeller, args = (cheese, id), daemon = True))
+        labellers[-1].start()
+
+    start = time.time()
+    if remove_mid_run:
+        # Tasks held by removed clients are finished by the others
+        while len(cheese.pipeline.results) < N_ITEMS // 4:
+            time.sleep(0.01)
+        api.remove_clients(range(1, 1 + remove_mid_run))
+
+    while len(cheese.pipeline.results) < N_ITEMS or not cheese.finished:
+        assert time.time() - start < 60, "Timed out waiting for labels"
+        time.sleep(0.05)
+
+    results = sorted(cheese.pipeline.results, key = lambda be: be.value)
+    assert [be.value for be in results] == list(range(1, N_ITEMS + 1))
+    for be in results:
+        assert be.label == 2 * be.value + 1
+
+    stats = cheese.get_stats()
+    if not remove_mid_run:
+        assert stats["num_tasks"] == N_ITEMS # Statistics of removed clients are dropped with them
+    assert stats["num_assigned_tasks"] == cheese.busy_clients == 0
+    # Memoized items skip the model
+    processed = N_ITEMS - (stats["model_stats"]["memo"]["hits"] if model_kwargs.get("memo_key") else 0)
+    assert stats["model_stats"]["processed"] == processed
+    assert sum(size * cnt for size, cnt in stats["model_stats"]["batch_sizes"].items()) == processed
+    if model_kwargs.get("bucket_key") is not None and model_replicas is None:
+        # Batches are only ever made from a single bucket
+        cost = lambda value: model_kwargs["bucket_key"](CountElement(value = value))
+        assert all(len({cost(value) for value in batch}) == 1 for batch in cheese.model.batches)
+        assert max(len(batch) for batch in cheese.model.batches) > 1
+    if model_replicas is not None:
+        assert sum(replica["processed"] for replica in stats["model_stats"]["replicas"].values()) == processed
+    assert cheese.finished
+    if pipeline_kwargs.get("prefetch"):
+        prefetch_stats = stats["prefetch_stats"]
+        assert prefetch_stats["hits"] + prefetch_stats["misses"] == N_ITEMS
+        assert prefetch_stats["ready"] == 0
+
+    # Pipeline is exhausted, so a new client waiting with a timeout is told to come back later
+    api.create_client(N_CLIENTS)
+    task = cheese.client_manager.await_new_task(N_CLIENTS, timeout = 0.1)
+    assert task.waiting and not task.terminate
+
+    # Removing a client wakes its waiting labeller with a terminate signal
+    api.remove_client(0)
+    labellers[0].join(timeout = 5)
+    assert not labellers[0].is_alive()
+
+    # Rate kept up to date as clients submit and are removed matches the one computed from every client's statistics
+    manager = cheese.client_manager
+    expected = sum(stats.rate() for stats in manager.client_statistics.values())
+    assert abs(manager.consumption_rate() - expected) <= 1e-6 * expected
+
+    print(f"Labelled {N_ITEMS} items in {time.time() - start:.2f}s with {pipeline_kwargs} {model_kwargs} {model_replicas}")
+    return stats
+
+if __name__ == "__main__":
+    run({})
+    # Posting from a writer thread in groups
+    run({"write_behind" : True, "flush_interval" : 0.05, "flush_size" : 16})
+    # Fetching ahead on a background thread
+    run({"prefetch" : 8, "prefetch_low" : 2})
+    # Model waits briefly for batches to fill up
+    run({}, {"batch_size" : 4, "max_wait_ms" : 5})
+    # Model batches items of similar size together. Neighbouring items cost a power of two apart, so land in different buckets
+    run({}, {"batch_size" : 4, "max_wait_ms" : 5, "bucket_key" : lambda be: 2 ** (be.value % 3)})
+    # Model runs as replicas in worker processes
+    run({}, {"batch_size" : 4}, model_replicas = 2)
+    # Batching and memoization settings are kept from replicas, so they can be lambdas and don't open the disk cache there
+    with tempfile.TemporaryDirectory() as memo_path:
+        replica_kwargs = {
+            "batch_size" : 4, "max_wait_ms" : 5, "bucket_key" : lambda be: be.value,
+            "memo_key" : lambda be: be.value, "memo_path" : memo_path
+        }
+        run({}, replica_kwargs, model_replicas = 2)
+    # Model results are memoized on disk, so a second run never calls the model
+    with tempfile.TemporaryDirectory() as memo_path:
+        memo_kwargs = {"batch_size" : 4, "memo_key" : lambda be: be.value, "memo_path" : memo_path}
+        assert run({}, memo_kwargs)["model_stats"]["memo"]["hits"] == 0
+        memo_stats = run({}, memo_kwargs)["model_stats"]["memo"]
+        assert memo_stats["hits"] == memo_stats["disk_hits"] == N_ITEMS
+    # Clients are removed while holding prefetched tasks
+    run({}, cheese_kwargs = {"prefetch" : 2}, remove_mid_run = N_CLIENTS // 2)
+    print("All Tests Passed")
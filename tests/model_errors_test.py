@@ -0,0 +1,125 @@
+"""
+    This test script checks that tasks in a batch the model fails to process are sent on with error set,
+    instead of being dropped and leaving whoever waits on them waiting forever. It checks this both for a model
+    running in this process and for one running as replicas in worker processes. It also checks that memo keys are
+    only worked out once for each task.
+"""
+
+from cheese.models import BaseModel
+from cheese.models.replicas import ReplicaModel
+import cheese.models.replicas as replicas
+from cheese.codec import encode_task, decode_task
+from cheese.data import BatchElement
+from cheese.tasks import Task
+
+from dataclasses import dataclass
+from types import SimpleNamespace
+import threading
+import time
+
+N_TASKS = 40
+
+@dataclass
+class CountElement(BatchElement):
+    value : int = 0
+    doubled : int = 0
+
+class PickyModel(BaseModel):
+    """
+    Fails on any batch with a multiple of 5 in it.
+    """
+    def process(self, data):
+        if any(be.value % 5 == 0 for be in data):
+            raise ValueError("Multiple of 5")
+        for be in data:
+            be.doubled = 2 * be.value
+        return data
+
+class Recorder:
+    """
+    Stands in for publisher, keeping every task sent on with the route it was sent to.
+    """
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def publish(self, routing_key : str, payload):
+        with self.lock:
+            self.sent.append((routing_key, decode_task(payload)))
+
+def replica_has_worker() -> bool:
+    return replicas.replica_model.worker_thread is not None
+
+def check_model(model : BaseModel):
+    recorder = Recorder()
+    model.publisher = recorder
+    for value in range(1, N_TASKS + 1):
+        # Trip ends at model for odd values, so they go to pipeline, even ones go back to their client
+        data = CountElement(value = value, trip_max = 1 if value % 2 else 2)
+        model.dequeue_task(SimpleNamespace(body = encode_task(Task(data = data))))
+
+    start = time.time()
+    while len(recorder.sent) < N_TASKS:
+        assert time.time() - start < 30, "Tasks were dropped"
+        time.sleep(0.01)
+    model.close()
+
+    sent = sorted(recorder.sent, key = lambda sent: sent[1].data.value)
+    assert [task.data.value for _, task in sent] == list(range(1, N_TASKS + 1))
+    for route, task in sent:
+        assert route == ("pipeline" if task.data.value % 2 else "active")
+        # Whole batch fails with the element that caused it, and the rest are processed as usual
+        if task.data.value % 5 == 0:
+            assert task.data.error
+        assert task.data.error == (task.data.doubled == 0)
+        if not task.data.error:
+            assert task.data.doubled == 2 * task.data.value
+
+    stats = model.get_stats()
+    failed = sum(task.data.error for _, task in sent)
+    assert stats["failed"] == failed and stats["processed"] == N_TASKS - failed
+
+class KeyCounter:
+    """
+    Memo key that counts how many times it is worked out.
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, be : CountElement):
+        self.calls += 1
+        return be.value
+
+def check_memo(make_model):
+    # Each value is sent twice, the second time once the first has been memoized
+    key = KeyCounter()
+    model = make_model(key)
+    recorder = Recorder()
+    model.publisher = recorder
+    values = [value for value in range(1, N_TASKS + 1) if value % 5 != 0]
+    for expected in [len(values), 2 * len(values)]:
+        for value in values:
+            model.dequeue_task(SimpleNamespace(body = encode_task(Task(data = CountElement(value = value)))))
+        start = time.time()
+        while len(recorder.sent) < expected:
+            assert time.time() - start < 30, "Tasks were dropped"
+            time.sleep(0.01)
+    model.close()
+
+    # Key is worked out once per task, even for those that missed and were memoized after processing
+    assert key.calls == 2 * len(values)
+    assert all(task.data.doubled == 2 * task.data.value for _, task in recorder.sent)
+    assert model.get_stats()["memo"]["hits"] == len(values)
+
+if __name__ == "__main__":
+    check_model(PickyModel(batch_size = 4, max_wait_ms = 5))
+
+    # Replicas are only handed batches, so they don't start a worker thread of their own
+    model = ReplicaModel(PickyModel, {"batch_size" : 4, "max_wait_ms" : 5}, replicas = 2)
+    assert model.worker_thread is None
+    assert not model.executor.submit(replica_has_worker).result()
+    check_model(model)
+    check_memo(lambda key: PickyModel(batch_size = 4, max_wait_ms = 5, memo_key = key))
+    check_memo(lambda key: ReplicaModel(PickyModel, {"batch_size" : 4, "max_wait_ms" : 5, "memo_key" : key}, replicas = 2))
+
+    print("All Tests Passed")
@@ -0,0 +1,48 @@
+"""
+    This test script checks which idle client each scheduling policy gives the next task to.
+"""
+
+from cheese.client.scheduling import FIFOPolicy, RoundRobinPolicy, make_policy
+
+def select_all(policy):
+    res = []
+    while len(policy) > 0:
+        res.append(policy.select())
+    return res
+
+if __name__ == "__main__":
+    # Client that has been idle longest goes first
+    fifo = make_policy("fifo")
+    assert isinstance(fifo, FIFOPolicy)
+    for id in [3, 1, 2]: fifo.add(id)
+    assert fifo.select() == 3
+    fifo.add(3) # Idle again, so now it is last
+    fifo.remove(1)
+    assert select_all(fifo) == [2, 3]
+    assert fifo.select() is None
+
+    # Each idle client gets a task in turn, and one that was given a task waits until the others have had theirs
+    rr = make_policy("round_robin")
+    assert isinstance(rr, RoundRobinPolicy)
+    for id in [30, 10, 20]: rr.add(id)
+    assert rr.select() == 30
+    rr.add(30)
+    assert rr.select() == 10
+    rr.add(10)
+    assert select_all(rr) == [20, 30, 10]
+
+    # Next lap skips clients that are busy or removed
+    for id in [30, 10, 20]: rr.add(id)
+    assert rr.select() == 20
+    rr.remove(30)
+    assert rr.select() == 10
+    rr.forget(30)
+    rr.add(40) # Not served yet in this lap, unlike 10
+    rr.add(10)
+    assert select_all(rr) == [40, 10]
+    rr.add(30) # Added again, so as good as new
+    for id in [10, 20]: rr.add(id)
+    assert select_all(rr) == [30, 20, 10]
+    assert rr.select() is None
+
+    print("All Tests Passed")
@@ -0,0 +1,190 @@
+"""
+    This test script checks that resumable data sources continue from the position they were stopped at, both on their own
+    and inside an IterablePipeline that is stopped without closing, as if the process died, and then resumed.
+"""
+
+from cheese.pipeline.sources import StatefulIterableSource, TextFileSource, TarShardSource, ShardedSource
+from cheese.pipeline.iterable_dataset import IterablePipeline
+from cheese.data import BatchElement
+
+from datasets import IterableDataset
+from dataclasses import dataclass
+from io import BytesIO
+import threading
+import tempfile
+import tarfile
+import atexit
+import os
+
+N_ITEMS = 30
+
+@dataclass
+class TextElement(BatchElement):
+    text : str = None
+
+class TextPipeline(IterablePipeline):
+    def get_stats(self):
+        return {}
+
+    def fetch(self) -> TextElement:
+        return TextElement(text = self.fetch_next())
+
+    def post(self, be : TextElement):
+        self.post_row({"text" : be.text})
+
+class CountingTextSource(TextFileSource):
+    """
+    Counts lines read, to check resuming does not replay them.
+    """
+    reads = 0
+
+    def __next__(self) -> str:
+        CountingTextSource.reads += 1
+        return super().__next__()
+
+def gen_lines(shards):
+    for shard in shards:
+        for i in range(N_ITEMS // 3):
+            yield {"text" : f"{shard}-{i}"}
+
+def make_dataset() -> IterableDataset:
+    return IterableDataset.from_generator(gen_lines, gen_kwargs = {"shards" : ["a", "b", "c"]})
+
+def write_text_files(tmp : str):
+    paths = []
+    for shard in ["a", "b", "c"]:
+        paths.append(os.path.join(tmp, f"{shard}.txt"))
+        with open(paths[-1], "w") as f:
+            f.write("".join(f"{shard}-{i}\n" for i in range(N_ITEMS // 3)))
+    return paths
+
+def write_tar_shards(tmp : str):
+    paths = []
+    for shard in ["a", "b", "c"]:
+        paths.append(os.path.join(tmp, f"{shard}.tar"))
+        with tarfile.open(paths[-1], "w") as tar:
+            for i in range(N_ITEMS // 3):
+                for ext in ["txt", "cls"]:
+                    data = f"{shard}-{i}".encode("utf-8")
+                    info = tarfile.TarInfo(f"{shard}/{i}.{ext}")
+                    info.size = len(data)
+                    tar.addfile(info, BytesIO(data))
+    return paths
+
+def text_of(item) -> str:
+    if isinstance(item, dict):
+        return item["text"] if "text" in item else item["txt"].decode("utf-8")
+    return item
+
+def check_source(make_source):
+    expected = [text_of(item) for item in make_source()]
+    assert len(expected) == N_ITEMS
+
+    for stop in [0, 1, 7, N_ITEMS - 1, N_ITEMS]:
+        source = make_source()
+        taken = [text_of(next(source)) for _ in range(stop)]
+        state = source.state_dict()
+
+        resumed = make_source()
+        resumed.load_state_dict(state)
+        assert taken + [text_of(item) for item in resumed] == expected
+
+def check_pipeline(make_source, tmp : str):
+    class SourcePipeline(TextPipeline):
+        def preprocess(self, x):
+            return text_of(x)
+
+    write_path = os.path.join(tmp, "res.csv")
+    kwargs = {"write_path" : write_path, "checkpoint_every" : 4}
+
+    pipeline = SourcePipeline(make_source(), force_new = True, **kwargs)
+    served = [pipeline.fetch_element() for _ in range(10)]
+    for be in served[2:8]:
+        pipeline.post_element(be)
+    posted = [be.text for be in served[2:8]]
+    atexit.unregister(pipeline.close_at_exit) # Stopped without saving anything more
+
+    pipeline = SourcePipeline(make_source(), **kwargs)
+    rest = []
+    while True:
+        be = pipeline.fetch_element()
+        if be.text is None:
+            break
+        rest.append(be.text)
+        pipeline.post_element(be)
+    pipeline.close()
+
+    # Unposted elements come back first, then everything not fetched before
+    assert rest[:4] == [be.text for be in served[:2] + served[8:]]
+    assert sorted(posted + rest) == sorted(text_of(item) for item in make_source())
+    os.remove(write_path)
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        text_paths = write_text_files(tmp)
+        tar_paths = write_tar_shards(tmp)
+
+        makers = [
+            lambda: StatefulIterableSource(make_dataset()),
+            lambda: TextFileSource(text_paths),
+            lambda: TarShardSource(tar_paths)
+        ]
+        for make_source in makers:
+            check_source(make_source)
+            check_pipeline(make_source, tmp)
+
+        # Resuming jumps to the position instead of reading through the lines before it
+        source = CountingTextSource(text_paths)
+        for _ in range(20): next(source)
+        state = source.state_dict()
+        CountingTextSource.reads = 0
+        resumed = CountingTextSource(text_paths)
+        resumed.load_state_dict(state)
+        assert len(list(resumed)) == N_ITEMS - 20
+        assert CountingTextSource.reads == N_ITEMS - 20 + 1 # Including the read that ends iteration
+
+        # Shards of uneven length, so they finish at different times
+        sharded_paths = []
+        for shard, length in enumerate([5, 1, 3, 0, 4, 2]):
+            sharded_paths.append(os.path.join(tmp, f"shard{shard}.txt"))
+            with open(sharded_paths[-1], "w") as f:
+                f.write("".join(f"{shard}-{i}\n" for i in range(length)))
+
+        # Open shards are read round robin, and a finished shard's slot goes to the next unopened one
+        threads_before = threading.active_count()
+        source = ShardedSource(sharded_paths, num_workers = 2, ready_size = 4)
+        order, most_threads = [], 0
+        for item in source:
+            order.append(item)
+            most_threads = max(most_threads, threading.active_count())
+        # Same two workers read every shard
+        assert most_threads == threads_before + 2
+        assert order == ["0-0", "1-0", "0-1", "2-0", "0-2", "2-1", "0-3", "2-2", "0-4", "4-0", "5-0", "4-1", "5-1", "4-2", "4-3"]
+        assert source.get_stats()["open_shards"] == 0 and source.get_stats()["remaining_shards"] == 0
+
+        # Resuming from any point gives exactly what would have come next, whatever was read ahead
+        for stop in range(len(order) + 1):
+            source = ShardedSource(sharded_paths, num_workers = 2, ready_size = 4)
+            taken = [next(source) for _ in range(stop)]
+            state = source.state_dict()
+            source.stop()
+            assert len(state["active"]) <= 2
+
+            resumed = ShardedSource(sharded_paths, num_workers = 2, ready_size = 4)
+            resumed.load_state_dict(state)
+            assert taken + list(resumed) == order
+
+        # Transform runs on workers, and items it rejects are skipped
+        def transform(line):
+            if line.endswith("-0"):
+                raise ValueError()
+            return line.upper()
+        source = ShardedSource(sharded_paths, num_workers = 3, transform = transform, skip = (ValueError,))
+        assert sorted(source) == sorted(line.upper() for line in order if not line.endswith("-0"))
+
+        # Text files and tar shards can be mixed, and a pipeline reading them resumes like with any other source
+        mixed_paths = text_paths[:2] + tar_paths[2:]
+        check_source(lambda: ShardedSource(mixed_paths, num_workers = 2))
+        check_pipeline(lambda: ShardedSource(mixed_paths, num_workers = 2), tmp)
+
+    print("All Tests Passed")
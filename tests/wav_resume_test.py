@@ -0,0 +1,95 @@
+"""
+    This test script stops a WavFolderPipeline partway through without closing it, as if the process died,
+    then resumes from its write-ahead log and snapshots. Every file that was not posted should be served exactly once
+    more, and no posted file should be served again.
+"""
+
+from cheese.pipeline.wav_folder import WavFolderPipeline
+from cheese.data import BatchElement
+
+from dataclasses import dataclass
+import pandas as pd
+import tempfile
+import atexit
+import os
+
+N_FILES = 12
+
+@dataclass
+class WavElement(BatchElement):
+    id : int = None
+    path : str = None
+
+class RatingPipeline(WavFolderPipeline):
+    def get_stats(self):
+        return {}
+
+    def fetch(self) -> WavElement:
+        return WavElement(**self.id_pop())
+
+    def post(self, be : WavElement):
+        self.id_complete(be.id, {"file_name" : os.path.basename(be.path)})
+
+def crash(pipeline : RatingPipeline):
+    # Nothing is saved or snapshotted on the way out
+    atexit.unregister(pipeline.close_at_exit)
+
+def serve(pipeline : RatingPipeline, n : int):
+    return [pipeline.fetch() for _ in range(n)]
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        read_path = os.path.join(tmp, "wavs")
+        write_path = os.path.join(tmp, "ratings.csv")
+        os.makedirs(read_path)
+        for i in range(N_FILES):
+            open(os.path.join(read_path, f"{i}.wav"), "w").close()
+
+        # Snapshots are taken every few events, so resuming uses both a snapshot and events logged after it
+        kwargs = {"read_path" : read_path, "write_path" : write_path, "checkpoint_every" : 3}
+
+        pipeline = RatingPipeline(force_new = True, **kwargs)
+        served = serve(pipeline, 8)
+        for be in served[1:6]:
+            pipeline.post_element(be)
+        posted = {os.path.basename(be.path) for be in served[1:6]}
+        crash(pipeline)
+
+        # Files that were served but not posted are served again, posted ones are not
+        pipeline = RatingPipeline(**kwargs)
+        served = serve(pipeline, pipeline.total_items - len(posted))
+        assert pipeline.exhausted()
+        names = [os.path.basename(be.path) for be in served]
+        assert len(set(names)) == len(names)
+        assert set(names) == {f"{i}.wav" for i in range(N_FILES)} - posted
+
+        # Stop again after posting some, without closing
+        for be in served[:3]:
+            pipeline.post_element(be)
+        posted |= set(names[:3])
+        crash(pipeline)
+
+        pipeline = RatingPipeline(**kwargs)
+        served = serve(pipeline, pipeline.total_items - len(posted))
+        assert pipeline.exhausted()
+        names = [os.path.basename(be.path) for be in served]
+        assert set(names) == {f"{i}.wav" for i in range(N_FILES)} - posted
+        for be in served[:-1]:
+            pipeline.post_element(be)
+
+        # Rows are saved as they are added, even when calling post directly
+        pipeline.post(served[-1])
+        assert len(pd.read_csv(write_path)) == N_FILES
+        pipeline.close()
+
+        # Closing again does nothing, and a closed pipeline is not closed again on exit
+        assert not pipeline.exit_registered
+        pipeline.close()
+
+        # Every file was posted exactly once, and a finished run has nothing left to serve
+        pipeline = RatingPipeline(**kwargs)
+        assert pipeline.exhausted()
+        assert sorted(pipeline.res_dataset["file_name"]) == sorted(f"{i}.wav" for i in range(N_FILES))
+        pipeline.close()
+
+    print("All Tests Passed")
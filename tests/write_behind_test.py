@@ -0,0 +1,82 @@
+"""
+    This test script checks that the write-behind writer posts every element it is given, retrying ones whose post
+    fails, and that failures surface on flush and close instead of being dropped.
+"""
+
+from cheese.pipeline import Pipeline
+from cheese.data import BatchElement
+
+from dataclasses import dataclass
+
+@dataclass
+class CountElement(BatchElement):
+    value : int = 0
+
+class FlakyPipeline(Pipeline):
+    """
+    Post fails for elements in fail_values until they have been tried fail_times times.
+    """
+    def __init__(self, fail_values, fail_times, **kwargs):
+        super().__init__(write_behind = True, flush_interval = 0.01, flush_size = 4, **kwargs)
+        self.fail_values = set(fail_values)
+        self.fail_times = fail_times
+        self.attempts = {}
+        self.posted = []
+        self.commits = 0
+
+    def get_stats(self):
+        return {}
+
+    def exhausted(self):
+        return True
+
+    def fetch(self):
+        return None
+
+    def post(self, be : CountElement):
+        self.attempts[be.value] = self.attempts.get(be.value, 0) + 1
+        if be.value in self.fail_values and self.attempts[be.value] <= self.fail_times:
+            raise Exception(f"Could not post {be.value}")
+        self.posted.append(be.value)
+
+    def commit(self):
+        self.commits += 1
+
+def expect_error(fn):
+    try:
+        fn()
+    except Exception as e:
+        assert "still to be posted" in str(e)
+        return
+    assert False, "Writer failure was not raised"
+
+if __name__ == "__main__":
+    # Failed posts are retried until they go through, and nothing is posted twice
+    pipeline = FlakyPipeline(fail_values = [3, 7], fail_times = 2)
+    for value in range(20):
+        pipeline.write_queue.put(CountElement(value = value))
+    pipeline.close()
+    assert sorted(pipeline.posted) == list(range(20))
+    assert pipeline.attempts[3] == pipeline.attempts[7] == 3
+    assert not pipeline.failed_posts and pipeline.commits > 0
+
+    # Flush waits for everything given to the writer so far and raises while posts are failing
+    pipeline = FlakyPipeline(fail_values = [1], fail_times = 10 ** 9)
+    for value in range(5):
+        pipeline.write_queue.put(CountElement(value = value))
+    expect_error(pipeline.flush)
+    assert sorted(pipeline.posted) == [0, 2, 3, 4]
+    assert [be.value for be in pipeline.failed_posts] == [1]
+
+    # Once post works again, the kept element is posted and flush succeeds
+    pipeline.fail_values = set()
+    pipeline.flush()
+    assert sorted(pipeline.posted) == list(range(5))
+
+    # Elements that still can't be posted on close are left in failed_posts
+    pipeline = FlakyPipeline(fail_values = [0], fail_times = 10 ** 9)
+    pipeline.write_queue.put(CountElement(value = 0))
+    expect_error(pipeline.close)
+    assert [be.value for be in pipeline.failed_posts] == [0]
+
+    print("All Tests Passed")